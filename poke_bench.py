@@ -0,0 +1,454 @@
+import sys, os, io, csv, json, time, random, platform, argparse, threading, contextlib, tempfile
+
+from poke_dict import PokeDex, MainLoop, Pokemon, TypeEnum, PokeDexError, csv_row, convert
+from poke_diff import diff
+
+# Benchmarks for the hot paths of poke_dict.py on synthetic dexes.
+#   python poke_bench.py generate big --size 1000000    writes big.csv
+#   python poke_bench.py run --sizes 1000,100000        times every benchmark at each size
+#   python poke_bench.py threads --threads 1,2,4,8       read throughput of a dex in concurrent mode
+#   python poke_bench.py stress --threads 8              random reads and changes from many threads, then checks the dex
+# Every run is appended to the results file (poke_bench.json) and compared against the previous run at the same size.
+
+# 16 consonants x 4 vowels, every syllable two letters so the names can't collide
+SYLLABLES = [c + v for c in 'bdfghjklmnprstvz' for v in 'aeio']
+NAME_SPACE = len(SYLLABLES) ** 4
+TYPES = [t for t in TypeEnum if t not in (TypeEnum.UNKNOWN, TypeEnum.NONE)]
+
+def synthetic_name(i):
+	# a distinct 4 syllable name for every i below NAME_SPACE, scrambled by an odd multiplier so neighbouring nums
+	# don't share prefixes
+	i = (i * 2654435761) % NAME_SPACE
+	name = ''
+	for _ in range(4):
+		name += SYLLABLES[i % len(SYLLABLES)]
+		i //= len(SYLLABLES)
+	return name.capitalize()
+
+def _family_shape(rng):
+	# parent index of each member of one evolution tree, in breadth first order. Most trees are one to three stages in a
+	# line, a few branch, and a rare one fans out eight ways from the base.
+	parents = [None]
+	stages = rng.choices((1, 2, 3), weights=(30, 35, 35))[0]
+	level = [0]
+	for _ in range(stages - 1):
+		following = []
+		for parent in level:
+			r = rng.random()
+			fan = 8 if r < 0.005 else rng.randint(2, 3) if r < 0.05 else 1
+			for _ in range(fan):
+				parents.append(parent)
+				following.append(len(parents) - 1)
+		level = following
+	return parents
+
+def generate(outname, size, seed=0):
+	# write a dex of nums 1 to size in the national.csv format, with room to add more
+	if size >= NAME_SPACE:
+		raise ValueError('size must be below {}'.format(NAME_SPACE))
+	rng = random.Random(seed)
+	max_num = size + size // 10 + 100
+	with open(outname + '.csv', 'w', newline='') as f:
+		pokedex_writer = csv.writer(f, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
+		pokedex_writer.writerow([max_num])
+		base = 1
+		while base <= size:
+			# members past size are cut off, parents always come before their evolutions so the rest stays consistent
+			parents = _family_shape(rng)[:size - base + 1]
+			type1 = rng.choice(TYPES)
+			for k, parent in enumerate(parents):
+				type2 = rng.choice(TYPES) if rng.random() < 0.4 else TypeEnum.NONE
+				evo_from = None if parent == None else base + parent
+				evo_to = [base + j for j in range(k + 1, len(parents)) if parents[j] == k]
+				pokedex_writer.writerow(csv_row(base + k, synthetic_name(base + k), type1, type2, evo_from, evo_to))
+			base += len(parents)
+	return max_num
+
+## Benchmarks
+# Each takes the context dict and returns the number of operations it timed. Setup happens outside the timed part.
+@contextlib.contextmanager
+def _quiet():
+	with contextlib.redirect_stdout(io.StringIO()):
+		yield
+
+def _timed(fn):
+	start = time.perf_counter()
+	with _quiet():
+		fn()
+	return time.perf_counter() - start
+
+def bench_populate(ctx):
+	# a cold start, parsing the csv
+	def load():
+		ctx['dex'] = PokeDex(ctx['filename'], 0, False, workers=ctx['workers'], cache=False)
+	return _timed(load), 1
+
+def bench_populate_cached(ctx):
+	# a warm start, from a cache made beforehand
+	with _quiet():
+		PokeDex(ctx['filename'], 0, False, workers=ctx['workers'])
+	return _timed(lambda: PokeDex(ctx['filename'], 0, False, workers=ctx['workers'])), 1
+
+def bench_find_num(ctx):
+	dex = ctx['dex']
+	queries = [ctx['rng'].randint(1, ctx['size']) for _ in range(ctx['ops'])]
+	def run():
+		for num in queries:
+			dex.find(num)
+	return _timed(run), len(queries)
+
+def bench_find_name(ctx):
+	dex = ctx['dex']
+	queries = [synthetic_name(ctx['rng'].randint(1, ctx['size'])).lower() for _ in range(ctx['ops'])]
+	def run():
+		for name in queries:
+			dex.find(name)
+	return _timed(run), len(queries)
+
+def bench_add_delete(ctx):
+	dex = ctx['dex']
+	ops = min(ctx['ops'], dex.get_max_num() - len(dex))
+	mons = [Pokemon(ctx['size'] + 1 + i, 'Benchmon{}'.format(i), type1=TypeEnum.FIRE) for i in range(ops)]
+	def run():
+		for mon in mons:
+			dex.add(mon)
+		for mon in mons:
+			dex.delete(mon)
+	return _timed(run), 2 * ops
+
+def bench_fan_out(ctx):
+	# link many entries to one parent, then unlink them again
+	dex = ctx['dex']
+	fan = min(ctx['ops'], 1000, ctx['size'] - 1)
+	parent = dex.find(1)
+	children = [dex.find(ctx['size'] - i) for i in range(fan)]
+	olds = [child.get_evo_from() for child in children]
+	def run():
+		for child in children:
+			parent.set_evo_to(child)
+		for child in children:
+			parent.del_evo_to(child)
+	elapsed = _timed(run)
+	# put the dex back the way it was
+	with _quiet():
+		for child, old in zip(children, olds):
+			if old != None:
+				old.set_evo_to(child)
+	return elapsed, 2 * fan
+
+def bench_repair(ctx):
+	# the full integrity pass, on a dex with nothing to fix
+	return _timed(lambda: ctx['dex'].check(repair=True)), 1
+
+def bench_query(ctx):
+	# the first run of each expression also builds the evolution masks
+	dex = ctx['dex']
+	queries = ['type=FIRE and num<{} and evolves'.format(ctx['size'] // 2), 'stage>=1 and not type2=NONE', 'name=ba or name=ko', 'not evolved and not evolves'] * 25
+	def run():
+		for expr in queries:
+			for _ in dex.query(expr):
+				pass
+	return _timed(run), len(queries)
+
+def bench_effectiveness(ctx):
+	# scoring only, for one to three attacking types
+	dex = ctx['dex']
+	attacks = [ctx['rng'].sample(TYPES, ctx['rng'].randint(1, 3)) for _ in range(100)]
+	def run():
+		for attacking in attacks:
+			dex.effectiveness(*attacking)
+	return _timed(run), len(attacks)
+
+def bench_convert(ctx):
+	# csv to gzipped JSON Lines, per entry
+	return _timed(lambda: convert(ctx['filename'] + '.csv', ctx['filename'] + '-out.jsonl.gz')), ctx['size']
+
+def bench_diff(ctx):
+	# the dex against the copy bench_write leaves, with a patch, per entry
+	if not os.path.exists(ctx['filename'] + '-out.csv'):
+		ctx['dex'].write(ctx['filename'] + '-out')
+	return _timed(lambda: diff(ctx['filename'] + '.csv', ctx['filename'] + '-out.csv', out=io.StringIO(), patch=ctx['filename'] + '.patch')), ctx['size']
+
+def bench_reload(ctx):
+	# another program changes the types of 100 rows of the dex's csv, per changed row. The dex is written to a copy
+	# first, which becomes its csv, so the generated one is left alone.
+	dex = ctx['dex']
+	filename = ctx['filename'] + '-reload'
+	with _quiet():
+		dex.write(filename)
+	dex._track_source()
+	with open(filename + '.csv', 'rb') as f:
+		lines = f.read().splitlines(keepends=True)
+	changed = ctx['rng'].sample(range(1, len(lines)), min(100, len(lines)-1))
+	for i in changed:
+		row = lines[i].split(b',')
+		row[3] = b'TypeEnum.FIRE' if row[3] == b'TypeEnum.STEEL' else b'TypeEnum.STEEL'
+		lines[i] = b','.join(row)
+	with open(filename + '.tmp', 'wb') as f:
+		f.write(b''.join(lines))
+	os.replace(filename + '.tmp', filename + '.csv')
+	return _timed(dex.reload), len(changed)
+
+def bench_chain_printer(ctx):
+	with _quiet():
+		loop = MainLoop(new=True)
+	loop.pokedex = ctx['dex']
+	mons = [ctx['dex'].find(ctx['rng'].randint(1, ctx['size'])) for _ in range(ctx['ops'])]
+	def run():
+		for mon in mons:
+			loop._chain_printer(mon)
+	return _timed(run), len(mons)
+
+def bench_write(ctx):
+	# after a handful of edits, as after an interactive session
+	dex = ctx['dex']
+	for _ in range(10):
+		mon = dex.find(ctx['rng'].randint(1, ctx['size']))
+		dex.update_types(mon, mon.get_type1(), TypeEnum.STEEL)
+	return _timed(lambda: dex.write(ctx['filename'] + '-out')), 1
+
+BENCHMARKS = [
+	('populate_from_file', bench_populate),
+	('populate_cached', bench_populate_cached),
+	('find_num', bench_find_num),
+	('find_name', bench_find_name),
+	('add_delete', bench_add_delete),
+	('set_evo_to_fan_out', bench_fan_out),
+	('repair', bench_repair),
+	('query', bench_query),
+	('effectiveness', bench_effectiveness),
+	('chain_printer', bench_chain_printer),
+	('write', bench_write),
+	('convert_jsonl', bench_convert),
+	('diff', bench_diff),
+	('reload', bench_reload),
+]
+
+def run_size(size, workdir, ops=10000, seed=0, only=None, workers=1):
+	# results for one dex size: {name: {'seconds', 'ops', 'per_op_us'}}
+	filename = os.path.join(workdir, 'synthetic-{}-{}'.format(size, seed))
+	if not os.path.exists(filename + '.csv'):
+		generate(filename, size, seed)
+	ctx = {'filename': filename, 'size': size, 'ops': ops, 'rng': random.Random(seed), 'workers': workers}
+	results = {}
+	for name, bench in BENCHMARKS:
+		# loading is needed by everything after it
+		if only != None and name not in only and name != 'populate_from_file':
+			continue
+		elapsed, count = bench(ctx)
+		results[name] = {'seconds': elapsed, 'ops': count, 'per_op_us': elapsed / max(count, 1) * 1e6}
+		print('  {:<20} {:>10.4f}s {:>12.2f}us/op'.format(name, elapsed, results[name]['per_op_us']))
+	return results
+
+def _previous(history, current, size):
+	# the latest earlier run of size with the same ops and workers, since per op times only compare between those
+	for run in reversed(history):
+		if size in run['sizes'] and run.get('ops') == current['ops'] and run.get('workers', 1) == current['workers']:
+			return run
+	return None
+
+def compare(history, current, threshold):
+	# print the change of every benchmark against the last matching run, and return the ones that got slower than threshold
+	regressions = []
+	for size, results in current['sizes'].items():
+		previous = _previous(history, current, size)
+		if previous == None:
+			print('size {}: no earlier run with {} ops and {} workers to compare with'.format(size, current['ops'], current['workers']))
+			continue
+		before = previous['sizes'][size]
+		print('size {} against {}'.format(size, previous['started']))
+		for name, result in results.items():
+			if name not in before:
+				continue
+			ratio = result['per_op_us'] / max(before[name]['per_op_us'], 1e-9)
+			flag = ''
+			if ratio > threshold:
+				flag = '  REGRESSION'
+				regressions.append((size, name, ratio))
+			print('  {:<20} {:>12.2f} -> {:>12.2f}us/op  x{:.2f}{}'.format(name, before[name]['per_op_us'], result['per_op_us'], ratio, flag))
+	return regressions
+
+## Concurrent mode
+def _load(filename, size, seed, concurrent):
+	if not os.path.exists(filename + '.csv'):
+		generate(filename, size, seed)
+	with _quiet():
+		return PokeDex(filename, 0, False, concurrent=concurrent)
+
+def _read(dex, rng, size):
+	# one find by num, by name or of an evolution family, returns an error message if the answer is wrong
+	r = rng.random()
+	num = rng.randint(1, size)
+	if r < 0.4:
+		mon = dex.find(num)
+		if mon != None and mon.get_num() != num:
+			return 'find({}) returned {}'.format(num, mon)
+	elif r < 0.8:
+		name = synthetic_name(num)
+		mon = dex.find(name)
+		if mon != None and mon.get_name().lower() != name.lower():
+			return 'find({}) returned {}'.format(name, mon)
+	else:
+		mon = dex.find(num)
+		try:
+			family = dex.evo_family(mon) if mon != None else []
+		except KeyError:
+			# deleted since it was found
+			return None
+		if len(family) > 0 and family[0][1] != 0:
+			return 'the family of {} starts at depth {}'.format(mon, family[0][1])
+	return None
+
+def _change(dex, rng, size):
+	# one random change, each made in a batch so the checks and the change happen together
+	num = rng.randint(1, size)
+	r = rng.random()
+	with dex.batch():
+		mon = dex.find(num)
+		if r < 0.15:
+			if mon == None:
+				dex.add(Pokemon(num, synthetic_name(num), type1=rng.choice(TYPES)))
+		elif r < 0.3:
+			if mon != None:
+				dex.delete(mon)
+		elif r < 0.6:
+			parent = dex.find(rng.randint(1, size))
+			if mon != None and parent != None and mon is not parent and mon.get_evo_from() == None and not dex.is_ancestor(mon, parent):
+				parent.set_evo_to(mon)
+		elif r < 0.8:
+			if mon != None and mon.get_evo_from() != None:
+				mon.get_evo_from().del_evo_to(mon)
+		elif mon != None:
+			dex.update_types(mon, rng.choice(TYPES), TypeEnum.NONE)
+
+def _run_threads(dex, size, readers, writers, seconds, seed):
+	# readers and writers hammering dex for seconds, returns (reads, changes, errors, elapsed). The elapsed time is
+	# measured, a busy thread can keep the main one from waking on time.
+	stop = threading.Event()
+	counts = {'reads': 0, 'changes': 0}
+	errors = []
+	tally = threading.Lock()
+
+	def work(kind, rng):
+		done = 0
+		try:
+			while not stop.is_set():
+				if kind == 'reads':
+					error = _read(dex, rng, size)
+					if error != None:
+						errors.append(error)
+				else:
+					_change(dex, rng, size)
+				done += 1
+		except (PokeDexError, LookupError, ValueError) as e:
+			errors.append('{}: {!r}'.format(kind, e))
+		with tally:
+			counts[kind] += done
+
+	threads = [threading.Thread(target=work, args=('reads', random.Random(seed + i))) for i in range(readers)]
+	threads += [threading.Thread(target=work, args=('changes', random.Random(seed + readers + i))) for i in range(writers)]
+	start = time.perf_counter()
+	for thread in threads:
+		thread.start()
+	time.sleep(seconds)
+	stop.set()
+	for thread in threads:
+		thread.join()
+	return counts['reads'], counts['changes'], errors, time.perf_counter() - start
+
+def threads_bench(size, thread_counts, writers, seconds, workdir, seed=0):
+	# reads per second from each number of threads on a concurrent dex, against one thread on a plain dex
+	filename = os.path.join(workdir, 'synthetic-{}-{}'.format(size, seed))
+	plain = _load(filename, size, seed, False)
+	reads, _, _, elapsed = _run_threads(plain, size, 1, 0, seconds, seed)
+	print('  {:<24} {:>12.0f} reads/s'.format('plain, 1 thread', reads / elapsed))
+	del plain
+	dex = _load(filename, size, seed, True)
+	for count in thread_counts:
+		reads, changes, errors, elapsed = _run_threads(dex, size, count, writers, seconds, seed)
+		label = 'concurrent, {} thread{}'.format(count, '' if count == 1 else 's')
+		print('  {:<24} {:>12.0f} reads/s {:>10.0f} changes/s {:>8.0f} reads/s/thread'.format(label, reads / elapsed, changes / elapsed, reads / elapsed / count))
+		for error in errors[:10]:
+			print('    ' + error)
+
+def stress(size, readers, writers, seconds, workdir, seed=0):
+	# returns the number of problems found, in the answers given during the run and in the dex after it
+	filename = os.path.join(workdir, 'synthetic-{}-{}'.format(size, seed))
+	dex = _load(filename, size, seed, True)
+	reads, changes, errors, elapsed = _run_threads(dex, size, readers, writers, seconds, seed)
+	print('{} reads and {} changes from {} threads in {:.1f}s'.format(reads, changes, readers + writers, elapsed))
+	problems = errors + dex.check()
+	nums = [mon.get_num() for mon in dex.iter_range()]
+	if nums != sorted(dex._by_num) or len(nums) != len(dex) or len(dex._by_name) != len(dex):
+		problems.append('{} entries listed, size {}, {} nums and {} names'.format(len(nums), len(dex), len(dex._by_num), len(dex._by_name)))
+	for problem in problems[:20]:
+		print('  ' + problem)
+	print('{} problems found.'.format(len(problems)))
+	return len(problems)
+
+def main(args):
+	parser = argparse.ArgumentParser(description='Generate synthetic dexes and benchmark poke_dict.py on them.')
+	sub = parser.add_subparsers(dest='mode', required=True)
+	gen = sub.add_parser('generate', help='write a synthetic dex')
+	gen.add_argument('outname', help='file to write, without the .csv extension')
+	gen.add_argument('--size', type=int, default=100000, help='number of entries (default: 100000)')
+	gen.add_argument('--seed', type=int, default=0)
+	run = sub.add_parser('run', help='time the hot paths and compare with the last run of the same settings')
+	run.add_argument('--sizes', default='1000,10000,100000', help='comma separated dex sizes, up to 10000000 (default: 1000,10000,100000)')
+	run.add_argument('--ops', type=int, default=10000, help='operations per micro benchmark (default: 10000)')
+	run.add_argument('--seed', type=int, default=0)
+	run.add_argument('--workers', type=int, default=1, help='processes used to parse the csv (default: 1)')
+	run.add_argument('--only', help='comma separated benchmarks to run')
+	run.add_argument('--workdir', default=os.path.join(tempfile.gettempdir(), 'poke_bench'), help='where synthetic dexes are generated and kept')
+	run.add_argument('--results', default='poke_bench.json', help='results history to compare with and append to (default: poke_bench.json)')
+	run.add_argument('--threshold', type=float, default=1.25, help='per-op slowdown reported as a regression (default: 1.25)')
+	run.add_argument('--fail', action='store_true', help='exit with status 1 if anything regressed')
+	conc = sub.add_parser('threads', help='measure read throughput of a dex in concurrent mode from several threads')
+	conc.add_argument('--threads', default='1,2,4,8', help='comma separated reader thread counts (default: 1,2,4,8)')
+	conc.add_argument('--writers', type=int, default=0, help='threads making changes at the same time (default: 0)')
+	stress_parser = sub.add_parser('stress', help='read and change a dex in concurrent mode from many threads, then check it')
+	stress_parser.add_argument('--threads', type=int, default=8, help='reader threads (default: 8)')
+	stress_parser.add_argument('--writers', type=int, default=4, help='threads making changes (default: 4)')
+	for p in (conc, stress_parser):
+		p.add_argument('--size', type=int, default=100000, help='entries in the synthetic dex (default: 100000)')
+		p.add_argument('--seconds', type=float, default=2.0, help='how long to run each measurement (default: 2)')
+		p.add_argument('--seed', type=int, default=0)
+		p.add_argument('--workdir', default=os.path.join(tempfile.gettempdir(), 'poke_bench'), help='where synthetic dexes are generated and kept')
+	opts = parser.parse_args(args)
+
+	if opts.mode == 'threads':
+		os.makedirs(opts.workdir, exist_ok=True)
+		threads_bench(opts.size, [int(count) for count in opts.threads.split(',')], opts.writers, opts.seconds, opts.workdir, opts.seed)
+		return 0
+	if opts.mode == 'stress':
+		os.makedirs(opts.workdir, exist_ok=True)
+		return 1 if stress(opts.size, opts.threads, opts.writers, opts.seconds, opts.workdir, opts.seed) > 0 else 0
+
+	if opts.mode == 'generate':
+		max_num = generate(opts.outname, opts.size, opts.seed)
+		print('Wrote {} entries (max_num {}) to {}.csv'.format(opts.size, max_num, opts.outname))
+		return 0
+
+	os.makedirs(opts.workdir, exist_ok=True)
+	only = None if opts.only == None else set(opts.only.split(','))
+	current = {'started': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(), 'ops': opts.ops, 'seed': opts.seed, 'workers': opts.workers, 'sizes': {}}
+	for size in [int(size) for size in opts.sizes.split(',')]:
+		print('size {}'.format(size))
+		current['sizes'][str(size)] = run_size(size, opts.workdir, opts.ops, opts.seed, only, opts.workers)
+
+	history = []
+	if os.path.exists(opts.results):
+		with open(opts.results, 'r') as f:
+			history = json.load(f)
+	regressions = compare(history, current, opts.threshold)
+	history.append(current)
+	with open(opts.results, 'w') as f:
+		json.dump(history, f, indent=1)
+	print('Results appended to {}'.format(opts.results))
+	if len(regressions) > 0:
+		print('{} benchmarks regressed by more than x{}'.format(len(regressions), opts.threshold))
+		return 1 if opts.fail else 0
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv[1:]))
@@ -1,4 +1,10 @@
-import sys, csv
+import sys, csv, os, re, io, gc, json, gzip, lzma, mmap, pickle, hashlib, math, struct, argparse, time, weakref, threading, functools, contextlib, cProfile, pstats
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from itertools import accumulate, islice, repeat, compress, chain
+from heapq import merge
+from operator import itemgetter, eq, ne, lt, le, gt, ge
+from concurrent.futures import ProcessPoolExecutor
 from enum import IntEnum
 from string import digits
 
@@ -24,6 +30,222 @@ class TypeEnum(IntEnum):
 	STEEL = 17
 	WATER = 18
 
+# csv cell text -> TypeEnum, e.g. 'TypeEnum.FIRE'
+CSV_TYPES = {'TypeEnum.{}'.format(t.name): t for t in TypeEnum}
+# csv cell text <-> type name, e.g. 'FIRE', quicker than going through TypeEnum.name
+CSV_TYPE_NAMES = {text: t.name for text, t in CSV_TYPES.items()}
+TYPE_NAME_CSV = {name: text for text, name in CSV_TYPE_NAMES.items()}
+# TypeEnum value -> TypeEnum, quicker than calling TypeEnum()
+TYPE_CODES = {t.value: t for t in TypeEnum}
+
+# Type effectiveness from generation 6 on, as (attacking type, super effective against, not very effective against, no
+# effect on), expanded into the 18x18 TYPE_CHART[attacking][defending] of damage multipliers below
+_TYPE_MATCHUPS = (
+	('NORMAL', '', 'ROCK STEEL', 'GHOST'),
+	('FIRE', 'GRASS ICE BUG STEEL', 'FIRE WATER ROCK DRAGON', ''),
+	('WATER', 'FIRE GROUND ROCK', 'WATER GRASS DRAGON', ''),
+	('ELECTRIC', 'WATER FLYING', 'ELECTRIC GRASS DRAGON', 'GROUND'),
+	('GRASS', 'WATER GROUND ROCK', 'FIRE GRASS POISON FLYING BUG DRAGON STEEL', ''),
+	('ICE', 'GRASS GROUND FLYING DRAGON', 'FIRE WATER ICE STEEL', ''),
+	('FIGHTING', 'NORMAL ICE ROCK DARK STEEL', 'POISON FLYING PSYCHIC BUG FAIRY', 'GHOST'),
+	('POISON', 'GRASS FAIRY', 'POISON GROUND ROCK GHOST', 'STEEL'),
+	('GROUND', 'FIRE ELECTRIC POISON ROCK STEEL', 'GRASS BUG', 'FLYING'),
+	('FLYING', 'GRASS FIGHTING BUG', 'ELECTRIC ROCK STEEL', ''),
+	('PSYCHIC', 'FIGHTING POISON', 'PSYCHIC STEEL', 'DARK'),
+	('BUG', 'GRASS PSYCHIC DARK', 'FIRE FIGHTING POISON FLYING GHOST STEEL FAIRY', ''),
+	('ROCK', 'FIRE ICE FLYING BUG', 'FIGHTING GROUND STEEL', ''),
+	('GHOST', 'PSYCHIC GHOST', 'DARK', 'NORMAL'),
+	('DRAGON', 'DRAGON', 'STEEL', 'FAIRY'),
+	('DARK', 'PSYCHIC GHOST', 'FIGHTING DARK FAIRY', ''),
+	('STEEL', 'ICE ROCK FAIRY', 'FIRE WATER ELECTRIC STEEL', ''),
+	('FAIRY', 'FIGHTING DRAGON DARK', 'FIRE POISON STEEL', ''),
+)
+# the types a pokemon can have, and attack with
+ELEMENTAL_TYPES = [t for t in TypeEnum if t not in (TypeEnum.UNKNOWN, TypeEnum.NONE)]
+
+def _type_chart():
+	chart = {attacking: {defending: 1.0 for defending in ELEMENTAL_TYPES} for attacking in ELEMENTAL_TYPES}
+	for attacking, strong, weak, immune in _TYPE_MATCHUPS:
+		for names, multiplier in ((strong, 2.0), (weak, 0.5), (immune, 0.0)):
+			for defending in names.split():
+				chart[TypeEnum[attacking]][TypeEnum[defending]] = multiplier
+	return chart
+
+TYPE_CHART = _type_chart()
+
+def type_multiplier(attacking, type1, type2):
+	# damage multiplier of an attack on a pokemon of these types. NONE and UNKNOWN slots take normal damage, and a type
+	# in both slots counts once.
+	row = TYPE_CHART[attacking]
+	multiplier = row.get(type1, 1.0)
+	if type2 != type1:
+		multiplier *= row.get(type2, 1.0)
+	return multiplier
+
+def pokemon_record(pokemon):
+	# plain dict form of an entry, for JSON output
+	evo_from = pokemon.get_evo_from()
+	return {
+		'num': pokemon.get_num(),
+		'name': pokemon.get_name(),
+		'type1': pokemon.get_type1().name,
+		'type2': pokemon.get_type2().name,
+		'evo_from': None if evo_from == None else evo_from.get_num(),
+		'evo_to': [mon.get_num() for mon in pokemon.get_evo_to()],
+	}
+
+## Bitsets over dex numbers
+# Mutable bitsets are bytearrays (bit n is bit n%8 of byte n//8) so single bits flip in O(1); queries turn them into
+# ints and combine them with & and |.
+def _bit_set(bits, n):
+	i = n >> 3
+	if i >= len(bits):
+		bits.extend(bytes(i + 1 - len(bits)))
+	bits[i] |= 1 << (n & 7)
+
+def _bit_clear(bits, n):
+	i = n >> 3
+	if i < len(bits):
+		bits[i] &= ~(1 << (n & 7)) & 0xff
+
+def _bits_to_int(bits):
+	return int.from_bytes(bits, 'little')
+
+_NONZERO_BYTE = re.compile(b'[^\x00]')
+
+def _iter_bits(mask):
+	# yield the set bits of an int in ascending order, skipping runs of empty bytes at C speed
+	data = mask.to_bytes((mask.bit_length() + 7) // 8, 'little')
+	for match in _NONZERO_BYTE.finditer(data):
+		base = match.start() * 8
+		byte = data[match.start()]
+		while byte:
+			low = byte & -byte
+			yield base + low.bit_length() - 1
+			byte ^= low
+
+def _edit_distance(a, b, limit):
+	# Levenshtein distance between a and b, or limit+1 as soon as it is known to exceed limit. Only the cells within
+	# limit of the diagonal can stay under the limit, so the rest of each row is never filled in.
+	big = limit + 1
+	if abs(len(a) - len(b)) > limit:
+		return big
+	prev = [j if j <= limit else big for j in range(len(b) + 1)]
+	for i in range(1, len(a) + 1):
+		cur = [big] * (len(b) + 1)
+		if i <= limit:
+			cur[0] = i
+		ch = a[i-1]
+		for j in range(max(1, i - limit), min(len(b), i + limit) + 1):
+			cost = prev[j-1] + (ch != b[j-1])
+			if prev[j] + 1 < cost:
+				cost = prev[j] + 1
+			if cur[j-1] + 1 < cost:
+				cost = cur[j-1] + 1
+			cur[j] = cost
+		if min(cur) > limit:
+			return big
+		prev = cur
+	return min(prev[-1], big)
+
+def _edit_variants(text, alphabet):
+	# text and every string one insertion, deletion or substitution away from it
+	variants = {text}
+	for i in range(len(text) + 1):
+		for ch in alphabet:
+			variants.add(text[:i] + ch + text[i:])
+			if i < len(text):
+				variants.add(text[:i] + ch + text[i+1:])
+		if i < len(text):
+			variants.add(text[:i] + text[i+1:])
+	return variants
+
+def _prefix_count(names, prefix):
+	# how many entries of a sorted list start with prefix
+	return bisect_left(names, prefix + '\U0010ffff') - bisect_left(names, prefix)
+
+def _prefixed(names, prefix):
+	# the entries of a sorted list that start with prefix
+	i = bisect_left(names, prefix)
+	while i < len(names) and names[i].startswith(prefix):
+		yield names[i]
+		i += 1
+
+def _gap_line(lo, hi):
+	return '{} UNKNOWN/UNSEEN'.format(lo) if lo == hi else '{}-{} UNKNOWN/UNSEEN'.format(lo, hi)
+
+def _listing(pokemons, fltr, lo, hi, num_of=None):
+	# lines for the list command from entries in num order, with fltr 'all' also one line per run of missing nums.
+	# num_of gives the number to list an entry under, if not its own.
+	expected = lo
+	for pokemon in pokemons:
+		num = pokemon.get_num() if num_of == None else num_of(pokemon)
+		if fltr == 'all' and num > expected:
+			yield _gap_line(expected, num-1)
+		yield '{} {}'.format(num, pokemon.get_name())
+		expected = num + 1
+	if fltr == 'all' and expected <= hi:
+		yield _gap_line(expected, hi)
+
+def _print_lines(lines, start=0, count=None, batch=4096):
+	# print lines[start:start+count] a batch at a time
+	lines = islice(lines, start, None if count == None else start + count)
+	while True:
+		chunk = list(islice(lines, batch))
+		if len(chunk) == 0:
+			break
+		print('\n'.join(chunk))
+
+def csv_row(num, name, type1, type2, evo_from, evo_to):
+	# types are spelled out explicitly, str() of an IntEnum is just the number on newer Pythons
+	return [num, name, 'TypeEnum.{}'.format(type1.name), 'TypeEnum.{}'.format(type2.name), evo_from] + evo_to
+
+@contextlib.contextmanager
+def atomic_open(outname, mode='wb', **kwargs):
+	# write to a temp file next to outname and only rename it over outname once it is safely on disk, so a crash part
+	# way through leaves the old file untouched
+	tmpname = outname + '.tmp'
+	try:
+		with open(tmpname, mode, **kwargs) as f:
+			yield f
+			f.flush()
+			os.fsync(f.fileno())
+		os.replace(tmpname, outname)
+	except BaseException:
+		if os.path.exists(tmpname):
+			os.remove(tmpname)
+		raise
+	# make the rename itself durable
+	if hasattr(os, 'O_DIRECTORY'):
+		fd = os.open(os.path.dirname(os.path.abspath(outname)), os.O_RDONLY | os.O_DIRECTORY)
+		try:
+			os.fsync(fd)
+		finally:
+			os.close(fd)
+
+# the collector is switched for the whole process, so overlapping pauses from different threads are counted and only
+# the last one to finish turns it back on, and only if it was on before the first
+_gc_lock = threading.Lock()
+_gc_pauses = 0
+_gc_was_enabled = False
+
+@contextlib.contextmanager
+def _gc_paused():
+	# for building or saving many small containers at once, which would otherwise set off full collections
+	global _gc_pauses, _gc_was_enabled
+	with _gc_lock:
+		if _gc_pauses == 0:
+			_gc_was_enabled = gc.isenabled()
+			gc.disable()
+		_gc_pauses += 1
+	try:
+		yield
+	finally:
+		with _gc_lock:
+			_gc_pauses -= 1
+			if _gc_pauses == 0 and _gc_was_enabled:
+				gc.enable()
+
 class Pokemon:
 	def __init__(self, num, name, **kwargs):
 		self._num = num
@@ -33,6 +255,10 @@ class Pokemon:
 		self._type2 = kwargs.get('type2', TypeEnum.NONE)
 		self._evo_from = None
 		self._evo_to = []
+		# the PokeDex this entry belongs to, if any
+		self._dex = None
+		# index of this entry's row in the dex's source csv, None once the row needs rewriting
+		self._row = None
 
 	def get_num(self):
 		return self._num
@@ -62,22 +288,60 @@ class Pokemon:
 		return self._evo_from
 
 	def set_evo_from(self, pokemon, inner=False):
+		lock = self._unheld_lock() if not inner else None
+		if lock != None:
+			with lock.exclusive():
+				return self.set_evo_from(pokemon)
+		old = self._evo_from
+		if not inner:
+			self._links_changing(old, pokemon)
+		# an entry has one prior evolution, so it leaves the evo_to list of the one it had
+		if isinstance(old, Pokemon) and old is not pokemon:
+			old.del_evo_to(self, inner=True)
 		self._evo_from = pokemon
 		# not inner to prevent infinite loop
 		if isinstance(pokemon, Pokemon) and not inner:
 			pokemon.set_evo_to(self, inner=True)
+		if not inner:
+			self._links_changed(old, pokemon)
 
 	def del_evo_from(self, inner=False):
+		lock = self._unheld_lock() if not inner else None
+		if lock != None:
+			with lock.exclusive():
+				return self.del_evo_from()
+		old = self._evo_from
+		if not inner:
+			self._links_changing(old)
 		# not inner to prevent infinite loop
 		if isinstance(self._evo_from, Pokemon) and not inner:
 			self._evo_from.del_evo_to(self, inner=True)
 		self._evo_from = None
+		if not inner:
+			self._links_changed(old)
 
 	def get_evo_to(self):
 		return self._evo_to
 
 	def set_evo_to(self, pokemon, inner=False):
-		if isinstance(pokemon, Pokemon):
+		lock = self._unheld_lock() if not inner else None
+		if lock != None:
+			with lock.exclusive():
+				return self.set_evo_to(pokemon)
+		old = None
+		if isinstance(pokemon, Pokemon) and not inner:
+			# an entry has one prior evolution, so pokemon leaves the evo_to list of the one it had
+			old = pokemon.get_evo_from() if pokemon.get_evo_from() is not self else None
+			self._links_changing(pokemon, old)
+			if isinstance(old, Pokemon):
+				old.del_evo_to(pokemon, inner=True)
+		if isinstance(pokemon, Pokemon) and self._dex != None and self._dex._batch != None:
+			# inside a batch evolutions are just appended, the dex sorts them and drops repeats on commit
+			self._evo_to.append(pokemon)
+			if not inner:
+				pokemon.set_evo_from(self, inner=True)
+				self._links_changed(pokemon, old)
+		elif isinstance(pokemon, Pokemon):
 			duplicate = False
 			for mon in self._evo_to:
 				if mon.get_num() == pokemon.get_num():
@@ -97,23 +361,39 @@ class Pokemon:
 			# prevent infinite loop
 			if not inner:
 				pokemon.set_evo_from(self, inner=True)
+				self._links_changed(pokemon, old)
 
 	def del_evo_to(self, pokemon, inner=False):
+		lock = self._unheld_lock() if not inner else None
+		if lock != None:
+			with lock.exclusive():
+				return self.del_evo_to(pokemon)
 		if isinstance(pokemon, Pokemon):
-			i = 0
-			# find pokemon to delete
-			for mon in self._evo_to:
-				if mon.get_num() == pokemon.get_num():
-					break
-				i += 1
-			# if pokemon found
-			if i < len(self._evo_to):
-				del self._evo_to[i]
+			if not inner:
+				self._links_changing(pokemon)
+			# drop every copy of pokemon, a batch may have appended it more than once
+			self._evo_to = [mon for mon in self._evo_to if mon.get_num() != pokemon.get_num()]
 
 			# prevent infinite loop
 			if not inner:
 				pokemon.del_evo_from(inner=True)
+				self._links_changed(pokemon)
+
+	def _unheld_lock(self):
+		# the owning dex's lock, if it is in concurrent mode and this thread doesn't hold it yet
+		lock = self._dex._lock if self._dex != None else None
+		return lock if lock != None and not lock.held() else None
+
+	def _links_changing(self, *others):
+		# let the owning dex save these entries before their links change, for a batch or snapshot
+		if self._dex != None:
+			self._dex._touch(self, *others)
 
+	def _links_changed(self, *others):
+		# let the owning dex update its evolution index, and mark the rows that name either end as changed
+		if self._dex != None:
+			self._dex._evo_reindex(self, *others)
+			self._dex._mark_dirty(self, *others)
 
 	def __repr__(self):
 		return 'No: {}\nName: {}\nType 1: {}\nType 2: {}\nEvolves From: {}\nEvolves To: {}'.format(self._num, self._name, self._type1.name, self._type2.name, str(self._evo_from), [str(pokemon) for pokemon in self._evo_to])
@@ -122,6 +402,356 @@ class Pokemon:
 		return '{} {}'.format(self._num, self._name)
 
 
+## Parallel loading
+# The rows of a dex csv are cut into line aligned byte ranges that worker processes parse into columns: nums, type
+# codes, evo_from nums (0 for none), a CSR table of evo_to nums, a utf-8 name pool and the byte offset of every row.
+# Each range comes back as a handful of arrays, not an object per row. Rows are assumed to be one line each, which
+# is how write() lays them out.
+def _csv_chunks(filename, parts):
+	# (max_num, [(start, end)]) splitting the rows after the max_num line into about parts ranges
+	with open(filename, 'rb') as f:
+		max_num = int(f.readline().split(b',')[0])
+		first = f.tell()
+		size = os.fstat(f.fileno()).st_size
+		bounds = [first]
+		for k in range(1, parts):
+			f.seek(max(first + (size - first) * k // parts - 1, bounds[-1]))
+			# move on to the start of the next line
+			f.readline()
+			if f.tell() > bounds[-1] and f.tell() < size:
+				bounds.append(f.tell())
+		bounds.append(size)
+	return max_num, list(zip(bounds, bounds[1:]))
+
+def _parse_chunk(filename, start, end):
+	with open(filename, 'rb') as f:
+		f.seek(start)
+		data = f.read(end - start)
+	lines = data.splitlines(keepends=True)
+	line_offs = array('Q', accumulate(map(len, lines), initial=start))
+	nums = array('i')
+	type1 = array('b')
+	type2 = array('b')
+	evo_from = array('i')
+	evo_off = array('I', [0])
+	evo_to = array('i')
+	name_off = array('I', [0])
+	pool = bytearray()
+	row_offs = array('Q')
+	pokedex_reader = csv.reader(map(bytes.decode, lines), delimiter=',', quotechar='|')
+	row_start = 0
+	for row in pokedex_reader:
+		row_offs.append(line_offs[row_start])
+		row_start = pokedex_reader.line_num
+		nums.append(int(row[0]))
+		pool += row[1].encode('utf-8')
+		name_off.append(len(pool))
+		type1.append(CSV_TYPES[row[2]])
+		type2.append(CSV_TYPES[row[3]])
+		evo_from.append(int(row[4]) if len(row[4]) > 0 else 0)
+		evo_to.extend(int(evo) for evo in row[5:])
+		evo_off.append(len(evo_to))
+	return nums, type1, type2, evo_from, evo_off, evo_to, name_off, bytes(pool), row_offs
+
+# below this a csv parses faster in one process than it takes to start a pool
+PARALLEL_MIN_BYTES = 1 << 22
+
+def _parse_workers(filename, workers):
+	# how many processes to actually parse filename with: no more than there are cpus, and 1 for a small csv
+	workers = min(workers, os.cpu_count() or 1)
+	if workers > 1 and os.path.getsize(filename) < PARALLEL_MIN_BYTES:
+		return 1
+	return workers
+
+def _parse_parallel(filename, workers):
+	# (max_num, [columns of each range in file order]) using a pool of workers processes
+	max_num, chunks = _csv_chunks(filename, workers * 4)
+	with ProcessPoolExecutor(workers) as executor:
+		parts = list(executor.map(_parse_chunk, repeat(filename), [c[0] for c in chunks], [c[1] for c in chunks]))
+	return max_num, parts
+
+## JSON Lines
+# A dex as NDJSON is a header line {"max_num": N} followed by one pokemon_record() per line. A name ending in .gz or .xz
+# is compressed or decompressed on the fly. Records are generated and written one at a time (in batches of
+# JSONL_BATCH lines), so converting between csv and NDJSON never holds more than a batch, and never makes a Pokemon.
+JSONL_BATCH = 4096
+JSONL_EXTS = ('.jsonl', '.ndjson')
+
+def _compression(filename):
+	# module that compresses filename, None for a plain file
+	if filename.endswith('.gz'):
+		return gzip
+	if filename.endswith('.xz'):
+		return lzma
+	return None
+
+def _plain_name(filename):
+	# filename without the compression extension
+	return filename[:-3] if _compression(filename) != None else filename
+
+def is_jsonl(filename):
+	return _plain_name(filename).endswith(JSONL_EXTS)
+
+def _open_stream(filename):
+	# binary reader of filename's contents
+	compression = _compression(filename)
+	return open(filename, 'rb') if compression == None else compression.open(filename, 'rb')
+
+@contextlib.contextmanager
+def _write_stream(outname):
+	# binary writer that replaces outname once closed, see atomic_open
+	compression = _compression(outname)
+	with atomic_open(outname) as f:
+		if compression == gzip:
+			with gzip.GzipFile(fileobj=f, mode='wb', compresslevel=6) as stream:
+				yield stream
+		elif compression == lzma:
+			with lzma.LZMAFile(f, 'wb') as stream:
+				yield stream
+		else:
+			yield f
+
+def _line_terminator(line):
+	# the line break a csv line ends with, csv.writer's own \r\n unless it is a bare \n
+	return '\n' if line.endswith(b'\n') and not line.endswith(b'\r\n') else '\r\n'
+
+def file_line_terminator(filename):
+	# the line break of filename's first line, so a rewrite keeps the file's line breaks
+	with _open_stream(filename) as f:
+		return _line_terminator(f.readline())
+
+def csv_records(filename):
+	# the header and the record of every row of a dex csv, in file order
+	with io.TextIOWrapper(_open_stream(filename), encoding='utf-8', newline='') as f:
+		pokedex_reader = csv.reader(f, delimiter=',', quotechar='|')
+		# first row contains the max_num
+		yield {'max_num': int(next(pokedex_reader)[0])}
+		for row in pokedex_reader:
+			yield {
+				'num': int(row[0]),
+				'name': row[1],
+				'type1': CSV_TYPE_NAMES[row[2]],
+				'type2': CSV_TYPE_NAMES[row[3]],
+				'evo_from': None if len(row[4]) == 0 else int(row[4]),
+				'evo_to': [int(evo) for evo in row[5:]],
+			}
+
+def jsonl_records(filename):
+	# the header and the records of an NDJSON dex, in file order
+	with _open_stream(filename) as f:
+		first = True
+		for line in f:
+			if len(line.strip()) == 0:
+				continue
+			rec = json.loads(line)
+			if first and 'max_num' not in rec:
+				raise PokeDexBadFile
+			first = False
+			yield rec
+		# not even the header
+		if first:
+			raise PokeDexBadFile
+
+def dex_records(dex):
+	# the header and the record of every entry of a dex or a snapshot of one, in num order
+	yield {'max_num': dex.get_max_num()}
+	for pokemon in dex.iter_range():
+		yield pokemon_record(pokemon)
+
+def write_jsonl(outname, records):
+	# records as NDJSON, returns how many entries there were
+	records = iter(records)
+	count = -1
+	with _write_stream(outname) as f:
+		for batch in iter(lambda: list(islice(records, JSONL_BATCH)), []):
+			f.write(''.join(json.dumps(rec) + '\n' for rec in batch).encode('utf-8'))
+			count += len(batch)
+	return count
+
+def write_csv_records(outname, records, lineterminator='\r\n'):
+	# records (from csv_records() or jsonl_records()) as a dex csv
+	records = iter(records)
+	text = io.StringIO()
+	pokedex_writer = csv.writer(text, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL, lineterminator=lineterminator)
+	count = -1
+	with _write_stream(outname) as f:
+		for batch in iter(lambda: list(islice(records, JSONL_BATCH)), []):
+			for rec in batch:
+				if count == -1:
+					pokedex_writer.writerow([rec['max_num']])
+				else:
+					pokedex_writer.writerow([rec['num'], rec['name'], TYPE_NAME_CSV[rec['type1']], TYPE_NAME_CSV[rec['type2']], rec['evo_from']] + rec['evo_to'])
+				count += 1
+			f.write(text.getvalue().encode('utf-8'))
+			text.seek(0)
+			text.truncate()
+	return count
+
+def file_records(filename):
+	# csv_records() or jsonl_records(), by the file's extension
+	return jsonl_records(filename) if is_jsonl(filename) else csv_records(filename)
+
+def convert(src, dst):
+	# stream a dex between the csv and NDJSON formats, either of them compressed, and return the number of entries
+	records = file_records(src)
+	if is_jsonl(dst):
+		return write_jsonl(dst, records)
+	# a csv keeps its line breaks, NDJSON has none to keep so csv.writer's are used
+	return write_csv_records(dst, records, '\r\n' if is_jsonl(src) else file_line_terminator(src))
+
+# Latency of commands and of the phases inside them, as a count and a histogram per name. Bucket b holds the times
+# between STATS_BUCKET**b and STATS_BUCKET**(b+1) nanoseconds, so percentiles are read back to within 5%.
+STATS_BUCKET = 1.05
+
+class LatencyStats:
+	def __init__(self):
+		self.reset()
+
+	def reset(self):
+		# name -> [count, total seconds, max seconds, {bucket: count}]
+		self._hists = {}
+
+	def record(self, name, seconds):
+		hist = self._hists.get(name, None)
+		if hist == None:
+			hist = self._hists[name] = [0, 0.0, 0.0, {}]
+		hist[0] += 1
+		hist[1] += seconds
+		hist[2] = max(hist[2], seconds)
+		bucket = int(math.log(max(seconds * 1e9, 1.0), STATS_BUCKET))
+		hist[3][bucket] = hist[3].get(bucket, 0) + 1
+
+	@contextlib.contextmanager
+	def timed(self, name):
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.record(name, time.perf_counter() - start)
+
+	def percentile(self, name, p):
+		# upper edge of the bucket holding the p-th percentile, in seconds
+		count, _, most, buckets = self._hists[name]
+		rank = max(1, math.ceil(count * p / 100))
+		seen = 0
+		for bucket in sorted(buckets):
+			seen += buckets[bucket]
+			if seen >= rank:
+				return min(STATS_BUCKET ** (bucket + 1) / 1e9, most)
+		return most
+
+	def summary(self):
+		# {name: {count, total, mean, p50, p95, p99, max}} with times in seconds
+		summary = {}
+		for name in sorted(self._hists):
+			count, total, most, _ = self._hists[name]
+			summary[name] = {'count': count, 'total': total, 'mean': total / count, 'p50': self.percentile(name, 50), 'p95': self.percentile(name, 95), 'p99': self.percentile(name, 99), 'max': most}
+		return summary
+
+STATS = LatencyStats()
+
+## Locking
+# Many readers or one writer. A waiting writer holds back new readers so a steady stream of reads can't starve it, and
+# the readers held back by a writer all go before the next writer, so steady writes can't starve them either. Both
+# sides are reentrant, and the writer may also read, but a reader can't start writing without letting go first.
+class ReadWriteLock:
+	def __init__(self):
+		# the fast paths take the mutex directly, waiting goes through the condition on it
+		self._mutex = threading.Lock()
+		self._cond = threading.Condition(self._mutex)
+		self._readers = 0
+		self._writer = None
+		# nesting depth of the writer and writers waiting for the lock. Readers held back wait for the current or next
+		# writer to finish, counted by _phase, and are then let in ahead of the following writer.
+		self._writes = 0
+		self._waiting = 0
+		self._phase = 0
+		self._held_back = 0
+		self._admitting = 0
+		# read nesting depth of the current thread
+		self._local = threading.local()
+
+	def acquire_shared(self):
+		local = self._local
+		depth = getattr(local, 'depth', 0)
+		if depth == 0 and self._writer != threading.get_ident():
+			with self._mutex:
+				if self._writer != None or self._waiting > 0:
+					phase = self._phase
+					self._held_back += 1
+					while self._phase == phase:
+						self._cond.wait()
+					self._admitting -= 1
+				self._readers += 1
+		local.depth = depth + 1
+
+	def release_shared(self):
+		local = self._local
+		depth = local.depth = local.depth - 1
+		if depth == 0 and self._writer != threading.get_ident():
+			with self._mutex:
+				self._readers -= 1
+				if self._readers == 0 and self._waiting > 0:
+					self._cond.notify_all()
+
+	def held(self):
+		# True if this thread holds the exclusive lock
+		return self._writer == threading.get_ident()
+
+	def acquire_exclusive(self):
+		me = threading.get_ident()
+		if self._writer == me:
+			self._writes += 1
+			return
+		if getattr(self._local, 'depth', 0) > 0:
+			raise RuntimeError('Can\'t take the exclusive lock while holding the shared one.')
+		with self._mutex:
+			self._waiting += 1
+			while self._writer != None or self._readers > 0 or self._admitting > 0:
+				self._cond.wait()
+			self._waiting -= 1
+			self._writer = me
+			self._writes = 1
+
+	def release_exclusive(self):
+		self._writes -= 1
+		if self._writes > 0:
+			return
+		with self._mutex:
+			self._writer = None
+			self._phase += 1
+			self._admitting += self._held_back
+			self._held_back = 0
+			self._cond.notify_all()
+
+	@contextlib.contextmanager
+	def shared(self):
+		self.acquire_shared()
+		try:
+			yield
+		finally:
+			self.release_shared()
+
+	@contextlib.contextmanager
+	def exclusive(self):
+		self.acquire_exclusive()
+		try:
+			yield
+		finally:
+			self.release_exclusive()
+
+def _locked(method, acquire, release, listed=False):
+	# method run while holding a lock, see PokeDex._make_concurrent(). With listed=True its results are gathered into a
+	# list under the lock, for methods that yield them.
+	@functools.wraps(method)
+	def locked(*args, **kwargs):
+		acquire()
+		try:
+			return iter(list(method(*args, **kwargs))) if listed else method(*args, **kwargs)
+		finally:
+			release()
+	return locked
+
 ## PokeDex Exceptions
 class PokeDexError(Exception):
 	pass
@@ -144,205 +774,3036 @@ class PokeDexOutOfRange(PokeDexError):
 class PokeDexBadMax(PokeDexError):
 	pass
 
+class PokeDexBadFile(PokeDexError):
+	pass
+
+class PokeDexUnsupported(PokeDexError):
+	pass
+
+class PokeDexBadQuery(PokeDexError):
+	# the message says what is wrong with the query
+	pass
+
+class PokeDexBadType(PokeDexError):
+	# the message names the type that can't attack
+	pass
+
+## Query language
+# Expressions for PokeDex.query(), like 'type=FIRE and num<200 and evolves'. The conditions are
+#   num <op> N        op is one of = != < <= > >=
+#   stage <op> N      0 for a base form, 1 for what it evolves into, and so on
+#   type=T            T in either slot, type1=T and type2=T for one slot, all three also with !=
+#   name=TEXT         names starting with TEXT, ignoring case
+#   evolves           has an evolution
+#   evolved           has a prior evolution
+# combined with not, and, or (binding in that order) and parentheses. compile_query() turns an expression into a tree
+# of tuples once, and PokeDex._query_mask() evaluates the tree with ands and ors of bitsets over the nums.
+QUERY_TOKEN = re.compile(r'\s*(?:([()])|(\w+)\s*(<=|>=|!=|=|<|>)\s*([^\s()]+)|(\w+))')
+QUERY_OPS = {'=': eq, '!=': ne, '<': lt, '<=': le, '>': gt, '>=': ge}
+QUERY_FLAGS = ('evolves', 'evolved')
+QUERY_TYPE_SLOTS = {'type': 0, 'type1': 1, 'type2': 2}
+
+def _query_tokens(text):
+	# ('(',), (')',), ('cmp', field, op, value) and ('word', word)
+	tokens = []
+	pos = 0
+	while len(text[pos:].strip()) > 0:
+		match = QUERY_TOKEN.match(text, pos)
+		if match == None:
+			raise PokeDexBadQuery('Can\'t read the query from \'{}\'.'.format(text[pos:].strip()))
+		paren, field, op, value, word = match.groups()
+		if paren != None:
+			tokens.append((paren,))
+		elif field != None:
+			tokens.append(('cmp', field.lower(), op, value))
+		else:
+			tokens.append(('word', word.lower()))
+		pos = match.end()
+	return tokens
+
+def _query_condition(field, op, value):
+	if field in ('num', 'stage'):
+		try:
+			return (field, op, int(value))
+		except ValueError:
+			raise PokeDexBadQuery('{} needs a number, not \'{}\'.'.format(field, value))
+	if field in QUERY_TYPE_SLOTS:
+		if op not in ('=', '!='):
+			raise PokeDexBadQuery('{} can only be compared with = or !=.'.format(field))
+		if value.upper() not in TypeEnum.__members__:
+			raise PokeDexBadQuery('{} is not a type.'.format(value))
+		return ('type', QUERY_TYPE_SLOTS[field], op, TypeEnum[value.upper()])
+	if field == 'name':
+		if op != '=':
+			raise PokeDexBadQuery('name can only be matched with =.')
+		return ('name', value.lower())
+	raise PokeDexBadQuery('There is no field \'{}\'.'.format(field))
+
+def _parse_or(tokens, i):
+	node, i = _parse_and(tokens, i)
+	while i < len(tokens) and tokens[i] == ('word', 'or'):
+		right, i = _parse_and(tokens, i+1)
+		node = ('or', node, right)
+	return node, i
+
+def _parse_and(tokens, i):
+	node, i = _parse_not(tokens, i)
+	while i < len(tokens) and tokens[i] == ('word', 'and'):
+		right, i = _parse_not(tokens, i+1)
+		node = ('and', node, right)
+	return node, i
+
+def _parse_not(tokens, i):
+	if i == len(tokens):
+		raise PokeDexBadQuery('The query ends too early.')
+	token = tokens[i]
+	if token == ('word', 'not'):
+		node, i = _parse_not(tokens, i+1)
+		return ('not', node), i
+	if token == ('(',):
+		node, i = _parse_or(tokens, i+1)
+		if i == len(tokens) or tokens[i] != (')',):
+			raise PokeDexBadQuery('A \'(\' is never closed.')
+		return node, i+1
+	if token[0] == 'cmp':
+		return _query_condition(*token[1:]), i+1
+	if token[0] == 'word' and token[1] in QUERY_FLAGS:
+		return (token[1],), i+1
+	raise PokeDexBadQuery('Didn\'t expect \'{}\' there.'.format(token[-1]))
+
+@functools.lru_cache(maxsize=256)
+def compile_query(text):
+	tokens = _query_tokens(text)
+	node, i = _parse_or(tokens, 0)
+	if i != len(tokens):
+		raise PokeDexBadQuery('Didn\'t expect \'{}\' there.'.format(tokens[i][-1]))
+	return node
+
+def _range_mask(lo, hi):
+	# bits lo to hi
+	lo = max(lo, 0)
+	return 0 if hi < lo else ((1 << (hi + 1)) - 1) >> lo << lo
+
+## Binary (.pdx) snapshot format
+# All integers are little-endian. The file is a header followed by fixed-width columns, one slot per entry, sorted by num:
+#   header     magic, max_num, count, edge count, name pool size
+#   nums       int32[count]
+#   type1      int8[count]
+#   type2      int8[count]   (padded to a multiple of 4)
+#   evo_from   int32[count]  (0 when there is no prior evolution)
+#   evo_off    uint32[count+1]  CSR offsets into evo_to
+#   evo_to     int32[edges]
+#   name_off   uint32[count+1]  offsets into the name pool
+#   name_order uint32[count]    entry indices sorted by lowercase name
+#   name pool  utf-8 bytes
+PDX_MAGIC = b'PDX1'
+PDX_HEADER = struct.Struct('<4sIIII')
+
+def _pdx_layout(count, edges):
+	# byte offset of every column, in file order
+	layout = {}
+	pos = PDX_HEADER.size
+	for column, size in (('nums', 4*count), ('type1', count), ('type2', count)):
+		layout[column] = pos
+		pos += size
+	pos += -pos % 4
+	for column, size in (('evo_from', 4*count), ('evo_off', 4*(count+1)), ('evo_to', 4*edges), ('name_off', 4*(count+1)), ('name_order', 4*count)):
+		layout[column] = pos
+		pos += size
+	layout['names'] = pos
+	return layout
+
+def _write_pdx(outname, max_num, nums, type1, type2, evo_from, evo_off, evo_to, name_off, name_order, pool):
+	# every column is an array in slot (num) order, see the layout above
+	columns = [nums, type1, type2, evo_from, evo_off, evo_to, name_off, name_order]
+	if sys.byteorder != 'little':
+		columns = [array(column.typecode, column) for column in columns]
+		for column in columns:
+			column.byteswap()
+	layout = _pdx_layout(len(nums), len(evo_to))
+	with atomic_open(outname) as f:
+		f.write(PDX_HEADER.pack(PDX_MAGIC, max_num, len(nums), len(evo_to), len(pool)))
+		for column, data in zip(('nums', 'type1', 'type2', 'evo_from', 'evo_off', 'evo_to', 'name_off', 'name_order'), columns):
+			# pad up to the start of the column
+			f.write(bytes(layout[column] - f.tell()))
+			f.write(data.tobytes())
+		f.write(pool)
+	print('Wrote to {}'.format(outname))
+
+class _PdxReader:
+	# zero-copy view over a memory-mapped .pdx file; entries are decoded on demand
+	def __init__(self, filename):
+		self._file = open(filename, 'rb')
+		try:
+			self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+		except ValueError:
+			# empty file
+			self._file.close()
+			raise PokeDexBadFile
+		magic, self.max_num, self.count, edges, pool_size = PDX_HEADER.unpack_from(self._map, 0)
+		if magic != PDX_MAGIC:
+			self.close()
+			raise PokeDexBadFile
+
+		layout = _pdx_layout(self.count, edges)
+		buf = memoryview(self._map)
+		self._views = [buf]
+		self.nums = self._column(buf, layout['nums'], self.count, 'i')
+		self.type1 = self._column(buf, layout['type1'], self.count, 'b')
+		self.type2 = self._column(buf, layout['type2'], self.count, 'b')
+		self.evo_from = self._column(buf, layout['evo_from'], self.count, 'i')
+		self.evo_off = self._column(buf, layout['evo_off'], self.count+1, 'I')
+		self.evo_to = self._column(buf, layout['evo_to'], edges, 'i')
+		self.name_off = self._column(buf, layout['name_off'], self.count+1, 'I')
+		self.name_order = self._column(buf, layout['name_order'], self.count, 'I')
+		self.names = buf[layout['names']:layout['names']+pool_size]
+		self._views.append(self.names)
+
+	def _column(self, buf, start, length, code):
+		size = array(code).itemsize
+		view = buf[start:start+size*length]
+		self._views.append(view)
+		if sys.byteorder == 'little':
+			view = view.cast(code)
+			self._views.append(view)
+			return view
+		# big-endian hosts pay for one copy per column
+		column = array(code, view)
+		column.byteswap()
+		return column
+
+	def index_of_num(self, num):
+		i = bisect_left(self.nums, num)
+		return i if i < self.count and self.nums[i] == num else None
+
+	def index_of_name(self, name):
+		lower = name.lower()
+		i = bisect_left(self.name_order, lower, key=lambda j: self.name(j).lower())
+		if i < self.count and self.name(self.name_order[i]).lower() == lower:
+			return self.name_order[i]
+		return None
+
+	def name(self, i):
+		return str(self.names[self.name_off[i]:self.name_off[i+1]], 'utf-8')
+
+	def evos(self, i):
+		return self.evo_to[self.evo_off[i]:self.evo_off[i+1]].tolist()
+
+	def close(self):
+		# every exported memoryview has to be released before the map can close
+		for view in reversed(self._views if hasattr(self, '_views') else []):
+			view.release()
+		self._map.close()
+		self._file.close()
+
+## Startup cache (.csv.cache)
+# A bulk loaded dex is saved next to its csv as two pickles: the key (CACHE_VERSION, size, mtime, blake2b of the csv)
+# and the parsed and linked dex, so a later start with the same csv skips parsing, linking and the evolution tour. The
+# entries are written as bare objects first and their fields after, so links between them never recurse, and the only
+# global a cache may name is _blank_pokemon. A csv with the cache's size and mtime is taken as unchanged without being
+# read, one of another size as changed. Only when the mtime alone differs does the hash decide, so a touched but
+# unchanged csv still uses its cache.
+CACHE_VERSION = 2
+CACHE_HASH_CHUNK = 1 << 20
+
+def _blank_pokemon():
+	return Pokemon.__new__(Pokemon)
+
+def _cache_key(filename, cached=None):
+	# (version, size, mtime, digest) of the csv as it is now. Given cached, the key a cache was saved with, the csv is
+	# only hashed if the two differ in mtime alone: cached itself is returned for the same mtime, and a key with no
+	# digest for another version or size.
+	with open(filename, 'rb') as f:
+		stat = os.fstat(f.fileno())
+		key = (CACHE_VERSION, stat.st_size, stat.st_mtime_ns)
+		if cached != None and key == cached[:3]:
+			return cached
+		if cached != None and key[:2] != cached[:2]:
+			return key + (None,)
+		digest = hashlib.blake2b()
+		for chunk in iter(lambda: f.read(CACHE_HASH_CHUNK), b''):
+			digest.update(chunk)
+	return key + (digest.hexdigest(),)
+
+class _CachePickler(pickle.Pickler):
+	def reducer_override(self, obj):
+		if type(obj) is Pokemon:
+			return (_blank_pokemon, ())
+		return NotImplemented
+
+class _CacheUnpickler(pickle.Unpickler):
+	def find_class(self, module, name):
+		# the cache is only ever read back as data
+		if name == '_blank_pokemon':
+			return _blank_pokemon
+		raise pickle.UnpicklingError('{}.{} is not allowed in a cache'.format(module, name))
+
+## Hot reload
+# PokeDex.reload() tells which rows of a rewritten csv changed by a hash of each row (without its line break), kept for
+# the rows as they were last read or written. Python's hash() of bytes only holds within one process, which is all these
+# are kept for.
+def _hash_rows(data):
+	# (max_num, rows, byte offsets of the rows plus the end of the last one, num and hash of each row) of csv bytes
+	lines = data.splitlines(keepends=True)
+	offs = array('Q', accumulate(map(len, lines), initial=0))
+	rows = lines[1:]
+	nums = array('Q', [int(row[:row.index(b',')]) for row in rows])
+	hashes = array('q', [hash(row.rstrip(b'\r\n')) for row in rows])
+	return int(lines[0]), rows, offs[1:], nums, hashes
+
+def _entry_hash(pokemon, lineterminator):
+	# the hash of the row write() would give the entry now
+	text = io.StringIO()
+	evo_from = pokemon.get_evo_from()
+	evo_from = evo_from.get_num() if isinstance(evo_from, Pokemon) else None
+	csv.writer(text, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL, lineterminator=lineterminator).writerow(csv_row(pokemon.get_num(), pokemon.get_name(), pokemon.get_type1(), pokemon.get_type2(), evo_from, [mon.get_num() for mon in pokemon.get_evo_to()]))
+	return hash(text.getvalue().encode('utf-8').rstrip(b'\r\n'))
+
+def _same_entry(pokemon, mon, from_to):
+	# True if pokemon already is what the parsed row (mon, from_to) says
+	evo_from = pokemon.get_evo_from()
+	return (pokemon.get_name() == mon.get_name() and pokemon.get_type1() == mon.get_type1() and pokemon.get_type2() == mon.get_type2()
+		and (None if evo_from == None else evo_from.get_num()) == from_to[1] and [evo.get_num() for evo in pokemon.get_evo_to()] == from_to[2])
+
+# seconds between checks of a watched csv
+WATCH_INTERVAL = 1.0
+
+# A fuzzy search for text that can't be split (see PokeDex.search) is at most 2 characters with up to 2 edits
+SHORT_NAME_LEN = 4
+# versions kept for PokeDex.undo()
+UNDO_LIMIT = 1000
+# PokeDex methods run under the shared and the exclusive lock in concurrent mode
+CONCURRENT_READS = ('find', 'search', 'type_mask', 'effectiveness', 'evo_root', 'evo_depth', 'is_ancestor', 'evo_descendants', 'evo_family')
+CONCURRENT_WRITES = ('add', 'delete', 'update_num', 'update_name', 'update_types', 'set_max_num', 'undo', 'redo', 'forget_history', 'snapshot', 'check', 'rebuild_evo_index')
+
 class PokeDex:
-	def __init__(self, filename, max_num, new):
+	def __init__(self, filename, max_num, new, binary=False, bulk=True, workers=1, concurrent=False, cache=True):
 		self._by_num = {}
 		self._by_name = {}
 		self._max_num = max_num
 		self._size = 0
-		if not new:
-			self.populate_from_file(filename)
+		# TypeEnum -> bitset of the nums that have that type in either slot
+		self._by_type = {t: bytearray() for t in TypeEnum}
+		# the same for each slot on its own, for queries
+		self._by_type1 = {t: bytearray() for t in TypeEnum}
+		self._by_type2 = {t: bytearray() for t in TypeEnum}
+		# Pokemon -> (root, depth, tin, tout) from an Euler tour of its evolution tree, and root -> the tree's entries in
+		# tour (preorder) order, so the entries under X are _evo_family[root][tin:tout]
+		self._evo_info = {}
+		self._evo_family = {}
+		# bitsets of the nums at each stage, with an evolution and with a prior evolution, made from the evolution index
+		# by the first query after a change, see _evo_query_masks()
+		self._query_evo_masks = None
+		# lowercase names sorted forwards and reversed (for prefix and suffix ranges), and every character in them. These
+		# are rebuilt in one sort after bulk loads, and kept up to date one insort at a time otherwise.
+		self._names_sorted = []
+		self._names_reversed = []
+		self._name_chars = set()
+		# the names of up to SHORT_NAME_LEN characters, for fuzzy searches too short to split, see search()
+		self._short_names = set()
+		self._names_stale = False
+		# the present nums in order, rebuilt after bulk loads like the name index
+		self._nums_sorted = []
+		self._nums_stale = False
+		# memory-mapped .pdx snapshot that entries are lazily decoded from
+		self._pdx = None
+		# the csv last read or written as (filename, size, mtime), and the byte offset of each of its rows (plus the end
+		# of the last one). Unchanged entries copy their row from it on write.
+		self._source = None
+		self._source_offs = None
+		# the source csv's line break, which the rows write() formats end with too so they match the rows it copies
+		self._eol = '\r\n'
+		# (max_num, nums, hashes) of the source csv's rows while it is watched for reload(), see _track_source()
+		self._source_rows = None
+		# while in batch(), the entries changed so far with their state from before the batch, see _touch()
+		self._batch = None
+		# committed batches that undo() and redo() step through, and the open snapshots
+		self._undo = []
+		self._redo = []
+		self._restoring = False
+		self._snapshots = weakref.WeakSet()
+		# ReadWriteLock in concurrent mode, see _make_concurrent()
+		self._lock = None
+		if new:
+			pass
+		elif binary:
+			self.load_binary(filename)
+		elif is_jsonl(filename):
+			# named with its extension, an NDJSON dex has no cache or row offsets to keep
+			self.populate_from_jsonl(filename)
+		else:
+			self.populate_from_file(filename, bulk=bulk, workers=workers, cache=cache)
+		if concurrent:
+			self._make_concurrent()
+
+	# For sharing one dex between threads. The queries in CONCURRENT_READS run under the shared lock and the mutations
+	# in CONCURRENT_WRITES under the exclusive one, by wrapping them on the instance, so a dex opened without
+	# concurrent=True pays nothing. Queries that yield entries return a list made under the lock instead. A batch holds
+	# the exclusive lock throughout, so a check-then-change sequence can be made atomic by running it in one, and the
+	# evolution setters of the entries take it themselves. Writes to disk hold the shared lock, one write at a time.
+	def _make_concurrent(self):
+		self.materialize()
+		# readers only hold the shared lock, so the name index is never left for them to rebuild
+		if self._names_stale:
+			self._rebuild_name_index()
+		lock = self._lock = ReadWriteLock()
+		for name in CONCURRENT_READS:
+			setattr(self, name, _locked(getattr(self, name), lock.acquire_shared, lock.release_shared))
+		for name in ('iter_range', 'by_types', 'query', 'in_mask'):
+			setattr(self, name, _locked(getattr(self, name), lock.acquire_shared, lock.release_shared, listed=True))
+		for name in CONCURRENT_WRITES:
+			setattr(self, name, _locked(getattr(self, name), lock.acquire_exclusive, lock.release_exclusive))
+		writing = threading.Lock()
+		for name in ('write', 'write_binary'):
+			setattr(self, name, _locked(_locked(getattr(self, name), writing.acquire, writing.release), lock.acquire_shared, lock.release_shared))
 
 	def __len__(self):
 		return self._size
 
-	def get_max_num(self):
-		return self._max_num
+	def get_max_num(self):
+		return self._max_num
+
+	def set_max_num(self, new_max):
+		if new_max < self._size or new_max <= 0:
+			raise PokeDexBadMax
+
+		self._max_num = new_max
+
+	# Inside 'with dex.batch():' mutations are made to the entries and to _by_num/_by_name as usual, but the type, num
+	# and name indexes, the evolution index and the ordering of evo_to lists are only brought up to date once, on
+	# commit. Every entry is saved by _touch() before its first change, so if anything raises the saved entries are put
+	# back and the dex is left exactly as it was. Nested batches are part of the outermost one.
+	# Each committed batch is also kept as a version, the saved states and the states it left behind, so undo() and
+	# redo() can put its entries either way in O(changes). A change made outside a batch can't be undone, and clears
+	# the versions.
+	@contextlib.contextmanager
+	def batch(self, label=''):
+		if self._lock != None and not self._lock.held():
+			with self._lock.exclusive(), self.batch(label):
+				yield self
+			return
+		if self._batch != None:
+			yield self
+			return
+		self.materialize()
+		self._batch = {}
+		saved_size = self._size
+		saved_max = self._max_num
+		# the saved states are many small containers
+		with _gc_paused():
+			try:
+				yield self
+			except BaseException:
+				self._rollback(saved_size, saved_max)
+				raise
+			else:
+				self._commit(label, saved_size, saved_max)
+			finally:
+				self._batch = None
+
+	def _state(self, mon):
+		return (mon._num, mon._name, mon._type1, mon._type2, mon._evo_from, list(mon._evo_to), mon._dex)
+
+	def _touch(self, *mons):
+		# save the entries as they were before the batch, and before any open snapshot was taken, the first time each is
+		# changed
+		if self._batch == None:
+			if len(self._undo) > 0 or len(self._redo) > 0:
+				self._undo = []
+				self._redo = []
+			if len(self._snapshots) == 0:
+				return
+		for mon in mons:
+			if not isinstance(mon, Pokemon):
+				continue
+			state = None
+			if self._batch != None and mon not in self._batch:
+				state = self._batch[mon] = self._state(mon)
+			for snapshot in self._snapshots:
+				if mon not in snapshot._saved:
+					state = self._state(mon) if state == None else state
+					snapshot._save(mon, state)
+
+	def _commit(self, label, saved_size, saved_max):
+		changed = self._batch
+		self._batch = None
+		# the indexes still describe every changed entry as it was, so move them all over in one go
+		for mon, state in changed.items():
+			if state[6] is self:
+				self._index_delete(state[0], state[1].lower(), state[2], state[3])
+		for mon in changed:
+			if mon._dex is self:
+				# restored evo_to lists are put back exactly as they were
+				if not self._restoring:
+					mon._evo_to = sorted({evo.get_num(): evo for evo in mon._evo_to}.values(), key=Pokemon.get_num)
+				self._index_add(mon)
+		# re-tour the families the changed entries were in and are in now. A batch of name and type edits leaves the
+		# evolution index, and the query masks made from it, as they are.
+		if any(self._evo_changed(mon, state) for mon, state in changed.items()):
+			members = []
+			for mon in changed:
+				members.append(mon)
+				info = self._evo_info.get(mon, None)
+				if info != None:
+					members.extend(self._evo_family.get(info[0], []))
+				if mon._dex is not self:
+					self._evo_info.pop(mon, None)
+					self._evo_family.pop(mon, None)
+			self._evo_reindex(*members)
+		if self._restoring or (len(changed) == 0 and (saved_size, saved_max) == (self._size, self._max_num)):
+			return
+		after = {mon: self._state(mon) for mon in changed}
+		self._undo.append((label, changed, after, saved_size, saved_max, self._size, self._max_num))
+		del self._undo[:-UNDO_LIMIT]
+		self._redo = []
+
+	def _evo_changed(self, mon, state):
+		# whether a batch changed what the evolution index holds about mon: its num, its links or whether it is here
+		if mon._num != state[0] or mon._evo_from is not state[4] or mon._dex is not state[6] or len(mon._evo_to) != len(state[5]):
+			return True
+		return any(evo is not before for evo, before in zip(mon._evo_to, state[5]))
+
+	def _rollback(self, saved_size, saved_max):
+		changed = self._batch
+		self._batch = None
+		self._put_back(changed)
+		self._size = saved_size
+		self._max_num = saved_max
+
+	def _put_back(self, states):
+		# unregister every entry, then set its fields and register it again under its num and name if it is present
+		for mon in states:
+			if mon._dex is self:
+				if self._by_num.get(mon._num, None) is mon:
+					del self._by_num[mon._num]
+				if self._by_name.get(mon._name.lower(), None) is mon:
+					del self._by_name[mon._name.lower()]
+		for mon, state in states.items():
+			mon._num, mon._name, mon._type1, mon._type2, mon._evo_from, evo_to, mon._dex = state
+			mon._evo_to = list(evo_to)
+			mon._row = None
+			if mon._dex is self:
+				self._by_num[mon._num] = mon
+				self._by_name[mon._name.lower()] = mon
+
+	def _restore(self, states, size, max_num):
+		# put the entries into the given states, as a batch that isn't kept as a version itself
+		self._restoring = True
+		try:
+			with self.batch():
+				self._touch(*states)
+				self._put_back(states)
+				self._size = size
+				self._max_num = max_num
+		finally:
+			self._restoring = False
+
+	def undo(self):
+		# undo the last version, returning its label, or None if there is nothing to undo
+		if len(self._undo) == 0:
+			return None
+		version = self._undo.pop()
+		label, before, after, size_before, max_before, size_after, max_after = version
+		self._restore(before, size_before, max_before)
+		self._redo.append(version)
+		return label
+
+	def redo(self):
+		# redo the last undone version, returning its label, or None if there is nothing to redo
+		if len(self._redo) == 0:
+			return None
+		version = self._redo.pop()
+		label, before, after, size_before, max_before, size_after, max_after = version
+		self._restore(after, size_after, max_after)
+		self._undo.append(version)
+		return label
+
+	def forget_history(self):
+		# drop every version, for when the changes they would take back are no longer recorded anywhere else
+		self._undo = []
+		self._redo = []
+
+	def snapshot(self):
+		self.materialize()
+		snapshot = PokeDexSnapshot(self)
+		self._snapshots.add(snapshot)
+		return snapshot
+
+	def populate_from_file(self, filename, bulk=True, progress=True, workers=1, cache=True):
+		filename += '.csv'
+		print('Opening {}'.format(filename))
+		if bulk:
+			if cache and self._load_cache(filename):
+				print('{} loaded from {}.cache.'.format(filename, filename))
+				return
+			self._bulk_load(filename, progress, workers)
+			if cache:
+				self._write_cache(filename)
+			print('{} loaded.'.format(filename))
+			return
+
+		progress = 1
+
+		first = True
+		with open(filename, 'r') as csvfile:
+			pokedex_reader = csv.reader(csvfile, delimiter=',', quotechar='|')
+			from_to_list = []
+			for row in pokedex_reader:
+				# first row contains the max_num
+				if first:
+					self._max_num = int(row[0])
+					first = False
+					continue
+				# add all mons to the dex
+				mon, from_to = self._csv_row_to_pokemon(row)
+				from_to_list.append(from_to)
+				self.add(mon)
+				print('Loading -- {}/{}'.format(progress, self._max_num), end='\r')
+				progress += 1
+			# link all evolutions
+			self._link_evolutions(from_to_list)
+		print('\n{} loaded.'.format(filename))
+
+	# Bulk loading parses every row first, validates the whole batch at once and links all evolutions in a single
+	# sorted pass, so the cost is linear in the number of rows. Measured at 110k-145k rows/s on one core (1M-row
+	# synthetic dex, CPython 3.11), about 4x the per-row add()/set_evo_to() path, which also degrades with fan-out.
+	def _bulk_load(self, filename, progress, workers=1):
+		start = time.perf_counter()
+		workers = _parse_workers(filename, workers)
+		if workers > 1:
+			self._parallel_load(filename, workers, start)
+			return
+		with open(filename, 'rb') as csvfile:
+			data = csvfile.read()
+			stat = os.fstat(csvfile.fileno())
+		# byte offset of every line, so each row's span in the file is known
+		lines = data.splitlines(keepends=True)
+		line_offs = array('Q', accumulate(map(len, lines), initial=0))
+		pokedex_reader = csv.reader(map(bytes.decode, lines), delimiter=',', quotechar='|')
+		# first row contains the max_num
+		max_num = int(next(pokedex_reader)[0])
+		row_offs = array('Q', [line_offs[pokedex_reader.line_num]])
+		mons = []
+		from_to_list = []
+		last_report = time.monotonic()
+		reported = False
+		for row in pokedex_reader:
+			mon, from_to = self._csv_row_to_pokemon(row)
+			mon._row = len(mons)
+			row_offs.append(line_offs[pokedex_reader.line_num])
+			mons.append(mon)
+			from_to_list.append(from_to)
+			# report progress at most a few times per second
+			if progress and len(mons) % 4096 == 0 and time.monotonic() - last_report > 0.25:
+				last_report = time.monotonic()
+				reported = True
+				print('Loading -- {}/{}'.format(len(mons), max_num), end='\r')
+		if reported:
+			print()
+		self._bulk_finish(filename, stat, max_num, mons, from_to_list, row_offs, data.endswith(b'\n'), start)
+
+	def _parallel_load(self, filename, workers, start):
+		stat = os.stat(filename)
+		max_num, parts = _parse_parallel(filename, workers)
+		mons = []
+		from_to_list = []
+		row_offs = array('Q')
+		for nums, type1, type2, evo_from, evo_off, evo_to, name_off, pool, offs in parts:
+			names = pool.decode('utf-8') if pool.isascii() else None
+			for i in range(len(nums)):
+				name = names[name_off[i]:name_off[i+1]] if names != None else pool[name_off[i]:name_off[i+1]].decode('utf-8')
+				mon = Pokemon(nums[i], name, type1=TYPE_CODES[type1[i]], type2=TYPE_CODES[type2[i]])
+				mon._row = len(mons)
+				mons.append(mon)
+				from_to_list.append((nums[i], evo_from[i] if evo_from[i] != 0 else None, evo_to[evo_off[i]:evo_off[i+1]].tolist()))
+			row_offs.extend(offs)
+		row_offs.append(stat.st_size)
+		with open(filename, 'rb') as f:
+			f.seek(max(stat.st_size - 1, 0))
+			clean_end = f.read(1) == b'\n'
+		self._bulk_finish(filename, stat, max_num, mons, from_to_list, row_offs, clean_end, start)
+
+	def _bulk_finish(self, filename, stat, max_num, mons, from_to_list, row_offs, clean_end, start):
+		self._max_num = max_num
+		self._bulk_add(mons)
+		linking = time.perf_counter()
+		STATS.record('populate_from_file.parse', linking - start)
+		self._bulk_link(from_to_list)
+		STATS.record('populate_from_file.link', time.perf_counter() - linking)
+		self._source = (filename, stat.st_size, stat.st_mtime_ns)
+		self._source_offs = row_offs
+		self._eol = file_line_terminator(filename)
+		# a last row without a line break can't be copied as is
+		if len(mons) > 0 and not clean_end:
+			mons[-1]._row = None
+
+	def populate_from_jsonl(self, filename):
+		# load an NDJSON dex (see jsonl_records) into this one, linked and validated like a bulk loaded csv
+		print('Opening {}'.format(filename))
+		mons = []
+		from_to_list = []
+		records = jsonl_records(filename)
+		self._max_num = next(records)['max_num']
+		for rec in records:
+			mon = Pokemon(rec['num'], rec['name'], type1=TypeEnum[rec['type1']], type2=TypeEnum[rec['type2']])
+			mons.append(mon)
+			from_to_list.append((rec['num'], rec['evo_from'], rec['evo_to']))
+		self._bulk_add(mons)
+		self._bulk_link(from_to_list)
+		print('{} loaded.'.format(filename))
+
+	def write_jsonl(self, outname):
+		# outname is the full name, .gz or .xz compresses it. Entries stream out of a snapshot, so the dex can keep
+		# changing meanwhile.
+		with self.snapshot() as snapshot:
+			count = write_jsonl(outname, dex_records(snapshot))
+		print('Wrote {} entries to {}'.format(count, outname))
+
+	def _load_cache(self, filename):
+		# fill the dex from filename's cache if it was made from the same csv, else leave it untouched
+		try:
+			with open(filename + '.cache', 'rb') as f, _gc_paused():
+				unpickler = _CacheUnpickler(f)
+				cached = unpickler.load()
+				with STATS.timed('populate_from_file.hash'):
+					key = _cache_key(filename, cached)
+				if key[:2] != cached[:2] or key[3] != cached[3]:
+					return False
+				start = time.perf_counter()
+				max_num, mons, states, by_type, by_type1, by_type2, evo_info, evo_family, row_offs = unpickler.load()
+		except Exception:
+			# a missing cache, or one that can't be read back, is rebuilt like a stale one
+			return False
+
+		with _gc_paused():
+			for mon, (num, name, type1, type2, evo_from, evo_to, row) in zip(mons, states):
+				mon._num = num
+				mon._name = name
+				mon._type1 = TYPE_CODES[type1]
+				mon._type2 = TYPE_CODES[type2]
+				mon._evo_from = evo_from
+				mon._evo_to = evo_to
+				mon._dex = self
+				mon._row = row
+			self._by_num = {mon._num: mon for mon in mons}
+			self._by_name = {mon._name.lower(): mon for mon in mons}
+		self._max_num = max_num
+		self._size = len(mons)
+		self._by_type = {TYPE_CODES[t]: bits for t, bits in by_type.items()}
+		self._by_type1 = {TYPE_CODES[t]: bits for t, bits in by_type1.items()}
+		self._by_type2 = {TYPE_CODES[t]: bits for t, bits in by_type2.items()}
+		self._evo_info = evo_info
+		self._evo_family = evo_family
+		self._names_stale = True
+		self._nums_stale = True
+		self._source = (filename, key[1], key[2])
+		self._source_offs = array('Q', row_offs)
+		self._eol = file_line_terminator(filename)
+		STATS.record('populate_from_file.cache_load', time.perf_counter() - start)
+		return True
+
+	def _write_cache(self, filename):
+		# save the freshly loaded dex for the next start, skipped if the directory can't be written to
+		with STATS.timed('populate_from_file.hash'):
+			key = _cache_key(filename)
+		# unless the csv changed while it was being read
+		if self._source[1:] != key[1:3]:
+			return
+		start = time.perf_counter()
+		mons = list(self._by_num.values())
+		states = [(mon._num, mon._name, mon._type1.value, mon._type2.value, mon._evo_from, mon._evo_to, mon._row) for mon in mons]
+		by_type = [{t.value: bits for t, bits in bitsets.items()} for bitsets in (self._by_type, self._by_type1, self._by_type2)]
+		try:
+			with atomic_open(filename + '.cache') as f, _gc_paused():
+				pickler = _CachePickler(f, protocol=pickle.HIGHEST_PROTOCOL)
+				pickler.dump(key)
+				pickler.dump((self._max_num, mons, states, *by_type, self._evo_info, self._evo_family, self._source_offs.tobytes()))
+		except OSError as e:
+			print('Could not write {}.cache: {}'.format(filename, e.strerror))
+			return
+		STATS.record('populate_from_file.cache_write', time.perf_counter() - start)
+
+	def _bulk_add(self, mons):
+		# validate the whole batch against itself and the current entries, then insert it in one go
+		nums = [mon.get_num() for mon in mons]
+		names = [mon.get_name().lower() for mon in mons]
+		if self._size + len(mons) > self._max_num:
+			raise PokeDexFull
+		if len(set(nums)) != len(nums) or not self._by_num.keys().isdisjoint(nums):
+			raise PokeDexHasEntryNum
+		if len(set(names)) != len(names) or not self._by_name.keys().isdisjoint(names):
+			raise PokeDexHasEntryName
+		if len(nums) > 0 and (min(nums) <= 0 or max(nums) > self._max_num):
+			raise PokeDexOutOfRange
+
+		self._by_num.update(zip(nums, mons))
+		self._by_name.update(zip(names, mons))
+		self._size += len(mons)
+		self._names_stale = True
+		self._nums_stale = True
+		for mon in mons:
+			self._index_add(mon)
+			mon._dex = self
+
+	def _bulk_link(self, from_to_list):
+		# collect every (from, to) edge named by either end, then wire each parent's evo_to in num order
+		edges = []
+		for num, evo_from, evo_to in from_to_list:
+			if evo_from != None:
+				edges.append((evo_from, num))
+			for evo in evo_to:
+				edges.append((num, evo))
+		edges.sort()
+
+		by_num = self._by_num
+		last = None
+		for edge in edges:
+			if edge == last:
+				continue
+			last = edge
+			parent = by_num.get(edge[0], None)
+			child = by_num.get(edge[1], None)
+			if parent == None or child == None:
+				continue
+			parent._evo_to.append(child)
+			child._evo_from = parent
+		# rows whose links came out differently from what they say (a one-sided or dangling link) get rewritten
+		for num, evo_from, evo_to in from_to_list:
+			pokemon = by_num[num]
+			prior = pokemon._evo_from
+			if (evo_from != None if prior == None else prior._num != evo_from) or evo_to != [mon._num for mon in pokemon._evo_to]:
+				pokemon._row = None
+		self.rebuild_evo_index()
+
+	def _csv_row_to_pokemon(self, row):
+		# print(row)
+		num = int(row[0])
+		name = row[1]
+		type1 = CSV_TYPES[row[2]]
+		type2 = CSV_TYPES[row[3]]
+		evo_from = None if len(row[4]) == 0 else int(row[4])
+		evo_to = [int(evo) for evo in row[5:]]
+
+		return Pokemon(num, name, type1=type1, type2=type2), (num, evo_from, evo_to)
+
+	def load_binary(self, filename):
+		filename += '.pdx'
+		print('Opening {}'.format(filename))
+		self._pdx = _PdxReader(filename)
+		self._max_num = self._pdx.max_num
+		self._size = self._pdx.count
+		self._names_stale = True
+		self._nums_stale = True
+		print('{} mapped.'.format(filename))
+
+	def _decode(self, i):
+		# build the Pokemon in slot i of the .pdx, along with the rest of its evolution family
+		pdx = self._pdx
+		num = pdx.nums[i]
+		if num in self._by_num:
+			return self._by_num[num]
+
+		# create every undecoded member of the family first, then wire up their links
+		created = []
+		pending = [i]
+		while len(pending) > 0:
+			j = pending.pop()
+			if pdx.nums[j] in self._by_num:
+				continue
+			pokemon = Pokemon(pdx.nums[j], pdx.name(j), type1=TypeEnum(pdx.type1[j]), type2=TypeEnum(pdx.type2[j]))
+			self._by_num[pokemon.get_num()] = pokemon
+			self._by_name[pokemon.get_name().lower()] = pokemon
+			self._index_add(pokemon)
+			pokemon._dex = self
+			created.append(j)
+			if pdx.evo_from[j] != 0:
+				pending.append(pdx.index_of_num(pdx.evo_from[j]))
+			pending.extend(pdx.index_of_num(evo) for evo in pdx.evos(j))
+
+		for j in created:
+			pokemon = self._by_num[pdx.nums[j]]
+			if pdx.evo_from[j] != 0:
+				pokemon._evo_from = self._by_num[pdx.evo_from[j]]
+			pokemon._evo_to = [self._by_num[evo] for evo in pdx.evos(j)]
+		self._evo_reindex(self._by_num[num])
+		return self._by_num[num]
+
+	def materialize(self):
+		# decode every remaining entry and drop the mapping, needed before any bulk operation or mutation. Lazily mapped
+		# dexes decode on lookups, so call this up front before sharing one between threads.
+		if self._pdx == None:
+			return
+		for i in range(self._pdx.count):
+			self._decode(i)
+		self._pdx.close()
+		self._pdx = None
+
+	def write_binary(self, outname):
+		outname += '.pdx'
+		self.materialize()
+		nums = sorted(self._by_num)
+		count = len(nums)
+
+		type1 = array('b')
+		type2 = array('b')
+		evo_from = array('i')
+		evo_off = array('I', [0])
+		evo_to = array('i')
+		name_off = array('I', [0])
+		pool = bytearray()
+		for num in nums:
+			pokemon = self._by_num[num]
+			type1.append(pokemon.get_type1())
+			type2.append(pokemon.get_type2())
+			prior = pokemon.get_evo_from()
+			evo_from.append(prior.get_num() if isinstance(prior, Pokemon) else 0)
+			evo_to.extend(mon.get_num() for mon in pokemon.get_evo_to())
+			evo_off.append(len(evo_to))
+			pool += pokemon.get_name().encode('utf-8')
+			name_off.append(len(pool))
+		name_order = array('I', sorted(range(count), key=lambda i: self._by_num[nums[i]].get_name().lower()))
+
+		_write_pdx(outname, self._max_num, array('i', nums), type1, type2, evo_from, evo_off, evo_to, name_off, name_order, pool)
+
+	def _link_evolutions(self, from_to_list):
+		for from_to in from_to_list:
+			num, evo_from, evo_to = from_to
+			pokemon = self.find(num)
+			from_mon = self.find(evo_from) if evo_from != None else None
+			to_mons = [self.find(evo) for evo in evo_to]
+			pokemon.set_evo_from(from_mon)
+			for mon in to_mons:
+				pokemon.set_evo_to(mon)
+
+	def find(self, query):
+		return self._find_by_num(query) if isinstance(query, int) else self._find_by_name(query)
+
+	def _find_by_num(self, query):
+		pokemon = self._by_num.get(query, None)
+		if pokemon == None and self._pdx != None:
+			i = self._pdx.index_of_num(query)
+			pokemon = None if i == None else self._decode(i)
+		return pokemon
+
+	def _find_by_name(self, query):
+		# name = query[0].upper() + query[1:].lower()
+		name = query.lower()
+		pokemon = self._by_name.get(name, None)
+		if pokemon == None and self._pdx != None:
+			i = self._pdx.index_of_name(name)
+			pokemon = None if i == None else self._decode(i)
+		return pokemon
+
+	def add(self, pokemon):
+		self.materialize()
+		if self._size >= self._max_num:
+			raise PokeDexFull
+		elif pokemon.get_num() in self._by_num:
+			raise PokeDexHasEntryNum
+		elif pokemon.get_name().lower() in self._by_name:
+			raise PokeDexHasEntryName
+		elif pokemon.get_num() <= 0 or pokemon.get_num() > self._max_num:
+			raise PokeDexOutOfRange
+
+		self._touch(pokemon)
+		self._by_num[pokemon.get_num()] = pokemon
+		self._by_name[pokemon.get_name().lower()] = pokemon
+		self._size += 1
+		self._index_add(pokemon)
+		pokemon._dex = self
+		self._evo_reindex(pokemon)
+		self._mark_dirty(pokemon)
+
+	def delete(self, pokemon):
+		self.materialize()
+		if self._size == 0:
+			raise PokeDexEmpty
+
+		if pokemon == None:
+			print('The specified pokemon does not exist in the pokedex.')
+			return
+
+		if pokemon.get_num() not in self._by_num and pokemon.get_name().lower() not in self._by_name:
+			print('{} is only in one of the searchable dicts (num/name) for some reason. Try reloading.'.format(pokemon))
+			return
+
+		self._touch(pokemon)
+		# delete self as the evo_from for all subsequent evolutions, leaving alone any that have moved to another entry
+		for evo in list(pokemon.get_evo_to()):
+			if evo.get_evo_from() is pokemon:
+				evo.del_evo_from()
+			else:
+				pokemon.del_evo_to(evo, inner=True)
+
+		# delete self as an evo_to entry for the prior evolution
+		pokemon.del_evo_from()
+
+		self._index_remove(pokemon)
+		del self._by_num[pokemon.get_num()]
+		del self._by_name[pokemon.get_name().lower()]
+		self._size -= 1
+		# fully unlinked by now, so it is the only member of its family
+		pokemon._dex = None
+		if self._batch == None:
+			self._evo_info.pop(pokemon, None)
+			self._evo_family.pop(pokemon, None)
+			self._evo_masks_move(pokemon.get_num(), None)
+
+	def update_num(self, pokemon, num):
+		self.materialize()
+		if num != pokemon.get_num() and num in self._by_num:
+			raise PokeDexHasEntryNum
+		elif num <= 0 or num > self._max_num:
+			raise PokeDexOutOfRange
+
+		parent = pokemon.get_evo_from()
+		self._touch(pokemon, parent)
+		self._index_remove(pokemon)
+		if self._batch == None:
+			self._evo_masks_move(pokemon.get_num(), num)
+		del self._by_num[pokemon.get_num()]
+		self._by_num[num] = pokemon
+		pokemon.set_num(num)
+		self._index_add(pokemon)
+		# keep the evolutions of its prior evolution in num order, a batch sorts them on commit
+		if isinstance(parent, Pokemon) and self._batch == None:
+			evo_to = sorted(parent._evo_to, key=Pokemon.get_num)
+			if evo_to != parent._evo_to:
+				parent._evo_to = evo_to
+				self._evo_reindex(parent)
+		# rows of its evolutions refer to it by num
+		self._mark_dirty(pokemon, pokemon.get_evo_from(), *pokemon.get_evo_to())
+
+	def update_name(self, pokemon, name):
+		self.materialize()
+		if self._by_name.get(name.lower(), pokemon) is not pokemon:
+			raise PokeDexHasEntryName
+
+		self._touch(pokemon)
+		self._index_remove(pokemon)
+		del self._by_name[pokemon.get_name().lower()]
+		self._by_name[name.lower()] = pokemon
+		pokemon.set_name(name)
+		self._index_add(pokemon)
+		self._mark_dirty(pokemon)
+
+	def update_types(self, pokemon, type1, type2):
+		self.materialize()
+		self._touch(pokemon)
+		self._index_remove(pokemon)
+		pokemon.set_type1(type1)
+		pokemon.set_type2(type2)
+		self._index_add(pokemon)
+		self._mark_dirty(pokemon)
+
+	# Secondary indexes are kept in step with _by_num through these two hooks. Every change to an entry's indexed
+	# fields is made as remove -> change -> add. Inside a batch both wait for the commit.
+	def _index_add(self, pokemon):
+		if self._batch == None:
+			self._index_insert(pokemon.get_num(), pokemon.get_name().lower(), pokemon.get_type1(), pokemon.get_type2())
+
+	def _index_remove(self, pokemon):
+		if self._batch == None:
+			self._index_delete(pokemon.get_num(), pokemon.get_name().lower(), pokemon.get_type1(), pokemon.get_type2())
+
+	def _index_insert(self, num, name, type1, type2):
+		_bit_set(self._by_type[type1], num)
+		_bit_set(self._by_type[type2], num)
+		_bit_set(self._by_type1[type1], num)
+		_bit_set(self._by_type2[type2], num)
+		if not self._nums_stale:
+			insort(self._nums_sorted, num)
+		if not self._names_stale:
+			insort(self._names_sorted, name)
+			insort(self._names_reversed, name[::-1])
+			self._name_chars.update(name)
+			if len(name) <= SHORT_NAME_LEN:
+				self._short_names.add(name)
+
+	def _index_delete(self, num, name, type1, type2):
+		_bit_clear(self._by_type[type1], num)
+		_bit_clear(self._by_type[type2], num)
+		_bit_clear(self._by_type1[type1], num)
+		_bit_clear(self._by_type2[type2], num)
+		if not self._nums_stale:
+			del self._nums_sorted[bisect_left(self._nums_sorted, num)]
+		if not self._names_stale:
+			del self._names_sorted[bisect_left(self._names_sorted, name)]
+			del self._names_reversed[bisect_left(self._names_reversed, name[::-1])]
+			self._short_names.discard(name)
+
+	def _mark_dirty(self, *mons):
+		for mon in mons:
+			if isinstance(mon, Pokemon):
+				mon._row = None
+
+	def _rebuild_name_index(self):
+		# built aside and put in place at the end, so a reader never sees a half-filled index
+		self.materialize()
+		names_sorted = sorted(self._by_name)
+		name_chars = set()
+		for name in names_sorted:
+			name_chars.update(name)
+		self._names_reversed = sorted(name[::-1] for name in self._by_name)
+		self._name_chars = name_chars
+		self._short_names = {name for name in names_sorted if len(name) <= SHORT_NAME_LEN}
+		self._names_sorted = names_sorted
+		self._names_stale = False
+
+	def search(self, text, fuzzy=False, max_dist=None, limit=20):
+		# entries whose name starts with text, in name order, or with fuzzy=True entries whose name is within max_dist
+		# edits of text, closest first. max_dist defaults to 1, or 0 below 3 characters. 2 is allowed, but on a dex of a
+		# million names it takes tens of milliseconds, too slow for the suggestions a missed find prints.
+		if self._names_stale:
+			self._rebuild_name_index()
+		text = text.lower()
+		if not fuzzy:
+			names = []
+			for name in _prefixed(self._names_sorted, text):
+				if len(names) == limit:
+					break
+				names.append(name)
+			return [self._by_name[name] for name in names]
+
+		if max_dist == None:
+			max_dist = 0 if len(text) < 3 else 1
+		max_dist = min(max_dist, 2)
+		if max_dist == 0:
+			pokemon = self._by_name.get(text, None)
+			return [] if pokemon == None or limit == 0 else [pokemon]
+		if max_dist == 1:
+			# the strings one edit from text over the name alphabet are few enough to look each up in _by_name
+			candidates = [name for name in _edit_variants(text, self._name_chars) if name in self._by_name]
+		else:
+			# Split text anywhere into head + tail. A name within 2 edits splits the same way into parts whose edits add
+			# up to at most 2, so either its head part is within one edit of head, or its tail part is exactly tail. The
+			# candidates are therefore the prefix ranges of head's variants plus the suffix range of tail, checked exactly
+			# afterwards. The split point is picked to keep those ranges small; an edited head can be one character
+			# shorter, so its range is estimated from head minus its last character.
+			best = None
+			for k in range(2, len(text)):
+				cost = _prefix_count(self._names_sorted, text[:k-1]) + _prefix_count(self._names_reversed, text[k:][::-1])
+				if best == None or cost < best[0]:
+					best = (cost, k)
+			if best == None:
+				# too short to split, so every match is a short name
+				candidates = [name for name in self._short_names if len(name) <= len(text) + max_dist]
+			else:
+				head = text[:best[1]]
+				tail = text[best[1]:][::-1]
+				candidates = set()
+				for prefix in _edit_variants(head, self._name_chars):
+					candidates.update(_prefixed(self._names_sorted, prefix))
+				candidates.update(name[::-1] for name in _prefixed(self._names_reversed, tail))
+
+		matches = []
+		for name in candidates:
+			dist = _edit_distance(text, name, max_dist)
+			if dist <= max_dist:
+				matches.append((dist, name))
+		matches.sort()
+		return [self._by_name[name] for _, name in matches[:limit]]
+
+	def _evo_root_of(self, pokemon):
+		# walk up the evo_from links, stopping at the first repeat if they loop
+		seen = set()
+		while pokemon.get_evo_from() != None and pokemon not in seen:
+			seen.add(pokemon)
+			pokemon = pokemon.get_evo_from()
+		return pokemon
+
+	def _evo_tour(self, root):
+		# iterative Euler tour of the tree under root, recording entry/exit positions and depths
+		family = []
+		seen = set()
+		stack = [(root, 0, False)]
+		while len(stack) > 0:
+			pokemon, depth, leaving = stack.pop()
+			if leaving:
+				info = self._evo_info[pokemon]
+				self._evo_info[pokemon] = (info[0], info[1], info[2], len(family))
+				continue
+			if pokemon in seen or pokemon._dex is not self:
+				continue
+			seen.add(pokemon)
+			self._evo_info[pokemon] = (root, depth, len(family), len(family)+1)
+			family.append(pokemon)
+			stack.append((pokemon, depth, True))
+			for mon in reversed(pokemon.get_evo_to()):
+				stack.append((mon, depth+1, False))
+		self._evo_family[root] = family
+
+	def rebuild_evo_index(self):
+		self.materialize()
+		self._evo_info = {}
+		self._evo_family = {}
+		self._query_evo_masks = None
+		for mon in self._by_num.values():
+			if mon not in self._evo_info:
+				self._evo_tour(self._evo_root_of(mon))
+
+	def _evo_reindex(self, *mons):
+		# re-tour every family that any of these entries belonged to before the change or belongs to now. Inside a batch
+		# this waits for the commit, and so do the query masks, which describe the index rather than the entries.
+		if self._batch != None:
+			return
+		if self._evo_lone(mons):
+			return
+		self._query_evo_masks = None
+		if self._evo_splice(mons):
+			return
+		members = []
+		for mon in mons:
+			if mon == None or mon._dex is not self:
+				continue
+			members.append(mon)
+			info = self._evo_info.get(mon, None)
+			if info != None:
+				members.extend(self._evo_family.pop(info[0], []))
+		for mon in members:
+			self._evo_info.pop(mon, None)
+		for mon in members:
+			if mon not in self._evo_info and mon._dex is self:
+				self._evo_tour(self._evo_root_of(mon))
+
+	def _evo_lone(self, mons):
+		# a newly added entry without links is a family of its own, which is one more base form in the query masks
+		if len(mons) != 1 or mons[0] == None or mons[0]._dex is not self or mons[0] in self._evo_info:
+			return False
+		mon = mons[0]
+		if mon._evo_from != None or len(mon._evo_to) > 0:
+			return False
+		self._evo_info[mon] = (mon, 0, 0, 1)
+		self._evo_family[mon] = [mon]
+		if self._query_evo_masks != None:
+			stages, evolves, evolved = self._query_evo_masks
+			stages = dict(stages)
+			stages[0] = stages.get(0, 0) | (1 << mon._num)
+			self._query_evo_masks = (stages, evolves, evolved)
+		return True
+
+	# A single link or unlink moves one subtree as a whole, so instead of re-touring the family its interval of the tour is
+	# cut out of one family and spliced into the other. Only the moved entries, the entries after the splice point and
+	# the ancestors above it are renumbered, which for a fan-out built in num order is just the new subtree. Anything
+	# else (a re-parented entry, an entry linked under its own descendant) is left to _evo_reindex() to re-tour.
+	def _evo_splice(self, mons):
+		pair = [mon for mon in mons if mon != None]
+		if len(pair) != 2 or pair[0]._dex is not self or pair[1]._dex is not self:
+			return False
+		info = self._evo_info
+		for parent, child in (pair, pair[::-1]):
+			if parent not in info or child not in info:
+				continue
+			parent_info = info[parent]
+			child_info = info[child]
+			if child._evo_from is parent and child_info[0] is child and parent_info[0] is not child:
+				return self._evo_attach(parent, child)
+			if (child._evo_from == None and child_info[0] is parent_info[0] and child_info[1] == parent_info[1] + 1
+					and parent_info[2] < child_info[2] < parent_info[3] and child not in parent._evo_to):
+				self._evo_detach(parent, child)
+				return True
+		return False
+
+	def _evo_shift(self, family, start, delta, pokemon, pos):
+		# move the tour positions of family[start:] by delta, and stretch the intervals of pokemon and its ancestors,
+		# the entries above it whose interval holds pos
+		info = self._evo_info
+		for i in range(start, len(family)):
+			mon = family[i]
+			root, depth, tin, tout = info[mon]
+			info[mon] = (root, depth, tin + delta, tout + delta)
+		seen = set()
+		while pokemon != None and pokemon not in seen:
+			seen.add(pokemon)
+			root, depth, tin, tout = info.get(pokemon, (None, 0, 0, 0))
+			if root is not family[0] or not tin < pos <= tout:
+				break
+			info[pokemon] = (root, depth, tin, tout + delta)
+			pokemon = pokemon._evo_from
+
+	def _evo_attach(self, parent, child):
+		# child, the root of its own family, has just been linked under parent
+		info = self._evo_info
+		root, depth, tin, tout = info[parent]
+		siblings = parent._evo_to
+		i = siblings.index(child)
+		if i + 1 < len(siblings):
+			after = info.get(siblings[i+1], None)
+			if after == None or after[0] is not root or after[1] != depth + 1:
+				return False
+			pos = after[2]
+		else:
+			pos = tout
+		family = self._evo_family[root]
+		moved = self._evo_family.pop(child)
+		family[pos:pos] = moved
+		self._evo_shift(family, pos + len(moved), len(moved), parent, pos)
+		for mon in moved:
+			_, d, t_in, t_out = info[mon]
+			info[mon] = (root, d + depth + 1, t_in + pos, t_out + pos)
+		return True
+
+	def _evo_detach(self, parent, child):
+		# child has just been unlinked from parent, and becomes the root of its own family
+		info = self._evo_info
+		root, depth, tin, tout = info[child]
+		family = self._evo_family[root]
+		moved = family[tin:tout]
+		del family[tin:tout]
+		self._evo_shift(family, tin, tin - tout, parent, tin)
+		for mon in moved:
+			_, d, t_in, t_out = info[mon]
+			info[mon] = (child, d - depth, t_in - tin, t_out - tin)
+		self._evo_family[child] = moved
+
+	def evo_root(self, pokemon):
+		return self._evo_info[pokemon][0]
+
+	def evo_depth(self, pokemon):
+		# 0 for a basic entry, 1 for its first evolution, ...
+		return self._evo_info[pokemon][1]
+
+	def is_ancestor(self, ancestor, pokemon):
+		# True when pokemon is somewhere below ancestor in the same evolution tree
+		root, _, tin, tout = self._evo_info[ancestor]
+		other = self._evo_info[pokemon]
+		return other[0] is root and tin < other[2] < tout
+
+	def evo_descendants(self, pokemon):
+		root, _, tin, tout = self._evo_info[pokemon]
+		return self._evo_family[root][tin+1:tout]
+
+	def evo_family(self, pokemon):
+		# every entry in pokemon's evolution tree with its depth, in tour order
+		family = self._evo_family[self._evo_info[pokemon][0]]
+		return [(mon, self._evo_info[mon][1]) for mon in family]
+
+	def type_mask(self, pokemon_type):
+		self.materialize()
+		return _bits_to_int(self._by_type[pokemon_type])
+
+	def by_types(self, *types, match_all=True):
+		# entries having every one of the types (or any of them), in num order
+		masks = [self.type_mask(t) for t in types]
+		mask = masks[0] if len(masks) > 0 else 0
+		for other in masks[1:]:
+			mask = mask & other if match_all else mask | other
+		for num in _iter_bits(mask):
+			yield self._by_num[num]
+
+	def query(self, expr):
+		# entries matching a query (see compile_query), in num order. The matches are worked out up front, and a bad
+		# query raises PokeDexBadQuery right away.
+		node = compile_query(expr) if isinstance(expr, str) else expr
+		self.materialize()
+		present = 0
+		for bits in self._by_type1.values():
+			present |= _bits_to_int(bits)
+		return self.in_mask(self._query_mask(node, present))
+
+	def in_mask(self, mask):
+		# the entries whose nums are set in an int bitset, in num order
+		self.materialize()
+		by_num = self._by_num
+		return (by_num[num] for num in _iter_bits(mask))
+
+	# Scores every entry at once from the per-slot type bitsets. The entries with types (t1, t2) are the bitset
+	# type1[t1] & type2[t2] and all take the same multiplier, so scoring is one bitset and per pair of types present,
+	# and one or into that multiplier's group, however many entries there are.
+	def effectiveness(self, *attacking):
+		# [(multiplier, bitset of nums)] for attacks of the given types, least effective first. With several types each
+		# entry is scored by the most effective of them.
+		if len(attacking) == 0:
+			raise PokeDexBadType('No attacking type given.')
+		for t in attacking:
+			if t not in ELEMENTAL_TYPES:
+				raise PokeDexBadType('{} is not an attacking type.'.format(getattr(t, 'name', t)))
+		self.materialize()
+		slot1 = [(t, _bits_to_int(bits)) for t, bits in self._by_type1.items()]
+		slot2 = [(t, _bits_to_int(bits)) for t, bits in self._by_type2.items()]
+		groups = {}
+		for type1, mask1 in slot1:
+			if mask1 == 0:
+				continue
+			for type2, mask2 in slot2:
+				mask = mask1 & mask2
+				if mask == 0:
+					continue
+				multiplier = max(type_multiplier(t, type1, type2) for t in attacking)
+				groups[multiplier] = groups.get(multiplier, 0) | mask
+		return sorted(groups.items())
+
+	def _query_mask(self, node, present):
+		# the nums of the entries matching node, as an int bitset within present
+		kind = node[0]
+		if kind == 'and':
+			return self._query_mask(node[1], present) & self._query_mask(node[2], present)
+		elif kind == 'or':
+			return self._query_mask(node[1], present) | self._query_mask(node[2], present)
+		elif kind == 'not':
+			return present & ~self._query_mask(node[1], present)
+		elif kind == 'num':
+			_, op, n = node
+			top = present.bit_length()
+			ranges = {'=': (n, n), '!=': (n, n), '<': (0, n-1), '<=': (0, n), '>': (n+1, top), '>=': (n, top)}
+			mask = _range_mask(*ranges[op])
+			return present & (~mask if op == '!=' else mask)
+		elif kind == 'stage':
+			_, op, n = node
+			mask = 0
+			for depth, bits in self._evo_query_masks()[0].items():
+				if QUERY_OPS[op](depth, n):
+					mask |= bits
+			return mask
+		elif kind == 'type':
+			_, slot, op, pokemon_type = node
+			mask = _bits_to_int((self._by_type, self._by_type1, self._by_type2)[slot][pokemon_type])
+			return mask if op == '=' else present & ~mask
+		elif kind == 'name':
+			if self._names_stale:
+				self._rebuild_name_index()
+			bits = bytearray()
+			for name in _prefixed(self._names_sorted, node[1]):
+				_bit_set(bits, self._by_name[name].get_num())
+			return _bits_to_int(bits)
+		elif kind == 'evolves':
+			return self._evo_query_masks()[1]
+		elif kind == 'evolved':
+			return self._evo_query_masks()[2]
+
+	def _evo_masks_move(self, num, new_num):
+		# move an entry's bits in the kept query masks to new_num, or drop them for None, rather than rebuilding the masks
+		if self._query_evo_masks == None:
+			return
+		def moved(mask):
+			if (mask >> num) & 1 == 0:
+				return mask
+			mask &= ~(1 << num)
+			return mask if new_num == None else mask | (1 << new_num)
+		stages, evolves, evolved = self._query_evo_masks
+		self._query_evo_masks = ({depth: moved(mask) for depth, mask in stages.items()}, moved(evolves), moved(evolved))
+
+	def _evo_query_masks(self):
+		# ({stage: bitset}, has an evolution, has a prior evolution), from one pass over the evolution index that is
+		# kept until the next change
+		if self._query_evo_masks != None:
+			return self._query_evo_masks
+		stages = {}
+		evolves = bytearray()
+		evolved = bytearray()
+		for mon, info in self._evo_info.items():
+			stage = stages.get(info[1], None)
+			if stage == None:
+				stage = stages[info[1]] = bytearray()
+			_bit_set(stage, mon._num)
+			if len(mon._evo_to) > 0:
+				_bit_set(evolves, mon._num)
+			if mon._evo_from != None:
+				_bit_set(evolved, mon._num)
+		masks = ({depth: _bits_to_int(bits) for depth, bits in stages.items()}, _bits_to_int(evolves), _bits_to_int(evolved))
+		# inside a batch the index still describes the entries as they were
+		if self._batch == None:
+			self._query_evo_masks = masks
+		return masks
+
+	def _sorted_nums(self):
+		self.materialize()
+		if self._nums_stale:
+			self._nums_sorted = sorted(self._by_num)
+			self._nums_stale = False
+		return self._nums_sorted
+
+	def iter_range(self, lo=1, hi=None):
+		# present entries with lo <= num <= hi, in num order
+		nums = self._sorted_nums()
+		i = bisect_left(nums, lo)
+		while i < len(nums) and (hi == None or nums[i] <= hi):
+			yield self._by_num[nums[i]]
+			i += 1
+
+	def list_pokemon(self, fltr, lo=1, hi=None, start=0, count=None):
+		# lines start to start+count of the listing of nums lo to hi
+		hi = self._max_num if hi == None else min(hi, self._max_num)
+		_print_lines(_listing(self.iter_range(lo, hi), fltr, lo, hi), start, count)
+
+	# Integrity check in one pass over the entries and their links, O(n + edges). Returns a line for every problem
+	# found, and with repair=True fixes them on the way:
+	#   - the num and name dicts are rebuilt from the entries either of them holds, keyed by the entry's own num and
+	#     lowercase name (an entry clashing with a lower num is dropped)
+	#   - links to entries that aren't in the dex are dropped, and repeats in an evo_to list removed
+	#   - a child listed by several entries keeps the parent it names itself, or else the lowest listing one
+	#   - a link only one end knows about is added to the other end
+	#   - each loop of evolutions is cut above its lowest num, which becomes the base of the tree
+	# Fixed entries are rewritten on the next write, and the secondary and evolution indexes are rebuilt. Repairs can't
+	# be undone, so they clear the versions.
+	def check(self, repair=False):
+		self.materialize()
+		problems = []
+		changed = set()
+		by_num = self._by_num
+		by_name = self._by_name
+		entries = dict.fromkeys(by_num.values())
+		entries.update(dict.fromkeys(by_name.values()))
+
+		# num and name dicts. When every entry is found under its own num and name and the dicts hold no more keys than
+		# there are entries, there are no stale keys either.
+		for mon in entries:
+			if by_num.get(mon._num, None) is not mon:
+				problems.append('{} can\'t be found by its num.'.format(mon))
+			if by_name.get(mon._name.lower(), None) is not mon:
+				problems.append('{} can\'t be found by its name.'.format(mon))
+			if mon._dex is not self:
+				problems.append('{} is not marked as belonging to the dex.'.format(mon))
+		if len(problems) > 0 or len(by_num) != len(entries) or len(by_name) != len(entries):
+			for num, mon in by_num.items():
+				if mon._num != num:
+					problems.append('No. {} holds {}.'.format(num, mon))
+			for name, mon in by_name.items():
+				if mon._name.lower() != name:
+					problems.append('The name \'{}\' holds {}.'.format(name, mon))
+		if len(by_num) != self._size:
+			problems.append('The size is {}, but there are {} entries.'.format(self._size, len(by_num)))
+		if repair and len(problems) > 0:
+			by_num = {}
+			by_name = {}
+			for mon in sorted(entries, key=Pokemon.get_num):
+				name = mon._name.lower()
+				if mon._num in by_num or name in by_name:
+					problems.append('Dropped {}, another entry has its num or name.'.format(mon))
+					del entries[mon]
+					self._touch(mon)
+					mon._dex = None
+					continue
+				by_num[mon._num] = mon
+				by_name[name] = mon
+				if mon._dex is not self:
+					self._touch(mon)
+					mon._dex = self
+			self._by_num = by_num
+			self._by_name = by_name
+			self._size = len(by_num)
+
+		# links. A child is 'backed' when the parent it names also lists it, the rest of the listings are claims
+		# against it.
+		backed = set()
+		claims = {}
+		for mon in entries:
+			parent = mon._evo_from
+			if parent != None and parent not in entries:
+				problems.append('{} evolves from {}, which is not in the dex.'.format(mon, parent))
+				if repair:
+					self._touch(mon)
+					mon._evo_from = None
+					changed.add(mon)
+			# the usual case, every evolution names mon as its parent and they are in increasing num order
+			last = 0
+			for evo in mon._evo_to:
+				if evo._evo_from is not mon or evo._num <= last or evo not in entries:
+					break
+				last = evo._num
+			else:
+				backed.update(mon._evo_to)
+				continue
+			kept = []
+			listed = set()
+			for evo in mon._evo_to:
+				if evo not in entries:
+					problems.append('{} evolves into {}, which is not in the dex.'.format(mon, evo))
+				elif evo in listed:
+					problems.append('{} lists {} as an evolution more than once.'.format(mon, evo))
+				else:
+					listed.add(evo)
+					kept.append(evo)
+					if evo._evo_from is mon:
+						backed.add(evo)
+					else:
+						claims.setdefault(evo, []).append(mon)
+			out_of_order = any(kept[i]._num > kept[i+1]._num for i in range(len(kept)-1))
+			if out_of_order:
+				problems.append('The evolutions of {} are out of order.'.format(mon))
+			if repair and (out_of_order or len(kept) != len(mon._evo_to)):
+				self._touch(mon)
+				mon._evo_to = sorted(kept, key=Pokemon.get_num)
+				changed.add(mon)
+
+		for mon in entries:
+			parent = mon._evo_from
+			if (parent == None or mon in backed) and mon not in claims:
+				continue
+			if parent not in entries:
+				parent = None
+			others = claims.get(mon, [])
+			if parent != None and mon not in backed:
+				problems.append('{} evolves from {}, which doesn\'t list it.'.format(mon, parent))
+				if repair:
+					self._touch(parent)
+					evo_to = parent._evo_to
+					evo_to.insert(bisect_left(evo_to, mon._num, key=Pokemon.get_num), mon)
+					changed.update((mon, parent))
+			if len(others) == 0:
+				continue
+			if parent == None:
+				# no parent of its own, the lowest listing entry becomes it
+				parent = min(others, key=Pokemon.get_num)
+				others.remove(parent)
+				problems.append('{} is listed as an evolution of {}, but doesn\'t evolve from it.'.format(mon, parent))
+				if repair:
+					self._touch(mon)
+					mon._evo_from = parent
+					changed.update((mon, parent))
+			for other in others:
+				problems.append('{} is listed as an evolution of {}, but evolves from {}.'.format(mon, other, parent))
+				if repair:
+					self._touch(other)
+					other._evo_to.remove(mon)
+					changed.update((mon, other))
+
+		# loops, following evo_from from every entry and marking each entry with the walk that reached it first
+		reached = {}
+		for mon in entries:
+			walk = mon
+			while walk != None and walk not in reached and walk in entries:
+				reached[walk] = mon
+				walk = walk._evo_from
+			if walk == None or reached.get(walk, None) is not mon:
+				continue
+			loop = [walk]
+			while loop[-1]._evo_from is not walk:
+				loop.append(loop[-1]._evo_from)
+			loop.sort(key=Pokemon.get_num)
+			base = loop[0]
+			if len(loop) == 1:
+				problems.append('{} evolves from itself.'.format(base))
+			else:
+				problems.append('{} evolve into each other in a loop.'.format(', '.join(str(m) for m in loop)))
+			if repair:
+				self._touch(base, base._evo_from)
+				base._evo_from._evo_to.remove(base)
+				changed.update((base, base._evo_from))
+				base._evo_from = None
+
+		if repair and len(problems) > 0:
+			self._mark_dirty(*changed)
+			self._rebuild_indexes()
+		return problems
+
+	def _rebuild_indexes(self):
+		# the type bitsets from scratch, the sorted num and name lists on their next use, and the evolution index
+		self._by_type = {t: bytearray() for t in TypeEnum}
+		self._by_type1 = {t: bytearray() for t in TypeEnum}
+		self._by_type2 = {t: bytearray() for t in TypeEnum}
+		for mon in self._by_num.values():
+			_bit_set(self._by_type[mon.get_type1()], mon.get_num())
+			_bit_set(self._by_type[mon.get_type2()], mon.get_num())
+			_bit_set(self._by_type1[mon.get_type1()], mon.get_num())
+			_bit_set(self._by_type2[mon.get_type2()], mon.get_num())
+		self._names_stale = True
+		self._nums_stale = True
+		if self._lock != None:
+			# under the exclusive lock, see _make_concurrent()
+			self._rebuild_name_index()
+		self.rebuild_evo_index()
+
+	# When writing to a csv, all evolution references should be the pokedex number
+	# The list of numbers in the to_evo list should be delimited by spaces, and each number should be less than the current mon's number
+	# [num, name, type1, type2, from, flatten(to)]
+
+	def _source_file(self):
+		# the source csv, if it is still exactly as it was read or written
+		if self._source == None:
+			return None
+		filename, size, mtime = self._source
+		try:
+			stat = os.stat(filename)
+		except OSError:
+			return None
+		return filename if (stat.st_size, stat.st_mtime_ns) == (size, mtime) else None
+
+	# Rows of entries that haven't changed since the source csv was read are copied from it in contiguous byte ranges,
+	# only the changed entries are formatted again. Only present entries are visited, in num order, and the result is
+	# written to a temp file that replaces outname atomically, after which it becomes the new source.
+	def write(self, outname):
+		self.materialize()
+		outname += '.csv'
+		source = self._source_file()
+		src_offs = self._source_offs
+		text = io.StringIO()
+		pokedex_writer = csv.writer(text, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL, lineterminator=self._eol)
+
+		def format_row(row):
+			text.seek(0)
+			text.truncate()
+			pokedex_writer.writerow(row)
+			return text.getvalue().encode('utf-8')
+
+		order = sorted(self._by_num)
+		offs = array('Q')
+		# time spent copying and writing, the rest of the loop is formatting rows
+		io_time = [0.0]
+		start = time.perf_counter()
+		with contextlib.ExitStack() as stack:
+			src = stack.enter_context(open(source, 'rb')) if source != None else None
+			f = stack.enter_context(atomic_open(outname))
+			# first row is the max_num
+			pos = f.write(format_row([self._max_num]))
+			# [first, last) rows of the source still to be copied
+			run = [0, 0]
+
+			def copy_run():
+				copying = time.perf_counter()
+				src.seek(src_offs[run[0]])
+				left = src_offs[run[1]] - src_offs[run[0]]
+				while left > 0:
+					chunk = src.read(min(left, 1 << 20))
+					f.write(chunk)
+					left -= len(chunk)
+				io_time[0] += time.perf_counter() - copying
+
+			for num in order:
+				pokemon = self._by_num[num]
+				offs.append(pos)
+				row = pokemon._row if src != None else None
+				if row != None:
+					# extend the current run if this row follows it in the source
+					if row != run[1]:
+						copy_run()
+						run = [row, row]
+					run[1] = row + 1
+					pos += src_offs[row+1] - src_offs[row]
+					continue
+				evo_from = pokemon.get_evo_from()
+				evo_from = evo_from.get_num() if isinstance(evo_from, Pokemon) else None
+				data = format_row(csv_row(pokemon.get_num(), pokemon.get_name(), pokemon.get_type1(), pokemon.get_type2(), evo_from, [mon.get_num() for mon in pokemon.get_evo_to()]))
+				if src != None:
+					copy_run()
+					run = [0, 0]
+				writing = time.perf_counter()
+				pos += f.write(data)
+				io_time[0] += time.perf_counter() - writing
+			if src != None:
+				copy_run()
+			offs.append(pos)
+			formatted = time.perf_counter()
+		# closing the temp file syncs and renames it
+		STATS.record('write.serialize', formatted - start - io_time[0])
+		STATS.record('write.io', io_time[0] + time.perf_counter() - formatted)
+
+		stat = os.stat(outname)
+		self._source = (outname, stat.st_size, stat.st_mtime_ns)
+		self._source_offs = offs
+		for row, num in enumerate(order):
+			self._by_num[num]._row = row
+		if self._source_rows != None:
+			self._track_source()
+		print('Wrote to {}'.format(outname))
+
+	def _track_source(self):
+		# start keeping the row hashes of the source csv for reload(). If it already changed since it was read, nothing
+		# is known about its rows, and the first reload parses all of them.
+		self._source_rows = (None, array('Q'), array('q'))
+		filename = self._source_file()
+		if filename == None:
+			return
+		with open(filename, 'rb') as f:
+			max_num, rows, offs, nums, hashes = _hash_rows(f.read())
+		self._source_rows = (max_num, nums, hashes)
+
+	# Brings the dex up to date after another program rewrote its csv, see PokeDexWatcher. Only the rows whose hash
+	# differs from when the csv was last read or written are parsed, and their changes are applied to the entries in
+	# place as one batch. Like a change made outside a batch it can't be undone, and it clears the versions. An entry
+	# also changed here and not yet written is a conflict unless both sides made the same change: it keeps the unsaved
+	# change, and the conflict is reported. Returns (added, removed, changed, conflicts) with the conflicts as messages,
+	# or None if the csv is as it was.
+	def reload(self):
+		self.materialize()
+		if self._source == None:
+			return None
+		filename = self._source[0]
+		with open(filename, 'rb') as f:
+			data = f.read()
+			stat = os.fstat(f.fileno())
+		if (stat.st_size, stat.st_mtime_ns) == self._source[1:]:
+			return None
+		start = time.perf_counter()
+		max_num, rows, offs, nums, hashes = _hash_rows(data)
+		if self._source_rows == None:
+			self._source_rows = (None, array('Q'), array('q'))
+		base_max, base_nums, base_hashes = self._source_rows
+		base = dict(zip(base_nums, base_hashes))
+		# num -> (mon, from_to) of every row the csv changed
+		parsed = {}
+		for i, num in enumerate(nums):
+			if base.get(num, None) != hashes[i]:
+				row = next(csv.reader([rows[i].decode('utf-8')], delimiter=',', quotechar='|'))
+				parsed[num] = self._csv_row_to_pokemon(row)
+		STATS.record('reload.diff', time.perf_counter() - start)
+
+		with self._lock.exclusive() if self._lock != None else contextlib.nullcontext():
+			result = self._apply_reload(filename, max_num, base_max, base, parsed, set(nums))
+			self._source = (filename, stat.st_size, stat.st_mtime_ns)
+			self._source_offs = offs
+			self._source_rows = (max_num, nums, hashes)
+			self._eol = _line_terminator(data[:data.find(b'\n')+1])
+			# rows the csv changed and the entries now match are clean, other rows stay as clean as their entries were
+			for i, num in enumerate(nums):
+				pokemon = self._by_num.get(num, None)
+				if pokemon == None:
+					continue
+				if num in parsed:
+					clean = num not in result[4] and _same_entry(pokemon, *parsed[num])
+				else:
+					clean = pokemon._row != None
+				pokemon._row = i if clean else None
+			if len(rows) > 0 and not rows[-1].endswith(b'\n') and nums[-1] in self._by_num:
+				self._by_num[nums[-1]]._row = None
+		STATS.record('reload', time.perf_counter() - start)
+		return result[:4]
+
+	def _apply_reload(self, filename, max_num, base_max, base, parsed, present):
+		# a dirty entry only has an unsaved change if it no longer matches its row as it was
+		def unsaved(num, pokemon):
+			return pokemon._row == None and base.get(num, None) != _entry_hash(pokemon, self._eol)
+
+		conflicts = []
+		conflicted = set()
+		adds = []
+		updates = []
+		for num, (mon, from_to) in parsed.items():
+			pokemon = self._by_num.get(num, None)
+			if pokemon == None:
+				if num in base:
+					conflicts.append('{} was deleted here and changed in {}, keeping it deleted.'.format(mon, filename))
+					conflicted.add(num)
+				else:
+					adds.append((mon, from_to))
+			elif _same_entry(pokemon, mon, from_to):
+				continue
+			elif unsaved(num, pokemon):
+				conflicts.append('{} was changed here and in {}, keeping the unsaved change.'.format(pokemon, filename))
+				conflicted.add(num)
+			else:
+				updates.append((pokemon, mon, from_to))
+		# entries without unsaved changes were deleted from the csv, the others were added or changed here
+		deletes = []
+		for num, pokemon in self._by_num.items():
+			if num in present:
+				continue
+			if not unsaved(num, pokemon):
+				deletes.append(pokemon)
+			elif num in base:
+				conflicts.append('{} was changed here and deleted from {}, keeping the unsaved change.'.format(pokemon, filename))
+				conflicted.add(num)
+		new_max = self._max_num
+		if max_num != base_max and max_num != self._max_num:
+			if base_max != None and self._max_num != base_max:
+				conflicts.append('The max number was changed here to {} and in {} to {}, keeping {}.'.format(self._max_num, filename, max_num, self._max_num))
+			else:
+				new_max = max_num
+
+		with self.batch('reload'):
+			changed = self._batch
+			self.set_max_num(max(new_max, self._max_num))
+			# links the csv dropped go first, leaving alone children that have moved to another entry like delete()
+			for pokemon, mon, (num, evo_from, evo_to) in updates:
+				for evo in list(pokemon.get_evo_to()):
+					if evo.get_num() in evo_to:
+						continue
+					if evo.get_evo_from() is pokemon:
+						pokemon.del_evo_to(evo)
+					else:
+						self._touch(pokemon)
+						pokemon.del_evo_to(evo, inner=True)
+						self._mark_dirty(pokemon)
+				prior = pokemon.get_evo_from()
+				if prior != None and prior.get_num() != evo_from:
+					prior.del_evo_to(pokemon)
+			for pokemon in deletes:
+				self.delete(pokemon)
+			for pokemon, mon, from_to in updates:
+				if pokemon.get_name() != mon.get_name():
+					self.update_name(pokemon, mon.get_name())
+				if (pokemon.get_type1(), pokemon.get_type2()) != (mon.get_type1(), mon.get_type2()):
+					self.update_types(pokemon, mon.get_type1(), mon.get_type2())
+			for mon, from_to in adds:
+				self.add(mon)
+			by_num = self._by_num
+			for pokemon, (num, evo_from, evo_to) in chain(((pokemon, from_to) for pokemon, mon, from_to in updates), adds):
+				for evo in evo_to:
+					child = by_num.get(evo, None)
+					if child != None and child not in pokemon.get_evo_to():
+						pokemon.set_evo_to(child)
+				parent = by_num.get(evo_from, None)
+				if parent != None and pokemon.get_evo_from() is not parent:
+					parent.set_evo_to(pokemon)
+			self.set_max_num(new_max)
+		# the saved states of the versions no longer follow from the entries
+		if len(self._undo) > 0 and self._undo[-1][1] is changed:
+			self._undo = []
+			self._redo = []
+		return len(adds), len(deletes), len(updates), conflicts, conflicted
+
+# A read-only view of a PokeDex as it was when dex.snapshot() was called. Nothing is copied when it is taken: the dex
+# saves an entry into every open snapshot just before the entry first changes (see PokeDex._touch), so the snapshot
+# reads saved entries from there and every other entry from the live dex. Taking one is O(1) and keeping it open costs
+# O(changes). Close it when done with it, or use it in a with statement.
+class PokeDexSnapshot:
+	def __init__(self, dex):
+		self._dex = dex
+		self._size = len(dex)
+		self._max_num = dex.get_max_num()
+		# Pokemon -> its state when the snapshot was taken, and the nums and lowercase names those had then
+		self._saved = {}
+		self._nums = {}
+		self._names = {}
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+	def close(self):
+		with self._dex._lock.exclusive() if self._dex._lock != None else contextlib.nullcontext():
+			self._dex._snapshots.discard(self)
+
+	def _save(self, mon, state):
+		self._saved[mon] = state
+		if state[6] is self._dex:
+			self._nums[state[0]] = mon
+			self._names[state[1].lower()] = mon
+
+	def _state(self, mon):
+		# in concurrent mode under the shared lock, so the entry can't start changing between the two reads
+		lock = self._dex._lock
+		if lock == None:
+			state = self._saved.get(mon, None)
+			return state if state != None else (mon._num, mon._name, mon._type1, mon._type2, mon._evo_from, mon._evo_to, mon._dex)
+		with lock.shared():
+			state = self._saved.get(mon, None)
+			return state if state != None else self._dex._state(mon)
+
+	def __len__(self):
+		return self._size
+
+	def get_max_num(self):
+		return self._max_num
+
+	def find(self, query):
+		with self._dex._lock.shared() if self._dex._lock != None else contextlib.nullcontext():
+			return self._find(query)
+
+	def _find(self, query):
+		if isinstance(query, int):
+			mon = self._nums.get(query, None)
+			live = self._dex._by_num.get(query, None)
+		else:
+			mon = self._names.get(query.lower(), None)
+			live = self._dex._by_name.get(query.lower(), None)
+		if mon == None and live != None and live not in self._saved:
+			mon = live
+		return None if mon == None else PokemonSnapshot(self, mon)
+
+	def _live_nums(self, lo, hi):
+		# unchanged entries from lo to hi, looking up the next num afresh each time so edits in between are fine
+		num = lo - 1
+		while True:
+			with self._dex._lock.shared() if self._dex._lock != None else contextlib.nullcontext():
+				nums = self._dex._sorted_nums()
+				i = bisect_right(nums, num)
+				if i == len(nums) or nums[i] > hi:
+					return
+				num = nums[i]
+				mon = self._dex._by_num.get(num, None)
+				unchanged = mon != None and mon not in self._saved
+			if unchanged:
+				yield num, mon
+
+	def iter_range(self, lo=1, hi=None):
+		# entries with lo <= num <= hi at the time of the snapshot, in num order
+		hi = self._max_num if hi == None else hi
+		with self._dex._lock.shared() if self._dex._lock != None else contextlib.nullcontext():
+			saved = sorted((num, mon) for num, mon in self._nums.items() if lo <= num <= hi)
+		for num, mon in merge(saved, self._live_nums(lo, hi), key=itemgetter(0)):
+			yield PokemonSnapshot(self, mon)
+
+	def list_pokemon(self, fltr, lo=1, hi=None, start=0, count=None):
+		hi = self._max_num if hi == None else min(hi, self._max_num)
+		_print_lines(_listing(self.iter_range(lo, hi), fltr, lo, hi), start, count)
+
+	def evo_family(self, pokemon):
+		# every entry in pokemon's evolution tree with its depth, in preorder
+		seen = set()
+		while pokemon.get_evo_from() != None and pokemon not in seen:
+			seen.add(pokemon)
+			pokemon = pokemon.get_evo_from()
+		family = []
+		seen = set()
+		stack = [(pokemon, 0)]
+		while len(stack) > 0:
+			mon, depth = stack.pop()
+			if mon in seen:
+				continue
+			seen.add(mon)
+			family.append((mon, depth))
+			for evo in reversed(mon.get_evo_to()):
+				stack.append((evo, depth+1))
+		return family
+
+	def csv_chunks(self, rows=4096):
+		# the dex in the csv format, as bytes of up to rows rows each
+		text = io.StringIO()
+		pokedex_writer = csv.writer(text, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
+		pokedex_writer.writerow([self._max_num])
+		count = 0
+		for pokemon in self.iter_range():
+			evo_from = pokemon.get_evo_from()
+			pokedex_writer.writerow(csv_row(pokemon.get_num(), pokemon.get_name(), pokemon.get_type1(), pokemon.get_type2(), None if evo_from == None else evo_from.get_num(), [mon.get_num() for mon in pokemon.get_evo_to()]))
+			count += 1
+			if count % rows == 0:
+				yield text.getvalue().encode('utf-8')
+				text.seek(0)
+				text.truncate()
+		yield text.getvalue().encode('utf-8')
+
+	def write(self, outname):
+		outname += '.csv'
+		with atomic_open(outname) as f:
+			for chunk in self.csv_chunks():
+				f.write(chunk)
+		print('Wrote to {}'.format(outname))
+
+class PokemonSnapshot:
+	# read-only handle onto one entry of a PokeDexSnapshot, with the getters of Pokemon
+	__slots__ = ('_snapshot', '_mon')
+
+	def __init__(self, snapshot, mon):
+		self._snapshot = snapshot
+		self._mon = mon
+
+	def get_num(self):
+		return self._snapshot._state(self._mon)[0]
+
+	def get_name(self):
+		return self._snapshot._state(self._mon)[1]
+
+	def get_type1(self):
+		return self._snapshot._state(self._mon)[2]
+
+	def get_type2(self):
+		return self._snapshot._state(self._mon)[3]
+
+	def get_evo_from(self):
+		evo_from = self._snapshot._state(self._mon)[4]
+		return None if evo_from == None else PokemonSnapshot(self._snapshot, evo_from)
+
+	def get_evo_to(self):
+		return [PokemonSnapshot(self._snapshot, mon) for mon in self._snapshot._state(self._mon)[5]]
+
+	def __eq__(self, other):
+		return isinstance(other, PokemonSnapshot) and other._snapshot is self._snapshot and other._mon is self._mon
+
+	def __hash__(self):
+		return id(self._mon)
+
+	def __repr__(self):
+		return 'No: {}\nName: {}\nType 1: {}\nType 2: {}\nEvolves From: {}\nEvolves To: {}'.format(self.get_num(), self.get_name(), self.get_type1().name, self.get_type2().name, str(self.get_evo_from()), [str(pokemon) for pokemon in self.get_evo_to()])
+
+	def __str__(self):
+		return '{} {}'.format(self.get_num(), self.get_name())
+
+class PokemonView:
+	# lightweight handle onto one ColumnarPokeDex entry, with the same interface as Pokemon
+	__slots__ = ('_dex', '_num')
+
+	def __init__(self, dex, num):
+		self._dex = dex
+		self._num = num
+
+	def _pos(self):
+		return self._dex._pos(self._num)
+
+	def get_num(self):
+		return self._num
+
+	def set_num(self, num):
+		self._dex.update_num(self, num)
+
+	def get_name(self):
+		return self._dex._name_at(self._pos())
+
+	def set_name(self, name):
+		self._dex.update_name(self, name)
+
+	def get_type1(self):
+		return TypeEnum(self._dex._type1[self._pos()])
+
+	def set_type1(self, type1):
+		self._dex._type1[self._pos()] = type1
+
+	def get_type2(self):
+		return TypeEnum(self._dex._type2[self._pos()])
+
+	def set_type2(self, type2):
+		self._dex._type2[self._pos()] = type2
+
+	def get_evo_from(self):
+		evo_from = self._dex._evo_from[self._pos()]
+		return None if evo_from == 0 else PokemonView(self._dex, evo_from)
+
+	def set_evo_from(self, pokemon, inner=False):
+		if isinstance(pokemon, PokemonView):
+			self._dex._link(pokemon._num, self._num)
+		elif pokemon == None:
+			self.del_evo_from()
+
+	def del_evo_from(self, inner=False):
+		evo_from = self._dex._evo_from[self._pos()]
+		if evo_from != 0:
+			self._dex._unlink(evo_from, self._num)
+
+	def get_evo_to(self):
+		return [PokemonView(self._dex, num) for num in self._dex._children(self._num)]
+
+	def set_evo_to(self, pokemon, inner=False):
+		if isinstance(pokemon, PokemonView):
+			self._dex._link(self._num, pokemon._num)
+
+	def del_evo_to(self, pokemon, inner=False):
+		if isinstance(pokemon, PokemonView):
+			self._dex._unlink(self._num, pokemon._num)
+
+	def __eq__(self, other):
+		return isinstance(other, PokemonView) and other._dex is self._dex and other._num == self._num
+
+	def __hash__(self):
+		return hash(self._num)
+
+	def __repr__(self):
+		return 'No: {}\nName: {}\nType 1: {}\nType 2: {}\nEvolves From: {}\nEvolves To: {}'.format(self._num, self.get_name(), self.get_type1().name, self.get_type2().name, str(self.get_evo_from()), [str(pokemon) for pokemon in self.get_evo_to()])
+
+	def __str__(self):
+		return '{} {}'.format(self._num, self.get_name())
+
+# The columnar dex keeps every field in a typed array, one slot per entry sorted by num, instead of one Pokemon object
+# per entry. Evolutions are stored as evo_from nums plus a CSR table of evo_to nums; parents whose evolutions changed
+# since the table was built are shadowed by small lists in _evo_patch until the next write. Names live in one utf-8
+# pool, and _name_order holds the nums sorted by lowercase name for lookups. This takes roughly 40 bytes per entry,
+# against several hundred for a Pokemon object and its two dict slots.
+class ColumnarPokeDex:
+	def __init__(self, filename, max_num, new, binary=False, workers=1):
+		self._max_num = max_num
+		self._nums = array('i')
+		self._type1 = array('b')
+		self._type2 = array('b')
+		self._evo_from = array('i')
+		self._evo_off = array('I', [0])
+		self._evo_to = array('i')
+		self._evo_patch = {}
+		self._names = bytearray()
+		self._name_start = array('I')
+		self._name_len = array('H')
+		self._name_order = array('i')
+		if new:
+			pass
+		elif binary:
+			self.load_binary(filename)
+		else:
+			self.populate_from_file(filename, workers=workers)
+
+	def __len__(self):
+		return len(self._nums)
+
+	def get_max_num(self):
+		return self._max_num
+
+	def set_max_num(self, new_max):
+		if new_max < len(self) or new_max <= 0:
+			raise PokeDexBadMax
+
+		self._max_num = new_max
+
+	def populate_from_file(self, filename, progress=True, workers=1):
+		filename += '.csv'
+		print('Opening {}'.format(filename))
+		start = time.perf_counter()
+		workers = _parse_workers(filename, workers)
+		if workers > 1:
+			self._parallel_load(filename, workers, start)
+			print('{} loaded.'.format(filename))
+			return
+		parents = array('i')
+		children = array('i')
+		with open(filename, 'r') as csvfile:
+			pokedex_reader = csv.reader(csvfile, delimiter=',', quotechar='|')
+			# first row contains the max_num
+			self._max_num = int(next(pokedex_reader)[0])
+			last_report = time.monotonic()
+			reported = False
+			for row in pokedex_reader:
+				num = int(row[0])
+				self._nums.append(num)
+				self._type1.append(CSV_TYPES[row[2]])
+				self._type2.append(CSV_TYPES[row[3]])
+				self._append_name(row[1])
+				if len(row[4]) > 0:
+					parents.append(int(row[4]))
+					children.append(num)
+				for evo in row[5:]:
+					parents.append(num)
+					children.append(int(evo))
+				# report progress at most a few times per second
+				if progress and len(self._nums) % 4096 == 0 and time.monotonic() - last_report > 0.25:
+					last_report = time.monotonic()
+					reported = True
+					print('Loading -- {}/{}'.format(len(self._nums), self._max_num), end='\r')
+			if reported:
+				print()
+
+		self._sort_and_validate()
+		linking = time.perf_counter()
+		STATS.record('populate_from_file.parse', linking - start)
+		self._build_evos(parents, children)
+		STATS.record('populate_from_file.link', time.perf_counter() - linking)
+		print('{} loaded.'.format(filename))
+
+	def _parallel_load(self, filename, workers, start):
+		# the parsed ranges are already columns, so they are appended as they are
+		self._max_num, parts = _parse_parallel(filename, workers)
+		parents = array('i')
+		children = array('i')
+		for nums, type1, type2, evo_from, evo_off, evo_to, name_off, pool, offs in parts:
+			base = len(self._names)
+			self._nums.extend(nums)
+			self._type1.extend(type1)
+			self._type2.extend(type2)
+			self._name_start.extend(base + off for off in name_off[:-1])
+			self._name_len.extend(map(int.__sub__, name_off[1:], name_off[:-1]))
+			self._names += pool
+			# every evo_from and evo_to becomes a (parent, child) edge
+			parents.extend(filter(None, evo_from))
+			children.extend(compress(nums, evo_from))
+			parents.extend(chain.from_iterable(map(repeat, nums, map(int.__sub__, evo_off[1:], evo_off[:-1]))))
+			children.extend(evo_to)
+		self._sort_and_validate()
+		linking = time.perf_counter()
+		STATS.record('populate_from_file.parse', linking - start)
+		self._build_evos(parents, children)
+		STATS.record('populate_from_file.link', time.perf_counter() - linking)
+
+	def load_binary(self, filename):
+		filename += '.pdx'
+		print('Opening {}'.format(filename))
+		pdx = _PdxReader(filename)
+		try:
+			self._max_num = pdx.max_num
+			for column, source in ((self._nums, pdx.nums), (self._type1, pdx.type1), (self._type2, pdx.type2), (self._evo_from, pdx.evo_from), (self._evo_to, pdx.evo_to)):
+				column.frombytes(memoryview(source).cast('B'))
+			self._evo_off = array('I')
+			self._evo_off.frombytes(memoryview(pdx.evo_off).cast('B'))
+			self._names = bytearray(pdx.names)
+			self._name_start = array('I', pdx.name_off[:-1])
+			self._name_len = array('H', [pdx.name_off[i+1] - pdx.name_off[i] for i in range(pdx.count)])
+			self._name_order = array('i', [pdx.nums[i] for i in pdx.name_order])
+		finally:
+			pdx.close()
+		print('{} loaded.'.format(filename))
+
+	def _append_name(self, name):
+		encoded = name.encode('utf-8')
+		self._name_start.append(len(self._names))
+		self._name_len.append(len(encoded))
+		self._names += encoded
+
+	def _sort_and_validate(self):
+		# put the slots in num order, then check nums and names the same way PokeDex.add would
+		count = len(self._nums)
+		if any(self._nums[i] >= self._nums[i+1] for i in range(count-1)):
+			order = sorted(range(count), key=self._nums.__getitem__)
+			for column in (self._nums, self._type1, self._type2, self._name_start, self._name_len):
+				column[:] = array(column.typecode, [column[i] for i in order])
+
+		if count > self._max_num:
+			raise PokeDexFull
+		if any(self._nums[i] == self._nums[i+1] for i in range(count-1)):
+			raise PokeDexHasEntryNum
+		if count > 0 and (self._nums[0] <= 0 or self._nums[-1] > self._max_num):
+			raise PokeDexOutOfRange
+
+		by_name = sorted(range(count), key=lambda i: self._name_at(i).lower())
+		if any(self._name_at(by_name[i]).lower() == self._name_at(by_name[i+1]).lower() for i in range(count-1)):
+			raise PokeDexHasEntryName
+		self._name_order = array('i', [self._nums[i] for i in by_name])
+
+	def _build_evos(self, parents, children):
+		# one sorted pass over every (from, to) edge named by either end
+		count = len(self._nums)
+		self._evo_from = array('i', bytes(4*count))
+		self._evo_to = array('i')
+		counts = [0] * count
+		last = None
+		for edge in sorted(zip(parents, children)):
+			if edge == last:
+				continue
+			last = edge
+			parent = self._pos(edge[0])
+			child = self._pos(edge[1])
+			if parent == None or child == None:
+				continue
+			counts[parent] += 1
+			self._evo_to.append(edge[1])
+			self._evo_from[child] = edge[0]
+
+		self._evo_off = array('I', [0])
+		total = 0
+		for n in counts:
+			total += n
+			self._evo_off.append(total)
+		self._evo_patch = {}
+
+	def _pos(self, num):
+		i = bisect_left(self._nums, num)
+		return i if i < len(self._nums) and self._nums[i] == num else None
+
+	def _name_at(self, i):
+		start = self._name_start[i]
+		return self._names[start:start+self._name_len[i]].decode('utf-8')
+
+	def _lower_name_of(self, num):
+		return self._name_at(self._pos(num)).lower()
+
+	def _name_slot(self, name):
+		# index into _name_order of the entry with this (lowercase) name, or None
+		i = bisect_left(self._name_order, name, key=self._lower_name_of)
+		return i if i < len(self._name_order) and self._lower_name_of(self._name_order[i]) == name else None
+
+	def _children(self, num):
+		if num in self._evo_patch:
+			return self._evo_patch[num]
+		i = self._pos(num)
+		return self._evo_to[self._evo_off[i]:self._evo_off[i+1]].tolist()
+
+	def _set_children(self, num, evo_to):
+		self._evo_patch[num] = evo_to
+
+	def _link(self, parent, child):
+		if parent == child:
+			return
+		# a num has exactly one prior evolution
+		old = self._evo_from[self._pos(child)]
+		if old == parent:
+			return
+		if old != 0:
+			self._unlink(old, child)
+		evo_to = self._children(parent)
+		evo_to.insert(bisect_left(evo_to, child), child)
+		self._set_children(parent, evo_to)
+		self._evo_from[self._pos(child)] = parent
+
+	def _unlink(self, parent, child):
+		evo_to = self._children(parent)
+		if child in evo_to:
+			evo_to.remove(child)
+			self._set_children(parent, evo_to)
+		pos = self._pos(child)
+		if self._evo_from[pos] == parent:
+			self._evo_from[pos] = 0
+
+	def _compact_evos(self):
+		# fold _evo_patch back into the CSR table
+		if len(self._evo_patch) == 0:
+			return
+		evo_to = array('i')
+		evo_off = array('I', [0])
+		for num in self._nums:
+			evo_to.extend(self._children(num))
+			evo_off.append(len(evo_to))
+		self._evo_to = evo_to
+		self._evo_off = evo_off
+		self._evo_patch = {}
+
+	def find(self, query):
+		return self._find_by_num(query) if isinstance(query, int) else self._find_by_name(query)
+
+	def _find_by_num(self, query):
+		return None if self._pos(query) == None else PokemonView(self, query)
+
+	def _find_by_name(self, query):
+		i = self._name_slot(query.lower())
+		return None if i == None else PokemonView(self, self._name_order[i])
+
+	def add(self, pokemon):
+		num = pokemon.get_num()
+		if len(self) >= self._max_num:
+			raise PokeDexFull
+		elif self._pos(num) != None:
+			raise PokeDexHasEntryNum
+		elif self._name_slot(pokemon.get_name().lower()) != None:
+			raise PokeDexHasEntryName
+		elif num <= 0 or num > self._max_num:
+			raise PokeDexOutOfRange
+
+		i = bisect_left(self._nums, num)
+		# the new slot starts with an empty span in the CSR table
+		self._evo_off.insert(i, self._evo_off[i])
+		self._nums.insert(i, num)
+		self._type1.insert(i, pokemon.get_type1())
+		self._type2.insert(i, pokemon.get_type2())
+		self._evo_from.insert(i, 0)
+		encoded = pokemon.get_name().encode('utf-8')
+		self._name_start.insert(i, len(self._names))
+		self._name_len.insert(i, len(encoded))
+		self._names += encoded
+		self._name_order.insert(bisect_left(self._name_order, pokemon.get_name().lower(), key=self._lower_name_of), num)
+
+	def delete(self, pokemon):
+		if len(self) == 0:
+			raise PokeDexEmpty
+
+		if pokemon == None:
+			print('The specified pokemon does not exist in the pokedex.')
+			return
+
+		num = pokemon.get_num()
+		# a copy, _unlink edits the patched list of num in place
+		for evo in list(self._children(num)):
+			self._unlink(num, evo)
+		pokemon.del_evo_from()
+		self._remove_slot(num)
+
+	def _remove_slot(self, num):
+		i = self._pos(num)
+		del self._name_order[self._name_slot(self._name_at(i).lower())]
+		# dropping offset i+1 merges this slot's CSR span into the next one, so shadow the next slot's evolutions first
+		if i+1 < len(self._nums) and self._evo_off[i] != self._evo_off[i+1]:
+			after = self._nums[i+1]
+			self._set_children(after, self._children(after))
+		self._evo_patch.pop(num, None)
+		del self._evo_off[i+1]
+		for column in (self._nums, self._type1, self._type2, self._evo_from, self._name_start, self._name_len):
+			del column[i]
+
+	def update_num(self, pokemon, num):
+		old = pokemon.get_num()
+		if old == num:
+			return
+		if self._pos(num) != None:
+			raise PokeDexHasEntryNum
+		elif num <= 0 or num > self._max_num:
+			raise PokeDexOutOfRange
+
+		i = self._pos(old)
+		evo_from = self._evo_from[i]
+		evo_to = self._children(old)
+		name = self._name_at(i)
+		fields = (self._type1[i], self._type2[i])
+
+		# move the slot to its new place in num order
+		self._remove_slot(old)
+		moved = Pokemon(num, name, type1=fields[0], type2=fields[1])
+		self.add(moved)
+		pokemon._num = num
+
+		# re-point the evolutions that referred to the old num
+		if evo_from != 0:
+			siblings = [num if evo == old else evo for evo in self._children(evo_from)]
+			siblings.sort()
+			self._set_children(evo_from, siblings)
+			self._evo_from[self._pos(num)] = evo_from
+		for evo in evo_to:
+			self._evo_from[self._pos(evo)] = num
+		self._set_children(num, evo_to)
+
+	def update_name(self, pokemon, name):
+		i = self._pos(pokemon.get_num())
+		slot = self._name_slot(name.lower())
+		if slot != None and self._name_order[slot] != pokemon.get_num():
+			raise PokeDexHasEntryName
+
+		del self._name_order[self._name_slot(self._name_at(i).lower())]
+		# the old name is left behind in the pool until the next rewrite
+		encoded = name.encode('utf-8')
+		self._name_start[i] = len(self._names)
+		self._name_len[i] = len(encoded)
+		self._names += encoded
+		self._name_order.insert(bisect_left(self._name_order, name.lower(), key=self._lower_name_of), pokemon.get_num())
+
+	def materialize(self):
+		pass
+
+	def update_types(self, pokemon, type1, type2):
+		pokemon.set_type1(type1)
+		pokemon.set_type2(type2)
+
+	def by_types(self, *types, match_all=True):
+		raise PokeDexUnsupported
+
+	def search(self, text, fuzzy=False, max_dist=None, limit=20):
+		raise PokeDexUnsupported
+
+	def check(self, repair=False):
+		raise PokeDexUnsupported
+
+	def reload(self):
+		raise PokeDexUnsupported
+
+	def query(self, expr):
+		raise PokeDexUnsupported
+
+	def in_mask(self, mask):
+		raise PokeDexUnsupported
+
+	def effectiveness(self, *attacking):
+		raise PokeDexUnsupported
+
+	def undo(self):
+		raise PokeDexUnsupported
+
+	def redo(self):
+		raise PokeDexUnsupported
+
+	def forget_history(self):
+		# there is no history to forget
+		pass
+
+	def snapshot(self):
+		raise PokeDexUnsupported
+
+	# evolution queries walk the evo columns, there is no precomputed index in this backend
+	def rebuild_evo_index(self):
+		pass
+
+	def evo_root(self, pokemon):
+		seen = set()
+		num = pokemon.get_num()
+		while self._evo_from[self._pos(num)] != 0 and num not in seen:
+			seen.add(num)
+			num = self._evo_from[self._pos(num)]
+		return PokemonView(self, num)
+
+	def evo_depth(self, pokemon):
+		return len(self._ancestors(pokemon.get_num()))
+
+	def _ancestors(self, num):
+		ancestors = []
+		while self._evo_from[self._pos(num)] != 0 and num not in ancestors:
+			num = self._evo_from[self._pos(num)]
+			ancestors.append(num)
+		return ancestors
+
+	def is_ancestor(self, ancestor, pokemon):
+		return ancestor.get_num() in self._ancestors(pokemon.get_num())
+
+	def evo_descendants(self, pokemon):
+		return [mon for mon, _ in self._walk(pokemon.get_num(), 0)[1:]]
+
+	def evo_family(self, pokemon):
+		return self._walk(self.evo_root(pokemon).get_num(), 0)
+
+	def _walk(self, num, depth):
+		family = []
+		seen = set()
+		stack = [(num, depth)]
+		while len(stack) > 0:
+			num, depth = stack.pop()
+			if num in seen:
+				continue
+			seen.add(num)
+			family.append((PokemonView(self, num), depth))
+			stack.extend((evo, depth+1) for evo in reversed(self._children(num)))
+		return family
+
+	def iter_range(self, lo=1, hi=None):
+		# present entries with lo <= num <= hi, in num order
+		i = bisect_left(self._nums, lo)
+		while i < len(self._nums) and (hi == None or self._nums[i] <= hi):
+			yield PokemonView(self, self._nums[i])
+			i += 1
+
+	def list_pokemon(self, fltr, lo=1, hi=None, start=0, count=None):
+		hi = self._max_num if hi == None else min(hi, self._max_num)
+		_print_lines(_listing(self.iter_range(lo, hi), fltr, lo, hi), start, count)
+
+	def write(self, outname):
+		outname += '.csv'
+		# rows are formatted into a buffer and written out a few thousand at a time
+		text = io.StringIO()
+		pokedex_writer = csv.writer(text, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
+		io_time = 0.0
+		start = time.perf_counter()
+		with atomic_open(outname, 'w', newline='') as f:
+			# first row is the max_num
+			pokedex_writer.writerow([self._max_num])
+			for i in range(len(self._nums)):
+				num = self._nums[i]
+				evo_from = self._evo_from[i] if self._evo_from[i] != 0 else None
+				pokedex_writer.writerow(csv_row(num, self._name_at(i), TypeEnum(self._type1[i]), TypeEnum(self._type2[i]), evo_from, self._children(num)))
+				if i % 4096 == 4095 or i == len(self._nums) - 1:
+					writing = time.perf_counter()
+					f.write(text.getvalue())
+					io_time += time.perf_counter() - writing
+					text.seek(0)
+					text.truncate()
+			if len(self._nums) == 0:
+				f.write(text.getvalue())
+			formatted = time.perf_counter()
+		STATS.record('write.serialize', formatted - start - io_time)
+		STATS.record('write.io', io_time + time.perf_counter() - formatted)
+		print('Wrote to {}'.format(outname))
+
+	def write_jsonl(self, outname):
+		count = write_jsonl(outname, dex_records(self))
+		print('Wrote {} entries to {}'.format(count, outname))
+
+	def write_binary(self, outname):
+		outname += '.pdx'
+		self._compact_evos()
+		# rebuild a packed name pool, dropping names left behind by renames
+		pool = bytearray()
+		name_off = array('I', [0])
+		for i in range(len(self._nums)):
+			start = self._name_start[i]
+			pool += self._names[start:start+self._name_len[i]]
+			name_off.append(len(pool))
+		name_order = array('I', [self._pos(num) for num in self._name_order])
+		_write_pdx(outname, self._max_num, self._nums, self._type1, self._type2, self._evo_from, self._evo_off, self._evo_to, name_off, name_order, pool)
+
+# A regional dex is a numbering over a subset of another (national) dex, read from a <name>.region.csv file whose first
+# row is the regional max_num and every other row is 'regional num,national num'. Lookups go through the national dex,
+# so both hand out the very same entries and nothing is parsed twice. Regional dexes are views: entries are changed
+# (and written) through the national dex.
+class RegionalDex:
+	def __init__(self, name, national, filename):
+		self.name = name
+		self._national = national
+		self._max_num = 0
+		# regional num <-> national num
+		self._to_national = {}
+		self._to_regional = {}
+		self._nums_sorted = []
+		self.populate_from_file(filename)
+
+	def populate_from_file(self, filename):
+		filename += '.region.csv'
+		print('Opening {}'.format(filename))
+		with open(filename, 'r') as csvfile:
+			region_reader = csv.reader(csvfile, delimiter=',', quotechar='|')
+			# first row contains the max_num
+			self._max_num = int(next(region_reader)[0])
+			for row in region_reader:
+				num, national_num = int(row[0]), int(row[1])
+				if num <= 0 or num > self._max_num:
+					raise PokeDexOutOfRange
+				if num in self._to_national or national_num in self._to_regional:
+					raise PokeDexHasEntryNum
+				self._to_national[num] = national_num
+				self._to_regional[national_num] = num
+		self._nums_sorted = sorted(self._to_national)
+		print('{} loaded.'.format(filename))
+
+	def __len__(self):
+		return sum(1 for _ in self.iter_range())
+
+	def get_max_num(self):
+		return self._max_num
+
+	def regional_num(self, pokemon):
+		return self._to_regional.get(pokemon.get_num(), None)
+
+	def _in_region(self, pokemon):
+		return pokemon != None and pokemon.get_num() in self._to_regional
+
+	def find(self, query):
+		if isinstance(query, int):
+			national_num = self._to_national.get(query, None)
+			return None if national_num == None else self._national.find(national_num)
+		pokemon = self._national.find(query)
+		return pokemon if self._in_region(pokemon) else None
+
+	def iter_range(self, lo=1, hi=None):
+		# entries with regional nums lo <= num <= hi, in regional order
+		nums = self._nums_sorted
+		i = bisect_left(nums, lo)
+		while i < len(nums) and (hi == None or nums[i] <= hi):
+			pokemon = self._national.find(self._to_national[nums[i]])
+			if pokemon != None:
+				yield pokemon
+			i += 1
+
+	def list_pokemon(self, fltr, lo=1, hi=None, start=0, count=None):
+		hi = self._max_num if hi == None else min(hi, self._max_num)
+		_print_lines(_listing(self.iter_range(lo, hi), fltr, lo, hi, self.regional_num), start, count)
+
+	def by_types(self, *types, match_all=True):
+		return (mon for mon in self._national.by_types(*types, match_all=match_all) if self._in_region(mon))
+
+	def query(self, expr):
+		# in national num order, like by_types
+		return (mon for mon in self._national.query(expr) if self._in_region(mon))
+
+	def _region_mask(self):
+		bits = bytearray()
+		for national_num in self._to_regional:
+			_bit_set(bits, national_num)
+		return _bits_to_int(bits)
+
+	def in_mask(self, mask):
+		return self._national.in_mask(mask & self._region_mask())
+
+	def effectiveness(self, *attacking):
+		# over national nums, like the national dex
+		region = self._region_mask()
+		groups = [(multiplier, mask & region) for multiplier, mask in self._national.effectiveness(*attacking)]
+		return [(multiplier, mask) for multiplier, mask in groups if mask != 0]
+
+	def search(self, text, fuzzy=False, max_dist=None, limit=20):
+		# search the whole national dex, then keep the regional matches
+		matches = self._national.search(text, fuzzy=fuzzy, max_dist=max_dist, limit=len(self._national))
+		return [mon for mon in matches if self._in_region(mon)][:limit]
+
+	def evo_family(self, pokemon):
+		return self._national.evo_family(pokemon)
+
+	def materialize(self):
+		self._national.materialize()
+
+	def add(self, pokemon):
+		raise PokeDexUnsupported
+
+	def delete(self, pokemon):
+		raise PokeDexUnsupported
 
 	def set_max_num(self, new_max):
-		if new_max < self._size or new_max <= 0:
-			raise PokeDexBadMax
+		raise PokeDexUnsupported
 
-		self._max_num = new_max
+	def update_num(self, pokemon, num):
+		raise PokeDexUnsupported
 
-	def populate_from_file(self, filename):
-		filename += '.csv'
-		print('Opening {}'.format(filename))
-		progress = 1
+	def update_name(self, pokemon, name):
+		raise PokeDexUnsupported
 
-		first = True
-		with open(filename, 'r') as csvfile:
-			pokedex_reader = csv.reader(csvfile, delimiter=',', quotechar='|')
-			from_to_list = []
-			for row in pokedex_reader:
-				# first row contains the max_num
-				if first:
-					self._max_num = int(row[0])
-					first = False
-					continue
-				# add all mons to the dex
-				mon, from_to = self._csv_row_to_pokemon(row)
-				from_to_list.append(from_to)
-				self.add(mon)
-				print('Loading -- {}/{}'.format(progress, self._max_num), end='\r')
-				progress += 1
-			# link all evolutions
-			self._link_evolutions(from_to_list)
-		print('\n{} loaded.'.format(filename))
+	def update_types(self, pokemon, type1, type2):
+		raise PokeDexUnsupported
 
-	def _csv_row_to_pokemon(self, row):
-		# print(row)
-		num = int(row[0])
-		name = row[1]
-		type1 = TypeEnum[row[2][9:]]
-		type2 = TypeEnum[row[3][9:]]
-		evo_from = None if len(row[4]) == 0 else int(row[4])
-		evo_to = []
-		for evo in row[5:]:
-			evo_to.append(int(evo))
+	def rebuild_evo_index(self):
+		self._national.rebuild_evo_index()
 
-		opts = {}
-		opts['type1'] = type1
-		opts['type2'] = type2
+	def check(self, repair=False):
+		return self._national.check(repair)
 
-		return Pokemon(num, name, **opts), (num, evo_from, evo_to)
+class PokeDexFederation:
+	# the national dex plus the regional dexes next to its file, each loaded the first time it is asked for
+	def __init__(self, national, filename):
+		self.national = national
+		self.national_name = os.path.basename(filename)
+		self._directory = os.path.dirname(filename)
+		self._regions = {}
 
-	def _link_evolutions(self, from_to_list):
-		for from_to in from_to_list:
-			num, evo_from, evo_to = from_to
-			pokemon = self.find(num)
-			from_mon = self.find(evo_from) if evo_from != None else None
-			to_mons = [self.find(evo) for evo in evo_to]
-			pokemon.set_evo_from(from_mon)
-			for mon in to_mons:
-				pokemon.set_evo_to(mon)
+	def names(self):
+		names = [self.national_name]
+		for entry in sorted(os.listdir(self._directory or '.')):
+			if entry.endswith('.region.csv'):
+				names.append(entry[:-len('.region.csv')])
+		return names
 
-	def find(self, query):
-		return self._find_by_num(query) if isinstance(query, int) else self._find_by_name(query)
+	def is_loaded(self, name):
+		return name == self.national_name or name in self._regions
 
-	def _find_by_num(self, query):
-		return self._by_num.get(query, None)
+	def get(self, name):
+		# the named dex, or None if there is no such dex
+		if name == self.national_name:
+			return self.national
+		if name not in self._regions:
+			filename = os.path.join(self._directory, name)
+			if not os.path.exists(filename + '.region.csv'):
+				return None
+			self._regions[name] = RegionalDex(name, self.national, filename)
+		return self._regions[name]
 
-	def _find_by_name(self, query):
-		# name = query[0].upper() + query[1:].lower()
-		name = query.lower()
-		return self._by_name.get(name, None)
+# Applies one change record, a list like ['link', 1, 2] as the journal below stores them and poke_diff.py writes them into
+# patches. Entries are named by num, and a record naming a missing entry raises KeyError.
+def apply_record(pokedex, rec):
+	op = rec[0]
+	if op == 'add':
+		pokedex.add(Pokemon(rec[1], rec[2], type1=TypeEnum[rec[3]], type2=TypeEnum[rec[4]]))
+	elif op == 'delete':
+		pokedex.delete(_record_entry(pokedex, rec[1]))
+	elif op == 'link':
+		_record_entry(pokedex, rec[1]).set_evo_to(_record_entry(pokedex, rec[2]))
+	elif op == 'unlink':
+		_record_entry(pokedex, rec[1]).del_evo_to(_record_entry(pokedex, rec[2]))
+	elif op == 'setmax':
+		pokedex.set_max_num(rec[1])
+	elif op == 'edit':
+		pokemon = _record_entry(pokedex, rec[1])
+		pokedex.update_num(pokemon, rec[2])
+		pokedex.update_name(pokemon, rec[3])
+		pokedex.update_types(pokemon, TypeEnum[rec[4]], TypeEnum[rec[5]])
+	elif op == 'repair':
+		pokedex.check(repair=True)
+	elif op == 'patch':
+		# ['patch', file, [record, ...]], a whole patch as one change
+		for part in rec[2]:
+			apply_record(pokedex, part)
+	elif op == 'undo':
+		pokedex.undo()
+	elif op == 'redo':
+		pokedex.redo()
+	else:
+		raise KeyError(op)
 
-	def add(self, pokemon):
-		if self._size >= self._max_num:
-			raise PokeDexFull
-		elif pokemon.get_num() in self._by_num:
-			raise PokeDexHasEntryNum
-		elif pokemon.get_name() in self._by_name:
-			raise PokeDexHasEntryName
-		elif pokemon.get_num() <= 0 or pokemon.get_num() > self._max_num:
-			raise PokeDexOutOfRange
+def _record_label(rec):
+	# how a record is named in messages and as the label of the version it makes, a patch by its file
+	if rec[0] == 'patch':
+		return 'patch {}'.format(rec[1])
+	return ' '.join(str(arg) for arg in rec)
 
-		self._by_num[pokemon.get_num()] = pokemon
-		self._by_name[pokemon.get_name().lower()] = pokemon
-		self._size += 1
+def _record_entry(pokedex, num):
+	pokemon = pokedex.find(num)
+	if pokemon == None:
+		raise KeyError(num)
+	return pokemon
 
-	def delete(self, pokemon):
-		if self._size == 0:
-			raise PokeDexEmpty
+def patch_records(filename):
+	# the change records of a patch file (optionally .gz or .xz), in order
+	with _open_stream(filename) as f:
+		for line in f:
+			if len(line.strip()) > 0:
+				yield json.loads(line)
 
-		if pokemon == None:
-			print('The specified pokemon does not exist in the pokedex.')
-			return
+# Polls the csv a PokeDex was read from (or last written to) with os.stat and reloads the dex when another program
+# replaces it, see PokeDex.reload(). A change is only acted on once the file has looked the same for two polls in a row,
+# so a file still being written isn't read half way. poll() does one check and suits a loop that has its own turns, like
+# MainLoop. start() polls from a daemon thread, which needs a dex opened with concurrent=True.
+class PokeDexWatcher:
+	def __init__(self, pokedex, interval=WATCH_INTERVAL, on_reload=None):
+		self.pokedex = pokedex
+		self.interval = interval
+		# called with the result of reload() from the thread
+		self.on_reload = on_reload
+		self._polled = time.monotonic()
+		# the (size, mtime) seen changed at the last poll, and one that failed to reload
+		self._pending = None
+		self._failed = None
+		self._stop = threading.Event()
+		self._thread = None
+		pokedex._track_source()
 
-		if pokemon.get_num() not in self._by_num and pokemon.get_name().lower() not in self._by_name:
-			print('{} is only in one of the searchable dicts (num/name) for some reason. Try reloading.'.format(pokemon))
-			return
+	def poll(self, force=False):
+		# reload the dex if its csv changed and has settled, returns what reload() did or None. Checks less than interval
+		# apart are skipped. With force=True the check is made anyway and a change is acted on without waiting.
+		now = time.monotonic()
+		if not force and now - self._polled < self.interval:
+			return None
+		self._polled = now
+		return self._check(force)
 
-		# delete self as the evo_from for all subsequent evolutions
-		while len(pokemon.get_evo_to()) > 0:
-			pokemon.get_evo_to()[0].del_evo_from()
+	def _check(self, force):
+		source = self.pokedex._source
+		if source == None:
+			return None
+		try:
+			stat = os.stat(source[0])
+		except OSError:
+			# between an unlink and a rename, or gone for good
+			return None
+		seen = (stat.st_size, stat.st_mtime_ns)
+		if seen == source[1:] or (seen == self._failed and not force):
+			return None
+		if not force and seen != self._pending:
+			self._pending = seen
+			return None
+		self._pending = None
+		try:
+			return self.pokedex.reload()
+		except (PokeDexError, ValueError, IndexError):
+			self._failed = seen
+			raise
 
-		# delete self as an evo_to entry for the prior evolution
-		pokemon.del_evo_from()
+	def _run(self):
+		while not self._stop.wait(self.interval):
+			try:
+				result = self._check(False)
+			except (PokeDexError, ValueError, IndexError) as e:
+				print('Could not reload {}: {}'.format(self.pokedex._source[0], type(e).__name__))
+				continue
+			if result != None and self.on_reload != None:
+				self.on_reload(result)
 
-		del self._by_num[pokemon.get_num()]
-		del self._by_name[pokemon.get_name().lower()]
-		self._size -= 1
+	def start(self):
+		self._stop.clear()
+		self._thread = threading.Thread(target=self._run, daemon=True)
+		self._thread.start()
 
-	def update_num(self, pokemon, num):
-		del self._by_num[pokemon.get_num()]
-		self._by_num[num] = pokemon
+	def stop(self):
+		self._stop.set()
+		if self._thread != None:
+			self._thread.join()
+			self._thread = None
 
-	def update_name(self, pokemon, name):
-		del self._by_name[pokemon.get_name().lower()]
-		self._by_name[name] = pokemon
-
-	def list_pokemon(self, fltr):
-		if fltr == 'all':
-			for i in range(1, self._max_num+1):
-				pokemon = self._by_num.get(i, '{} UNKNOWN/UNSEEN'.format(i))
-				print(pokemon)
-		elif fltr == 'known':
-			for i in range(1, self._max_num+1):
-				if i in self._by_num:
-					print(self._by_num[i])
+# The journal is an append-only log of mutations kept next to the dex file it applies to, one JSON list per line:
+#   ["add", num, name, type1, type2]    ["delete", num]    ["link", from, to]    ["unlink", from, to]
+#   ["setmax", max_num]    ["edit", num, new_num, new_name, type1, type2]
+# Mutations are buffered in memory and appended (and fsynced) on commit, so saving a few changes costs only those
+# records. Opening the dex replays the journal over the snapshot, and compacting rewrites the snapshot and drops it.
+class PokeDexJournal:
+	def __init__(self, filename):
+		self.filename = filename + '.journal'
+		self.pending = []
+		# records already on disk
+		self.committed = 0
 
-	# When writing to a csv, all evolution references should be the pokedex number
-	# The list of numbers in the to_evo list should be delimited by spaces, and each number should be less than the current mon's number
-	# [num, name, type1, type2, from, flatten(to)]
+	def __len__(self):
+		return self.committed + len(self.pending)
 
-	def write(self, outname):
-		outname += '.csv'
-		progress = 1
-		with open(outname, 'w', newline='') as f:
-			pokedex_writer = csv.writer(f, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
-			# first row is the max_num
-			pokedex_writer.writerow([self._max_num])
-			# write all pokemon
-			for entry in range(1, self._max_num+1):
-				pokemon = self.find(entry)
-				if pokemon == None:
-					continue
-				# print('Writing Entry--')
-				# print(repr(pokemon))
-				row = []
-				row.append(pokemon.get_num())
-				row.append(pokemon.get_name())
-				row.append(pokemon.get_type1())
-				row.append(pokemon.get_type2())
-				evo_from = pokemon.get_evo_from()
-				row.append(evo_from.get_num() if isinstance(evo_from, Pokemon) else None)
-				for mon in pokemon.get_evo_to():
-					row.append(mon.get_num())
-				pokedex_writer.writerow(row)
-				print('Progress -- {}/{}'.format(progress, self._max_num), end='\r')
-				progress += 1
-		print('\nWrote to {}'.format(outname))
+	def record(self, op, *args):
+		self.pending.append([op] + list(args))
+
+	def commit(self):
+		if len(self.pending) == 0:
+			return 0
+		data = ''.join(json.dumps(rec) + '\n' for rec in self.pending)
+		with open(self.filename, 'a') as f:
+			f.write(data)
+			f.flush()
+			os.fsync(f.fileno())
+		count = len(self.pending)
+		self.committed += count
+		self.pending = []
+		return count
+
+	def clear(self):
+		# the snapshot now holds every change
+		if os.path.exists(self.filename):
+			os.remove(self.filename)
+		self.committed = 0
+		self.pending = []
+
+	def replay(self, pokedex):
+		if not os.path.exists(self.filename):
+			return 0
+		print('Replaying {}'.format(self.filename))
+		with open(self.filename, 'rb') as f:
+			data = f.read()
+		end = data.rfind(b'\n') + 1
+		if end < len(data):
+			# a crash part way through a commit leaves at most one torn record at the end, which was never committed.
+			# It is cut off so the next commit doesn't append onto it.
+			print('Dropping the torn record at the end of {}.'.format(self.filename))
+			with open(self.filename, 'r+b') as f:
+				f.truncate(end)
+				f.flush()
+				os.fsync(f.fileno())
+		lines = data[:end].decode('utf-8', errors='replace').splitlines()
+		count = 0
+		readable = 0
+		for i, line in enumerate(lines):
+			try:
+				rec = json.loads(line)
+			except ValueError:
+				print('Ignoring unreadable journal record {}.'.format(i+1))
+				continue
+			readable += 1
+			try:
+				if rec[0] in ('undo', 'redo'):
+					# the version it takes back or brings back has to have been replayed before it
+					if (pokedex.undo() if rec[0] == 'undo' else pokedex.redo()) == None:
+						print('Skipping journal record {} {}: nothing to {}'.format(i+1, rec, rec[0]))
+						continue
+				else:
+					# replayed changes become versions like the commands that made them, so they can still be undone
+					versioned = isinstance(pokedex, PokeDex) and rec[0] != 'repair'
+					with pokedex.batch(_record_label(rec)) if versioned else contextlib.nullcontext():
+						apply_record(pokedex, rec)
+			except (PokeDexError, KeyError, IndexError) as e:
+				print('Skipping journal record {} {}: {}'.format(i+1, _record_label(rec), type(e).__name__))
+				continue
+			count += 1
+		self.committed = readable
+		print('{} changes replayed.'.format(count))
+		return count
+
+# lines per page of the list command
+LIST_PAGE_SIZE = 50
+# commands run as a batch that 'undo' can take back
+VERSIONED_CMDS = ('add', 'delete', 'link', 'unlink', 'setmax', 'edit.save')
 
 class MainLoop:
-	def __init__(self, filename='national', max_num=890, new=False):
-		self.pokedex = PokeDex(filename, max_num, new)
+	def __init__(self, filename='national', max_num=890, new=False, binary=False, columnar=False, profile=(), workers=1, check=None, cache=True, startup_time=False, watch=None):
+		start = time.perf_counter()
+		if is_jsonl(filename):
+			# an NDJSON dex is opened by its full name, and only into the default backend
+			binary = False
+			if columnar:
+				print('An NDJSON dex can\'t be opened with the columnar backend, using the default one.')
+				columnar = False
+		if columnar:
+			self.pokedex = ColumnarPokeDex(filename, max_num, new, binary, workers=workers)
+		else:
+			self.pokedex = PokeDex(filename, max_num, new, binary, workers=workers, cache=cache)
+		if startup_time:
+			self._print_startup_time(time.perf_counter() - start)
 		self.filename = filename
+		self.binary = binary
+		# changes since the snapshot, saved by 'write' and folded into the snapshot by 'compact'
+		self.journal = PokeDexJournal(self._file_name(filename, binary))
+		if not new:
+			self.journal.replay(self.pokedex)
+		# the opened dex is the national one, regional dexes next to it are views over it that 'use' switches to
+		self.federation = PokeDexFederation(self.pokedex, filename)
+		self.current = self.federation.national_name
 		self.help_msgs = self._init_help_msgs()
 		self.edit_help_msgs = self._init_edit_help_msgs()
 		self.change_made = False
 		self.edit_change_made = False
 		self.main_exit = False
 		self.edit_exit = False
+		# False when commands come from a script, which answers every Y/N prompt with yes
+		self.interactive = True
+		# (pokemon, vals) while in editing mode
+		self.editing = None
+		# commands to run under cProfile
+		self.profile = set(profile)
+		# polls the national csv between commands when watching it, every watch seconds
+		self.watcher = None
+		if watch != None:
+			if columnar or binary or is_jsonl(filename):
+				print('Only a dex opened from its .csv with the default backend can be watched.')
+			else:
+				self.watcher = PokeDexWatcher(self.pokedex, watch)
+		# 'check' or 'repair' the dex once it is loaded
+		if check != None:
+			self.run_line(check)
 
 	def _init_help_msgs(self):
 		help_msgs = {}
-		help_msgs['add'] = 'Add a pokemon to the pokedex. The command format is \'add <num> <name>\'.'
+		help_msgs['add'] = 'Add a pokemon to the pokedex. The command format is \'add <num> <name> [<type1> [<type2>]]\'. If no types are given, they are asked for.'
+		help_msgs['check'] = 'Check the pokedex for broken evolution chains (links to missing entries, links only one side knows about, pokemon listed under several prior evolutions, evolution loops) and entries that can\'t be found by their number or name. The command format is \'check\'. Use \'repair\' to fix what it finds.'
+		help_msgs['compact'] = 'Rewrite the pokedex file with every change made so far, and empty its journal. Changes made before it can no longer be undone. The command format is \'compact\'.'
 		help_msgs['delete'] = 'Delete a pokemon from the pokedex. The command format is \'delete <num>|<name>\'.'
 		help_msgs['edit'] = 'Edit the number, name, type1, and type2 fields for a pokemon. Editing mode can be identified by the console input reader looking like \'*>>\'. The command format is \'edit <num>|<name>\'. Type \'help\' while in editing more for more details.'
 		help_msgs['evos'] = 'See the full evolution chain for a pokemon. The command format is \'evos <num>|<name>\'.'
 		help_msgs['exit'] = 'Exit the pokedex. The command format is \'exit\'.'
+		help_msgs['filter'] = 'List the pokemon that have a type, or both of two types. The command format is \'filter <type> [<type>]\'.'
 		help_msgs['find'] = 'Find a pokemon in the pokedex. The command format is \'find <num>|<name>\'.'
 		help_msgs['getmax'] = 'Get the max PokeDex size. The command format is \'getmax\'.'
 		help_msgs['getsize'] = 'Get the current PokeDex size. The command format is \'getsize\'.'
 		help_msgs['help'] = 'See detailed instructions for how to use this pokedex. The command format is \'help [<cmd>]\'.'
 		help_msgs['link'] = 'Link two pokemon in an evolutionary chain. The command format is \'link <num>|<name> <num>|<name>\' where the first pokemon evolves into the second.'
-		help_msgs['list'] = 'List the pokemon in the pokedex. The command format is \'list <filter>\' where <filter> can be \'all\'|\'known\'.'
-		help_msgs['relink'] = 'Relink all evolutions in the pokedex. Use to fix all potentially broken/lopsided evolution chains after unlinking. Suggest to use after all unlinks. The command format is \'relink\'.'
+		help_msgs['list'] = 'List the pokemon in the pokedex. The command format is \'list <filter> [--from <num>] [--to <num>] [--page <page>]\' where <filter> can be \'all\'|\'known\'. \'all\' also lists each run of missing numbers. \'--from\' and \'--to\' limit the listing to those numbers, and \'--page\' shows only that page of {} lines.'.format(LIST_PAGE_SIZE)
+		help_msgs['matchup'] = 'Rank the pokedex by how much damage attacks of one or more types do to each pokemon, from the best resisted to the most effective. The command format is \'matchup <type> [<type>...]\'. With several types each pokemon is scored by the one that hits it hardest.'
+		help_msgs['patch'] = 'Apply a patch made by \'python poke_diff.py diff\' to the national pokedex. The command format is \'patch <file>\'. The whole patch is one change for \'undo\', and if any of it doesn\'t apply to this pokedex none of it is kept.'
+		help_msgs['query'] = 'List the pokemon matching an expression, in number order. The command format is \'query <expression>\', e.g. \'query type=FIRE and num<200 and evolves\'. The conditions are num, stage (0 for a base form, 1 for its evolution and so on) with = != < <= > >=, type (either slot), type1 and type2 with = or !=, name=<text> for names starting with <text>, evolves (has an evolution) and evolved (has a prior evolution). They combine with not, and, or and parentheses.'
+		help_msgs['reload'] = 'Bring the national pokedex up to date with its .csv after another program changed the file, loading only the rows that differ. The command format is \'reload\'. Entries changed here and not yet written keep those changes, and are reported if the file changed them too. Started with --watch, this is done by itself before each command once the file changes.'
+		help_msgs['relink'] = 'The old name of \'repair\'.'
+		help_msgs['repair'] = 'Fix every problem \'check\' finds. Links to missing entries are dropped, a pokemon keeps the prior evolution it names itself, links only one side knows about are completed, and evolution loops are cut above their lowest number. The command format is \'repair\'.'
+		help_msgs['search'] = 'Search the pokedex by name. The command format is \'search [fuzzy] <text>\', which lists the pokemon whose name starts with <text>, or with \'fuzzy\' the pokemon whose name is a few typos away from <text>.'
+		help_msgs['stats'] = 'See how many times each command ran and how long it took, as the median, 95th and 99th percentile and slowest time, along with the parse/link phases of loading and the serialize/io phases of writing. The command format is \'stats [reset]\', where \'reset\' clears them.'
 		help_msgs['setmax'] = 'Set the max PokeDex size. The max size must be greater than the current PokeDex size. The command format is \'setmax <max_num>\'.'
+		help_msgs['undo'] = 'Undo the last change to the pokedex: an add, delete, link, unlink, setmax or saved edit. The command format is \'undo\'. Up to {} changes can be undone, and \'repair\', \'compact\' or a \'write\' that rewrites the whole file forgets them.'.format(UNDO_LIMIT)
 		help_msgs['unlink'] = 'Unlink two pokemon in an evolutionary chain. The command format is \'unlink <num>|<name> <num>|<name>\' where the pokedex stores the first pokemon as evolving into the second.'
-		help_msgs['write'] = 'Write the current pokedex to disk. The command format is \'write [outname]\' where \'outname\' is the name of the file to write to. Beware that if a file of the same name already exists in the current directory, this will overwrite that file.'
+		help_msgs['redo'] = 'Redo the last change undone by \'undo\', as long as nothing else was changed since. The command format is \'redo\'.'
+		help_msgs['use'] = 'Switch to another dex. The command format is \'use [<dex>]\' where <dex> is the national dex that was opened or a regional dex defined by a <dex>.region.csv file next to it. Regional dexes are numbered views of the national one, so they are only loaded once and changes to their entries are made to the national entries. Without <dex>, lists the dexes.'
+		help_msgs['write'] = 'Write the national pokedex to disk. The command format is \'write [outname]\' where \'outname\' is the name of the file to write to. The pokedex is written in the format it was opened with, unless \'outname\' ends in \'.csv\' or \'.pdx\'. An \'outname\' ending in \'.jsonl\' or \'.ndjson\' (and optionally \'.gz\' or \'.xz\') exports it as JSON Lines, one pokemon per line. Writing to the file the pokedex was opened from only appends the unwritten changes to its journal, see \'compact\'. Beware that if a file of the same name already exists in the current directory, this will overwrite that file.'
 
 		return help_msgs
 
@@ -364,10 +3825,16 @@ class MainLoop:
 		
 		opts = {}
 		## Get user input
-		t1 = input('Enter Type 1 (Optional)\n>> ').upper().rstrip()
-		get_t2 = len(t1) > 0
-		if get_t2:
-			t2 = input('Enter Type 2 (Optional)\n>> ').upper().rstrip()
+		if len(args) > 2 or not self.interactive:
+			# types given on the command line are never prompted for
+			t1 = args[2].upper() if len(args) > 2 else ''
+			t2 = args[3].upper() if len(args) > 3 else ''
+			get_t2 = len(t1) > 0
+		else:
+			t1 = input('Enter Type 1 (Optional)\n>> ').upper().rstrip()
+			get_t2 = len(t1) > 0
+			if get_t2:
+				t2 = input('Enter Type 2 (Optional)\n>> ').upper().rstrip()
 
 		## Set user input
 		# type 1
@@ -386,6 +3853,16 @@ class MainLoop:
 
 		return Pokemon(num, name, **opts)
 
+	def _confirm(self):
+		# scripts always answer yes
+		if not self.interactive:
+			return True
+		try:
+			yn = input('Y/N? ')
+		except EOFError:
+			return False
+		return yn.lower() == 'y'
+
 	def _get_query_type(self, query):
 		# check if user inputted num or name, and return correctly typed query
 		by_num = True
@@ -397,31 +3874,41 @@ class MainLoop:
 
 	def add(self, args):
 		# check if input is in correct format
-		if len(args) != 2:
-			print('Wrong number of arguments supplied. Retry command as \'add <num> <name>\'.')
-			return
+		if len(args) < 2 or len(args) > 4:
+			print('Wrong number of arguments supplied. Retry command as \'add <num> <name> [<type1> [<type2>]]\'.')
+			return False
 
 		pokemon = self._create_pokemon(args)
 		self.pokedex.add(pokemon)
+		self.journal.record('add', pokemon.get_num(), pokemon.get_name(), pokemon.get_type1().name, pokemon.get_type2().name)
 		self.change_made = True
 
 	def edit(self, args):
 		# check if input is in correct format
 		if len(args) != 1:
 			print('Wrong number of arguments supplied. Retry command as \'edit <num>|<name>\'.')
-			return
+			return False
 
 		query = self._get_query_type(args[0])
 		pokemon = self.pokedex.find(query)
+		if pokemon == None:
+			print('{} was not found in the PokeDex.'.format(args[0]))
+			return False
 
 		print('Entering Editing Mode')
 		self.edit_loop(pokemon)
 
+	def _finish_edit(self):
+		print('Exiting Editing Mode')
+		self.editing = None
+		# reset edit flags
+		self.edit_exit = False
+		self.edit_change_made = False
+
 	def edit_exit_func(self, pokemon, vals, args):
 		if self.edit_change_made:
 			print('There are unsaved changes for this pokemon. Exit without saving changes?')
-			yn = input('Y/N? ')
-			if yn.lower() == 'y':
+			if self._confirm():
 				print('Exiting.')
 				self.edit_exit = True
 			else:
@@ -434,7 +3921,7 @@ class MainLoop:
 		# check if input is in correct format
 		if len(args) > 2:
 			print('Wrong number of arguments supplied. Retry command as \'help [<cmd>]\'.')
-			return
+			return False
 
 		if len(args) == 0:
 			print('The following commands are available. Type \'help <cmd>\' to see more detailed instructions.')
@@ -445,13 +3932,16 @@ class MainLoop:
 			print('status')
 
 		if len(args) == 1:
-			print(self.edit_help_msgs.get(args[0], '{} is not a valid <cmd>.'.format(args[0])))
+			if args[0] not in self.edit_help_msgs:
+				print('{} is not a valid <cmd>.'.format(args[0]))
+				return False
+			print(self.edit_help_msgs[args[0]])
 
 	def edit_save(self, pokemon, vals, args):
 		# check if input is in correct format
 		if len(args) != 0:
 			print('Wrong number of arguments supplied. Retry command as \'save\'.')
-			return
+			return False
 
 		print('Saving Status')
 		print('{} -----> {}'.format(pokemon.get_num(), vals[0]))
@@ -462,19 +3952,19 @@ class MainLoop:
 		self.change_made = True
 		self.edit_change_made = False
 
-		self.pokedex.update_num(pokemon, vals[0])
-		self.pokedex.update_name(pokemon, vals[1])
-
-		pokemon.set_num(vals[0])
-		pokemon.set_name(vals[1])
-		pokemon.set_type1(vals[2])
-		pokemon.set_type2(vals[3])
+		old_num = pokemon.get_num()
+		# all of the fields are saved or none of them
+		with self.pokedex.batch() if isinstance(self.pokedex, PokeDex) else contextlib.nullcontext():
+			self.pokedex.update_num(pokemon, vals[0])
+			self.pokedex.update_name(pokemon, vals[1])
+			self.pokedex.update_types(pokemon, vals[2], vals[3])
+		self.journal.record('edit', old_num, vals[0], vals[1], vals[2].name, vals[3].name)
 
 	def edit_set(self, pokemon, vals, args):
 		# check if input is in correct format
 		if len(args) != 2:
 			print('Wrong number of arguments supplied. Retry command as \'set <field> <value>\'.')
-			return
+			return False
 
 		field = args[0]
 		if field == 'number':
@@ -495,12 +3985,13 @@ class MainLoop:
 			vals[3] = TypeEnum[args[1].upper()]
 		else:
 			print('Bad <field> supplied. <field> can be \'number\'|\'name\'|\'type1\'|\'type2\'.')
+			return False
 
 	def edit_status(self, pokemon, vals, args):
 		# check if input is in correct format
 		if len(args) != 0:
 			print('Wrong number of arguments supplied. Retry command as \'status\'.')
-			return
+			return False
 
 		print('Current Editing Status')
 		print('Number: {} --?--> {}'.format(pokemon.get_num(), vals[0]))
@@ -520,86 +4011,82 @@ class MainLoop:
 		return edit_cmds
 
 	def edit_loop(self, pokemon):
-		edit_cmds = self.get_edit_cmds()
-
+		# editing mode lasts until edit exit, the following lines are dispatched to the edit commands by run_line
 		vals = []
 		vals.append(pokemon.get_num())
 		vals.append(pokemon.get_name())
 		vals.append(pokemon.get_type1())
 		vals.append(pokemon.get_type2())
-
-		while(True):
-			try:
-				if self.edit_exit:
-					break
-				line = input('*>> ').rstrip()
-				if len(line) == 0:
-					continue
-				args = line.split()
-				func = edit_cmds.get(args[0], None)
-				if func == None:
-					print('The input \'{}\' is not a valid command. Please try again, or type \'help\' to see the available commands. Commands are case-sensitive.'.format(args[0]))
-				else:
-					func(pokemon, vals, args[1:])
-			except PokeDexHasEntryName:
-				print('An entry already exists with that name. Delete the conflicting entry before trying again.')
-			except PokeDexHasEntryNum:
-				print('An entry already exists with that number. Delete the conflicting entry before trying again.')
-			except Exception as e:
-				# print('Edit exception')
-				# print(e)
-				print('Oops! Something went wrong. Please try again.')
-		print('Exiting Editing Mode')
-		# reset edit_exit flag
-		self.edit_exit = False
+		self.editing = (pokemon, vals)
 
 	def delete(self, args):
 		# check if input is in correct format
 		if len(args) != 1:
 			print('Wrong number of arguments supplied. Retry command as \'delete <num>|<name>\'.')
-			return
+			return False
 
 		query = self._get_query_type(args[0])
 		pokemon = self.pokedex.find(query)
+		if pokemon == None:
+			print('{} was not found in the PokeDex.'.format(args[0]))
+			return False
 
 		self.pokedex.delete(pokemon)
+		self.journal.record('delete', pokemon.get_num())
 		self.change_made = True
 
 	def evo_chain(self, args):
 		# check if input is in correct format
 		if len(args) != 1:
 			print('Wrong number of arguments supplied. Retry command as \'evos <num>|<name>\'.')
-			return
+			return False
 
 		query = self._get_query_type(args[0])
 		pokemon = self.pokedex.find(query)
-		
+		if pokemon == None:
+			print('{} was not found in the PokeDex.'.format(args[0]))
+			return False
+
 		self._chain_printer(pokemon)
 
-	def _chain_printer(self, pokemon):
-		# essentially pretty printing of a Depth First Traversal
-		root = pokemon
-		while root.get_evo_from() != None:
-			root = root.get_evo_from()
+	def _chain_printer(self, pokemon, indent=4):
+		# pretty printing of the Depth First Traversal stored in the evolution index
+		for mon, depth in self.pokedex.evo_family(pokemon):
+			print(' ' * indent * depth + str(mon))
+
+	def filter(self, args):
+		# check if input is in correct format
+		if len(args) not in (1, 2):
+			print('Wrong number of arguments supplied. Retry command as \'filter <type> [<type>]\'.')
+			return False
 
-		self._print_helper(root, 0)
+		types = []
+		for arg in args:
+			if arg.upper() not in TypeEnum.__members__:
+				print('Bad <type> supplied. {} is not a type.'.format(arg))
+				return False
+			types.append(TypeEnum[arg.upper()])
 
-	def _print_helper(self, pokemon, depth, indent=4):
-		space = ' ' * indent * depth
-		print(space + str(pokemon))
-		for mon in pokemon.get_evo_to():
-			self._print_helper(mon, depth+1)
+		for pokemon in self.pokedex.by_types(*types):
+			print(pokemon)
 
 	def find(self, args):
 		# check if input is in correct format
 		if len(args) < 1:
 			print('Wrong number of arguments supplied. Retry command as \'find <num>|<name>\'.')
-			return
+			return False
 
 		query = self._get_query_type(args[0])
 		pokemon = self.pokedex.find(query)
 		print(repr(pokemon))
-		return pokemon
+		if pokemon != None and isinstance(self.pokedex, RegionalDex):
+			print('{} No: {}'.format(self.current, self.pokedex.regional_num(pokemon)))
+		if pokemon == None and isinstance(query, str) and isinstance(self.pokedex, PokeDex):
+			suggestions = self.pokedex.search(query, fuzzy=True, limit=5)
+			if len(suggestions) > 0:
+				print('Did you mean: {}?'.format(', '.join(mon.get_name() for mon in suggestions)))
+		if pokemon == None:
+			return False
 
 	def get_max(self, args):
 		print('The PokeDex max size is {}.'.format(self.pokedex.get_max_num()))
@@ -611,7 +4098,7 @@ class MainLoop:
 		# check if input is in correct format
 		if len(args) != 2:
 			print('Wrong number of arguments supplied. Retry command as \'link <num>|<name> <num>|<name>\'.')
-			return
+			return False
 
 		p1 = self._get_query_type(args[0])
 		p2 = self._get_query_type(args[1])
@@ -619,78 +4106,314 @@ class MainLoop:
 		poke2 = self.pokedex.find(p2)
 		if poke1 == None:
 			print('{} was not found in the PokeDex.'.format(args[0]))
-			return
+			return False
 		if poke2 == None:
 			print('{} was not found in the PokeDex.'.format(args[1]))
-			return
+			return False
 		poke1.set_evo_to(poke2)
+		self.journal.record('link', poke1.get_num(), poke2.get_num())
 		print('Linked {} -----> {}'.format(str(poke1), str(poke2)))
 		self.change_made = True
 
 	def list_pokemon(self, args):
 		# check if input is in correct format
-		if len(args) != 1:
-			print('Wrong number of arguments supplied. Retry command as \'list <filter>\'.')
-			return
+		if len(args) % 2 != 1:
+			print('Wrong number of arguments supplied. Retry command as \'list <filter> [--from <num>] [--to <num>] [--page <page>]\'.')
+			return False
+
+		opts = {}
+		for i in range(1, len(args), 2):
+			if args[i] not in ('--from', '--to', '--page'):
+				print('Bad option {} supplied. Options can be \'--from\'|\'--to\'|\'--page\'.'.format(args[i]))
+				return False
+			opts[args[i]] = int(args[i+1])
+		lo = max(opts.get('--from', 1), 1)
+		hi = opts.get('--to', None)
+		start = 0
+		count = None
+		if '--page' in opts:
+			start = (max(opts['--page'], 1) - 1) * LIST_PAGE_SIZE
+			count = LIST_PAGE_SIZE
 
 		if args[0] == 'all':
-			self.pokedex.list_pokemon(args[0])
+			self.pokedex.list_pokemon(args[0], lo, hi, start, count)
 		elif args[0] == 'known':
-			self.pokedex.list_pokemon(args[0])
+			self.pokedex.list_pokemon(args[0], lo, hi, start, count)
 		else:
 			print('Bad <filter> supplied. <filter> can be \'all\'|\'known\'')
+			return False
 
 	def run_help(self, args):
 		# check if input is in correct format
 		if len(args) > 2:
 			print('Wrong number of arguments supplied. Retry command as \'help [<cmd>]\'.')
-			return
+			return False
 
 		if len(args) == 0:
 			print('The following commands are available. Type \'help <cmd>\' to see more detailed instructions.')
 			print('add')
+			print('check')
+			print('compact')
 			print('delete')
 			print('edit')
 			print('evos')
 			print('exit')
+			print('filter')
 			print('find')
 			print('getmax')
 			print('getsize')
 			print('help')
 			print('link')
 			print('list')
-			print('relink')
+			print('matchup')
+			print('patch')
+			print('query')
+			print('redo')
+			print('reload')
+			print('repair')
+			print('search')
 			print('setmax')
+			print('stats')
+			print('undo')
 			print('unlink')
+			print('use')
 			print('write')
 
 		if len(args) == 1:
-			print(self.help_msgs.get(args[0], '{} is not a valid <cmd>.'.format(args[0])))
+			if args[0] not in self.help_msgs:
+				print('{} is not a valid <cmd>.'.format(args[0]))
+				return False
+			print(self.help_msgs[args[0]])
+
+	def check(self, args):
+		# check if input is in correct format
+		if len(args) != 0:
+			print('Wrong number of arguments supplied. Retry command as \'check\'.')
+			return False
+
+		problems = self.federation.national.check()
+		for problem in problems:
+			print(problem)
+		print('{} problems found.'.format(len(problems)))
+
+	def reload(self, args):
+		# check if input is in correct format
+		if len(args) != 0:
+			print('Wrong number of arguments supplied. Retry command as \'reload\'.')
+			return False
+
+		result = self.watcher.poll(force=True) if self.watcher != None else self.federation.national.reload()
+		if result == None:
+			print('{} is unchanged.'.format(self.federation.national._source[0] if self.federation.national._source != None else self.filename))
+			return
+		self._print_reload(result)
+
+	def _poll_watcher(self):
+		# reload the national dex before a command if its csv changed, not while an entry is being edited
+		if self.watcher == None or self.editing != None:
+			return
+		try:
+			result = self.watcher.poll()
+		except (PokeDexError, ValueError, IndexError) as e:
+			print('Could not reload {}: {}'.format(self.federation.national._source[0], type(e).__name__))
+			return
+		if result != None:
+			self._print_reload(result)
+
+	def _print_reload(self, result):
+		added, removed, changed, conflicts = result
+		print('Reloaded {}: {} added, {} removed, {} changed.'.format(self.federation.national._source[0], added, removed, changed))
+		for conflict in conflicts:
+			print(conflict)
+		if self.journal.committed > 0:
+			# those records were made against the file as it was before
+			print('The journal still holds changes made before the file changed, use \'compact\' to fold them into it.')
+
+	def repair(self, args):
+		# check if input is in correct format
+		if len(args) != 0:
+			print('Wrong number of arguments supplied. Retry command as \'repair\'.')
+			return False
+
+		problems = self.federation.national.check(repair=True)
+		for problem in problems:
+			print(problem)
+		print('{} problems fixed.'.format(len(problems)))
+		if len(problems) > 0:
+			self.journal.record('repair')
+			self.change_made = True
+
+	def matchup(self, args):
+		# check if input is in correct format
+		if len(args) < 1:
+			print('Wrong number of arguments supplied. Retry command as \'matchup <type> [<type>...]\'.')
+			return False
+
+		attacking = []
+		for arg in args:
+			if arg.upper() not in TypeEnum.__members__ or TypeEnum[arg.upper()] not in ELEMENTAL_TYPES:
+				print('Bad <type> supplied. {} is not an attacking type.'.format(arg))
+				return False
+			attacking.append(TypeEnum[arg.upper()])
 
-	def relink(self, args):
-		print('Relinking all evolution chains.')
-		for i in range(1, self.pokedex.get_max_num()+1):
-			pokemon = self.pokedex.find(i)
-			if isinstance(pokemon, Pokemon):
-				for evo in pokemon.get_evo_to():
-					evo.set_evo_from(pokemon, inner=True)
+		for multiplier, mask in self.pokedex.effectiveness(*attacking):
+			print('x{:g} -- {} pokemon'.format(multiplier, mask.bit_count()))
+			_print_lines('    {} {}'.format(mon.get_num(), mon.get_name()) for mon in self.pokedex.in_mask(mask))
+
+	def patch(self, args):
+		# check if input is in correct format
+		if len(args) != 1:
+			print('Wrong number of arguments supplied. Retry command as \'patch <file>\'.')
+			return False
+
+		national = self.federation.national
+		# applied as one batch, so a record that doesn't apply rolls back the ones before it
+		versioned = isinstance(national, PokeDex)
+		count = 0
+		failed = False
+		try:
+			with national.batch('patch ' + args[0]) if versioned else contextlib.nullcontext():
+				for rec in patch_records(args[0]):
+					apply_record(national, rec)
+					count += 1
+		except (PokeDexError, KeyError, IndexError, ValueError) as e:
+			print('Change {} of {} does not apply to this pokedex: {} ({}). {}'.format(count+1, args[0], 'unreadable' if isinstance(e, ValueError) else rec, type(e).__name__, 'Nothing was changed.' if versioned else 'The changes before it were kept.'))
+			if versioned:
+				return False
+			failed = True
+		# journaled once it all applied, as one record so a replay makes it one version for 'undo' as well
+		if count > 0:
+			self.journal.record('patch', args[0], list(islice(patch_records(args[0]), count)))
+		print('Applied {} changes from {}.'.format(count, args[0]))
+		self.change_made = self.change_made or count > 0
+		if failed:
+			return False
+
+	def query(self, args):
+		# check if input is in correct format
+		if len(args) < 1:
+			print('Wrong number of arguments supplied. Retry command as \'query <expression>\'.')
+			return False
+
+		_print_lines(_listing(self.pokedex.query(' '.join(args)), 'known', 1, self.pokedex.get_max_num()))
+
+	def search(self, args):
+		# check if input is in correct format
+		if len(args) not in (1, 2) or (len(args) == 2 and args[0] != 'fuzzy'):
+			print('Wrong number of arguments supplied. Retry command as \'search [fuzzy] <text>\'.')
+			return False
+
+		for pokemon in self.pokedex.search(args[-1], fuzzy=len(args) == 2):
+			print(pokemon)
 
 	def set_max(self, args):
 		# check if input is in correct format
 		if len(args) != 1:
 			print('Wrong number of arguments supplied. Retry command as \'setmax <max_num>\'.')
-			return
+			return False
 
 		new_max = int(args[0])
 		self.pokedex.set_max_num(new_max)
+		self.journal.record('setmax', new_max)
 		print('New max size of the PokeDex is set to {}.'.format(new_max))
 		self.change_made = True
 
+	def stats(self, args):
+		# check if input is in correct format
+		if len(args) > 1 or (len(args) == 1 and args[0] != 'reset'):
+			print('Wrong number of arguments supplied. Retry command as \'stats [reset]\'.')
+			return False
+
+		if len(args) == 1:
+			STATS.reset()
+			print('Cleared the command statistics.')
+			return
+
+		print('{:<28} {:>7} {:>10} {:>10} {:>10} {:>10}'.format('command', 'count', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms'))
+		for name, row in STATS.summary().items():
+			print('{:<28} {:>7} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f}'.format(name, row['count'], row['p50'] * 1e3, row['p95'] * 1e3, row['p99'] * 1e3, row['max'] * 1e3))
+
+	def _print_startup_time(self, elapsed):
+		# warm when the dex came out of its cache, cold when the csv was parsed, with the phases of either
+		phases = STATS.summary()
+		if 'populate_from_file.cache_load' in phases:
+			kind = 'warm'
+			steps = (('hash', 'populate_from_file.hash'), ('cache load', 'populate_from_file.cache_load'))
+		else:
+			kind = 'cold'
+			steps = (('hash', 'populate_from_file.hash'), ('parse', 'populate_from_file.parse'), ('link', 'populate_from_file.link'), ('cache write', 'populate_from_file.cache_write'))
+		parts = ['{} {:.3f}s'.format(label, phases[name]['total']) for label, name in steps if name in phases]
+		print('Startup ({}): {:.3f}s{}'.format(kind, elapsed, ' -- ' + ', '.join(parts) if len(parts) > 0 else ''))
+
+	def dump_stats(self, filename):
+		# the stats as JSON, times in seconds
+		with open(filename, 'w') as f:
+			json.dump(STATS.summary(), f, indent=1)
+
+	def print_stats_summary(self):
+		# one line for the commands run, for an interactive session that doesn't keep its stats with --stats-file. The
+		# other names are phases of loading and writing, except for edit.<cmd>.
+		summary = STATS.summary()
+		names = [name for name in summary if '.' not in name or name.startswith('edit.')]
+		if len(names) == 0:
+			return
+		slowest = max(names, key=lambda name: summary[name]['max'])
+		print('Ran {} commands, the slowest was {} at {:.3f} ms. Pass --stats-file FILE to keep the full latency stats.'.format(sum(summary[name]['count'] for name in names), slowest, summary[slowest]['max'] * 1e3))
+
+	@contextlib.contextmanager
+	def _profiled(self, cmd):
+		if cmd not in self.profile:
+			yield
+			return
+		profile = cProfile.Profile()
+		profile.enable()
+		try:
+			yield
+		finally:
+			profile.disable()
+			pstats.Stats(profile, stream=sys.stdout).sort_stats('cumulative').print_stats(15)
+
+	def _versioned(self, cmd, line):
+		# commands that change the dex run as one batch each, which undo/redo step through
+		if cmd not in VERSIONED_CMDS or not isinstance(self.federation.national, PokeDex):
+			return contextlib.nullcontext()
+		if cmd == 'edit.save':
+			line = 'edit {}'.format(self.editing[0].get_num())
+		return self.federation.national.batch(line)
+
+	def undo(self, args):
+		# check if input is in correct format
+		if len(args) != 0:
+			print('Wrong number of arguments supplied. Retry command as \'undo\'.')
+			return False
+
+		label = self.federation.national.undo()
+		if label == None:
+			print('Nothing to undo.')
+			return
+		self.journal.record('undo')
+		print('Undid \'{}\'.'.format(label))
+		self.change_made = True
+
+	def redo(self, args):
+		# check if input is in correct format
+		if len(args) != 0:
+			print('Wrong number of arguments supplied. Retry command as \'redo\'.')
+			return False
+
+		label = self.federation.national.redo()
+		if label == None:
+			print('Nothing to redo.')
+			return
+		self.journal.record('redo')
+		print('Redid \'{}\'.'.format(label))
+		self.change_made = True
+
 	def unlink(self, args):
 		# check if input is in correct format
 		if len(args) != 2:
 			print('Wrong number of arguments supplied. Retry command as \'unlink <num>|<name> <num>|<name>\'.')
-			return
+			return False
 
 		p1 = self._get_query_type(args[0])
 		p2 = self._get_query_type(args[1])
@@ -698,35 +4421,107 @@ class MainLoop:
 		poke2 = self.pokedex.find(p2)
 		if poke1 == None:
 			print('{} was not found in the PokeDex.'.format(args[0]))
-			return
+			return False
 		if poke2 == None:
 			print('{} was not found in the PokeDex.'.format(args[1]))
-			return
+			return False
 		poke1.del_evo_to(poke2)
+		self.journal.record('unlink', poke1.get_num(), poke2.get_num())
 		print('Unlinked {} --X--> {}'.format(str(poke1), str(poke2)))
 		self.change_made = True
 
+	def use(self, args):
+		# check if input is in correct format
+		if len(args) > 1:
+			print('Wrong number of arguments supplied. Retry command as \'use [<dex>]\'.')
+			return False
+
+		if len(args) == 0:
+			for name in self.federation.names():
+				print('{} {}{}'.format('*' if name == self.current else ' ', name, '' if self.federation.is_loaded(name) else ' (not loaded)'))
+			return
+
+		pokedex = self.federation.get(args[0])
+		if pokedex == None:
+			print('There is no {} dex. Type \'use\' to see the dexes.'.format(args[0]))
+			return False
+		self.pokedex = pokedex
+		self.current = args[0]
+		print('Using the {} dex.'.format(args[0]))
+
 	def write(self, args):
 		# check if input is in correct format
 		if len(args) > 1:
 			print('Wrong number of arguments supplied. Retry command as \'write [outname]\'.')
-			return
+			return False
 
 		fname = self.filename if len(args) == 0 else args[0]
-		print('Write current pokedex to {}.csv?'.format(fname))
-		yn = input('Y/N? ')
-		if yn.lower() == 'y':
-			print('Writing to {}.csv'.format(fname))
-			self.pokedex.write(outname=fname)
+		if is_jsonl(fname) and fname != self.filename:
+			# an export, the opened file and its journal stay as they are
+			print('Write current pokedex to {}?'.format(fname))
+			if self._confirm():
+				self.federation.national.write_jsonl(fname)
+			else:
+				print('Cancelled writing current pokedex to {}'.format(fname))
+			return
+		binary = self.binary
+		# an explicit extension picks the output format
+		root, ext = os.path.splitext(fname)
+		if ext in ('.csv', '.pdx'):
+			fname = root
+			binary = ext == '.pdx'
+		ext = '' if is_jsonl(fname) else '.pdx' if binary else '.csv'
+
+		print('Write current pokedex to {}{}?'.format(fname, ext))
+		if self._confirm():
+			# the file this dex was opened from only needs the new changes appended to its journal
+			if fname == self.filename and binary == self.binary and os.path.exists(fname + ext):
+				count = self.journal.commit()
+				print('Wrote {} changes to {}'.format(count, self.journal.filename))
+			else:
+				self._write_snapshot(fname, binary)
+			self.change_made = False
+		else:
+			print('Cancelled writing current pokedex to {}{}'.format(fname, ext))
+
+	def _file_name(self, fname, binary):
+		# the file a dex name is written to, NDJSON dexes are named with their extension
+		if is_jsonl(fname):
+			return fname
+		return fname + ('.pdx' if binary else '.csv')
+
+	def _write_snapshot(self, fname, binary):
+		print('Writing to {}'.format(self._file_name(fname, binary)))
+		# regional dexes are views, what gets written is always the national dex
+		if is_jsonl(fname):
+			self.federation.national.write_jsonl(fname)
+		elif binary:
+			self.federation.national.write_binary(outname=fname)
+		else:
+			self.federation.national.write(outname=fname)
+		# a full rewrite of the opened file already holds everything in its journal
+		if fname == self.filename and binary == self.binary:
+			self.journal.clear()
+			# a replay after a restart no longer has the versions an undo from here would take back
+			self.federation.national.forget_history()
+
+	def compact(self, args):
+		# check if input is in correct format
+		if len(args) != 0:
+			print('Wrong number of arguments supplied. Retry command as \'compact\'.')
+			return False
+
+		print('Fold {} changes into {}?'.format(len(self.journal), self._file_name(self.filename, self.binary)))
+		if self._confirm():
+			self._write_snapshot(self.filename, self.binary)
 			self.change_made = False
 		else:
-			print('Cancelled writing current pokedex to {}.csv'.format(fname))
+			print('Cancelled compacting the pokedex.')
 
 	def exit(self, args):
 		if self.change_made:
 			print('There are unwritten changes in the pokedex. Exit without writing changes?')
-			yn = input('Y/N? ')
-			if yn.lower() == 'y':
+			if self._confirm():
 				print('Exiting.')
 				self.main_exit = True
 			else:
@@ -738,67 +4533,189 @@ class MainLoop:
 	def get_cmds(self):
 		cmds = {}
 		cmds['add'] = self.add
+		cmds['check'] = self.check
+		cmds['compact'] = self.compact
 		cmds['delete'] = self.delete
 		cmds['evos'] = self.evo_chain
 		cmds['edit'] = self.edit
 		cmds['exit'] = self.exit
+		cmds['filter'] = self.filter
 		cmds['find'] = self.find
 		cmds['getmax'] = self.get_max
 		cmds['getsize'] = self.get_size
 		cmds['help'] = self.run_help
 		cmds['link'] = self.link
 		cmds['list'] = self.list_pokemon
-		cmds['relink'] = self.relink
+		cmds['matchup'] = self.matchup
+		cmds['patch'] = self.patch
+		cmds['query'] = self.query
+		cmds['redo'] = self.redo
+		cmds['relink'] = self.repair
+		cmds['reload'] = self.reload
+		cmds['repair'] = self.repair
+		cmds['search'] = self.search
 		cmds['setmax'] = self.set_max
+		cmds['stats'] = self.stats
+		cmds['undo'] = self.undo
 		cmds['unlink'] = self.unlink
+		cmds['use'] = self.use
 		cmds['write'] = self.write
 
 		return cmds
 
+	def run_line(self, line):
+		# dispatch one line of input to the main or the editing commands, returns False if the command failed
+		line = line.rstrip()
+		if len(line) == 0:
+			return True
+		self._poll_watcher()
+		args = line.split()
+		if self.editing != None:
+			cmds = self.get_edit_cmds()
+			context = self.editing
+		else:
+			cmds = self.get_cmds()
+			context = ()
+
+		ok = False
+		try:
+			func = cmds.get(args[0], None)
+			if func == None:
+				print('The input \'{}\' is not a valid command. Please try again, or type \'help\' to see the available commands. Commands are case-sensitive.'.format(args[0]))
+			else:
+				# edit mode commands are timed as edit.<cmd>
+				name = args[0] if self.editing == None else 'edit.' + args[0]
+				with STATS.timed(name), self._profiled(name), self._versioned(name, line):
+					# commands return False when they only printed why they couldn't run
+					ok = func(*context, args[1:]) is not False
+		except PokeDexFull:
+			print('The PokeDex is full!. Cannot add new pokemon.')
+		except PokeDexEmpty:
+			print('The PokeDex is empty!')
+		except PokeDexOutOfRange:
+			print('The pokemon number is not in the range 1 - {}'.format(self.pokedex.get_max_num()))
+		except PokeDexHasEntryName:
+			print('An entry already exists with that name. Delete the conflicting entry before trying again.')
+		except PokeDexHasEntryNum:
+			print('An entry already exists with that number. Delete the conflicting entry before trying again.')
+		except PokeDexBadMax:
+			print('The new max number is either not positive or less than the current PokeDex size of {}.'.format(len(self.pokedex)))
+		except PokeDexUnsupported:
+			print('That command is not supported by the {} backend.'.format(type(self.pokedex).__name__))
+		except PokeDexBadQuery as e:
+			print('Bad query. {}'.format(e))
+		except Exception as e:
+		# 	print('Main Exception')
+		# 	print(e)
+			print('Oops! Something went wrong. Please try again.')
+
+		if self.editing != None and self.edit_exit:
+			self._finish_edit()
+		return ok
+
 	def run(self):
-		cmds = self.get_cmds()
 		while(True):
+			if self.main_exit:
+				break
 			try:
-				if self.main_exit:
-					break
-				line = input('>> ').rstrip()
-				if len(line) == 0:
-					continue
-				args = line.split()
-				func = cmds.get(args[0], None)
-				if func == None:
-					print('The input \'{}\' is not a valid command. Please try again, or type \'help\' to see the available commands. Commands are case-sensitive.'.format(args[0]))
-				else:
-					func(args[1:])
-			except PokeDexFull:
-				print('The PokeDex is full!. Cannot add new pokemon.')
-			except PokeDexEmpty:
-				print('The PokeDex is empty!')
-			except PokeDexOutOfRange:
-				print('The pokemon number is not in the range 1 - {}'.format(self.pokedex.get_max_num()))
-			except PokeDexHasEntryName:
-				print('An entry already exists with that name. Delete the conflicting entry before trying again.')
-			except PokeDexHasEntryNum:
-				print('An entry already exists with that number. Delete the conflicting entry before trying again.')
-			except PokeDexBadMax:
-				print('The new max number is either not positive or less than the current PokeDex size of {}.'.format(len(self.pokedex)))
-			except Exception as e:
-			# 	print('Main Exception')
-			# 	print(e)
-				print('Oops! Something went wrong. Please try again.')
+				line = input('*>> ' if self.editing != None else '>> ')
+			except EOFError:
+				break
+			self.run_line(line)
 		print('Shutting Down the Pokedex')
 
+	# Scripts run every line through run_line without prompting. Output is collected per command and written out in
+	# large chunks, as plain text or as one JSON object per command. Returns how many commands failed.
+	def run_script(self, lines, json_output=False, out=None, flush_every=1 << 16):
+		out = sys.stdout if out == None else out
+		self.interactive = False
+		pending = []
+		size = 0
+		failed = 0
+		for line in lines:
+			if self.main_exit:
+				break
+			line = line.rstrip()
+			if len(line) == 0 or line.startswith('#'):
+				continue
+			buf = io.StringIO()
+			with contextlib.redirect_stdout(buf):
+				ok = self.run_line(line)
+			if not ok:
+				failed += 1
+			if json_output:
+				text = json.dumps({'cmd': line, 'ok': ok, 'output': buf.getvalue().splitlines()}) + '\n'
+			else:
+				text = buf.getvalue()
+			pending.append(text)
+			size += len(text)
+			if size >= flush_every:
+				out.write(''.join(pending))
+				pending = []
+				size = 0
+		out.write(''.join(pending))
+		out.flush()
+		return failed
+
+def parse_args(args):
+	parser = argparse.ArgumentParser(description='Interactive PokeDex.')
+	parser.add_argument('filename', nargs='?', help='dex to open, without the extension unless it is a .jsonl (or .ndjson), optionally .gz or .xz (default: national)')
+	parser.add_argument('max_num', nargs='?', type=int, help='create a new dex of this size instead of opening one')
+	parser.add_argument('--binary', action='store_true', help='open the memory-mapped .pdx snapshot instead of the .csv')
+	parser.add_argument('--columnar', action='store_true', help='keep the dex in compact typed arrays instead of one object per entry')
+	parser.add_argument('--workers', type=int, default=1, help='parse the .csv with up to this many processes, no more than there are cpus and only for a large .csv (default: 1)')
+	parser.add_argument('--script', metavar='FILE', help='run the commands in FILE (- for stdin) without prompting, then exit (with status 1 if any of them failed)')
+	parser.add_argument('--json', action='store_true', help='with --script, print one JSON object per command')
+	parser.add_argument('--profile', metavar='CMDS', default='', help='comma separated commands to run under cProfile, e.g. write,edit.save')
+	parser.add_argument('--check', action='store_const', const='check', help='check the dex for broken entries and evolution chains once it is loaded')
+	parser.add_argument('--repair', action='store_const', const='repair', dest='check', help='check the dex once it is loaded and fix what is found')
+	parser.add_argument('--stats-file', metavar='FILE', help='write the command latency stats to FILE as JSON on exit, otherwise an interactive session only prints a one line summary of them')
+	parser.add_argument('--convert', nargs=2, metavar=('SRC', 'DST'), help='stream a dex from SRC to DST and exit, each a .csv or .jsonl (or .ndjson), optionally .gz or .xz compressed')
+	parser.add_argument('--no-cache', action='store_false', dest='cache', help='parse the .csv even if its .csv.cache is up to date, and don\'t write one')
+	parser.add_argument('--startup-time', action='store_true', help='report how long loading took, warm from the cache or cold from the .csv')
+	parser.add_argument('--watch', nargs='?', type=float, const=WATCH_INTERVAL, metavar='SECONDS', help='check the .csv for changes made by other programs every SECONDS (default: {:g}) and reload the rows that changed'.format(WATCH_INTERVAL))
+	opts = parser.parse_args(args)
+
+	# opening 'name.pdx' is the same as passing --binary
+	if opts.filename != None and opts.filename.endswith('.pdx'):
+		opts.filename = opts.filename[:-4]
+		opts.binary = True
+	return opts
+
 def main(args):
-	if len(args) == 0:
-		print('No parameters supplied. Defaulting to the national dex.')
-		loop = MainLoop()
-	elif len(args) == 1:
-		print('Opening the {} dex'.format(args[0]))
-		loop = MainLoop(filename=args[0])
-	elif len(args) == 2:
-		print('Creating a new dex with the name {} and size {}'.format(args[0], args[1]))
-		loop = MainLoop(filename=args[0], max_num=int(args[1]), new=True)
-	loop.run()
+	opts = parse_args(args)
+	if opts.convert != None:
+		start = time.perf_counter()
+		count = convert(*opts.convert)
+		print('Converted {} entries from {} to {} in {:.2f}s'.format(count, opts.convert[0], opts.convert[1], time.perf_counter() - start))
+		return
+	profile = [cmd for cmd in opts.profile.split(',') if len(cmd) > 0]
+	# keep stdout clean for the script output
+	with contextlib.redirect_stdout(sys.stderr if opts.script != None else sys.stdout):
+		if opts.filename == None:
+			print('No parameters supplied. Defaulting to the national dex.')
+			loop = MainLoop(binary=opts.binary, columnar=opts.columnar, profile=profile, workers=opts.workers, check=opts.check, cache=opts.cache, startup_time=opts.startup_time, watch=opts.watch)
+		elif opts.max_num == None:
+			print('Opening the {} dex'.format(opts.filename))
+			loop = MainLoop(filename=opts.filename, binary=opts.binary, columnar=opts.columnar, profile=profile, workers=opts.workers, check=opts.check, cache=opts.cache, startup_time=opts.startup_time, watch=opts.watch)
+		else:
+			print('Creating a new dex with the name {} and size {}'.format(opts.filename, opts.max_num))
+			loop = MainLoop(filename=opts.filename, max_num=opts.max_num, new=True, binary=opts.binary, columnar=opts.columnar, profile=profile, workers=opts.workers, check=opts.check, cache=opts.cache, startup_time=opts.startup_time, watch=opts.watch)
+
+	failed = 0
+	if opts.script == None:
+		loop.run()
+	elif opts.script == '-':
+		failed = loop.run_script(sys.stdin, json_output=opts.json)
+	else:
+		with open(opts.script, 'r') as f:
+			failed = loop.run_script(f, json_output=opts.json)
+	if opts.stats_file != None:
+		loop.dump_stats(opts.stats_file)
+	elif opts.script == None:
+		loop.print_stats_summary()
+	# a script with failed commands exits with 1
+	return 1 if failed > 0 else 0
 
 if __name__ == '__main__':
-	main(sys.argv[1:])
\ No newline at end of file
+	sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,227 @@
+import sys, json, shutil, argparse, tempfile
+
+from poke_dict import file_records, write_jsonl, write_csv_records, is_jsonl, atomic_open, file_line_terminator
+
+# Compares and merges dex files (.csv or .jsonl, optionally .gz or .xz) sorted by num, as PokeDex.write() leaves them.
+# The files are read side by side one row at a time, a merge join on num, so memory use doesn't grow with the dex.
+#   python poke_diff.py diff national-backup.csv national.csv
+#   python poke_diff.py diff old.csv new.csv --patch changes.patch
+#   python poke_diff.py merge base.csv ours.csv theirs.csv merged.csv
+# A patch is a list of journal records (see PokeDexJournal) that turns the first dex into the second, and is applied to
+# a loaded dex with 'patch <file>' in poke_dict.py.
+
+FIELDS = ('name', 'type1', 'type2', 'evo_from', 'evo_to')
+# the name a renamed entry holds while a patch is applied, see PatchWriter
+RENAMING = '~renaming {}'
+
+class UnsortedDex(ValueError):
+	def __init__(self, filename, num):
+		super().__init__('{} is not sorted by num at {}. Write it out with poke_dict.py first.'.format(filename, num))
+
+def _sorted_records(filename):
+	# the header and the entries of a dex file, checking the nums only go up
+	records = file_records(filename)
+	yield next(records)
+	last = 0
+	for rec in records:
+		if rec['num'] <= last:
+			raise UnsortedDex(filename, rec['num'])
+		last = rec['num']
+		yield rec
+
+def _joined(*streams):
+	# (num, [entry or None from each stream]) for every num in any of the streams, in num order
+	heads = [next(stream, None) for stream in streams]
+	while True:
+		nums = [head['num'] for head in heads if head != None]
+		if len(nums) == 0:
+			return
+		num = min(nums)
+		row = []
+		for i, head in enumerate(heads):
+			if head != None and head['num'] == num:
+				row.append(head)
+				heads[i] = next(streams[i], None)
+			else:
+				row.append(None)
+		yield num, row
+
+def _types(rec):
+	return '{}/{}'.format(rec['type1'], rec['type2'])
+
+def _changes(old, new):
+	# 'field old -> new' for each field that differs
+	return ['{} {} -> {}'.format(field, old[field], new[field]) for field in FIELDS if old[field] != new[field]]
+
+## Diff
+class PatchWriter:
+	# Patch records come out of the merge join in num order, but have to be applied in phases: links are dropped before
+	# the entries they name are deleted, and entries exist before links are made to them. Renamed entries first move to
+	# a temporary name, so an entry can take a name that another one only gives up later in the patch. Each phase is
+	# spooled to its own temporary file, and the files are joined once the diff is done.
+	PHASES = ('grow', 'unlink', 'delete', 'rename', 'change', 'link', 'shrink')
+
+	def __init__(self, outname):
+		self.outname = outname
+		self.phases = {phase: tempfile.TemporaryFile('w+') for phase in self.PHASES}
+		self.count = 0
+
+	def record(self, phase, *rec):
+		self.phases[phase].write(json.dumps(list(rec)) + '\n')
+		self.count += 1
+
+	def close(self):
+		with atomic_open(self.outname, 'w') as f:
+			for phase in self.PHASES:
+				spool = self.phases[phase]
+				spool.seek(0)
+				shutil.copyfileobj(spool, f)
+				spool.close()
+
+def diff(old_name, new_name, out=None, patch=None):
+	# report how new_name differs from old_name to out, stdout by default, and write a patch from one to the other if
+	# patch names a file. Returns the counts of added, removed and changed entries.
+	# stdout is looked up per call rather than bound as the default, so redirect_stdout() catches the report
+	if out == None:
+		out = sys.stdout
+	old = _sorted_records(old_name)
+	new = _sorted_records(new_name)
+	writer = None if patch == None else PatchWriter(patch)
+	old_max = next(old)['max_num']
+	new_max = next(new)['max_num']
+	if old_max != new_max:
+		out.write('max_num {} -> {}\n'.format(old_max, new_max))
+		if writer != None:
+			writer.record('grow' if new_max > old_max else 'shrink', 'setmax', new_max)
+
+	added = removed = changed = 0
+	for num, (a, b) in _joined(old, new):
+		if a == None:
+			out.write('+ {} {} {} evo_from {} evo_to {}\n'.format(num, b['name'], _types(b), b['evo_from'], b['evo_to']))
+			added += 1
+			if writer != None:
+				writer.record('change', 'add', num, b['name'], b['type1'], b['type2'])
+				for evo in b['evo_to']:
+					writer.record('link', 'link', num, evo)
+		elif b == None:
+			out.write('- {} {}\n'.format(num, a['name']))
+			removed += 1
+			if writer != None:
+				writer.record('delete', 'delete', num)
+		elif a != b:
+			out.write('~ {} {}: {}\n'.format(num, b['name'], '; '.join(_changes(a, b))))
+			changed += 1
+			if writer != None:
+				if a['name'] != b['name']:
+					writer.record('rename', 'edit', num, num, RENAMING.format(num), a['type1'], a['type2'])
+				if (a['name'], a['type1'], a['type2']) != (b['name'], b['type1'], b['type2']):
+					writer.record('change', 'edit', num, num, b['name'], b['type1'], b['type2'])
+				# a link is made and dropped from its prior evolution's side only, evo_from follows from those
+				for evo in a['evo_to']:
+					if evo not in b['evo_to']:
+						writer.record('unlink', 'unlink', num, evo)
+				for evo in b['evo_to']:
+					if evo not in a['evo_to']:
+						writer.record('link', 'link', num, evo)
+
+	if writer != None:
+		writer.close()
+		out.write('Wrote {} changes to {}\n'.format(writer.count, patch))
+	out.write('{} added, {} removed, {} changed\n'.format(added, removed, changed))
+	return added, removed, changed
+
+## Merge
+def _merge_field(field, base, ours, theirs):
+	# (value, conflict) of one field, taking whichever side changed it from base
+	if ours[field] == theirs[field] or theirs[field] == base[field]:
+		return ours[field], False
+	if ours[field] == base[field]:
+		return theirs[field], False
+	return ours[field], True
+
+def _merged(base, ours, theirs, out, conflicts):
+	# the three-way merge of three record streams, as one record stream. Conflicting changes keep ours and are reported.
+	base_max = next(base)['max_num']
+	ours_max = next(ours)['max_num']
+	theirs_max = next(theirs)['max_num']
+	if ours_max == base_max:
+		yield {'max_num': theirs_max}
+	elif theirs_max == base_max or theirs_max == ours_max:
+		yield {'max_num': ours_max}
+	else:
+		# both changed it, the larger still fits everything
+		out.write('conflict max_num: ours {}, theirs {}, keeping {}\n'.format(ours_max, theirs_max, max(ours_max, theirs_max)))
+		conflicts.append('max_num')
+		yield {'max_num': max(ours_max, theirs_max)}
+
+	for num, (b, o, t) in _joined(base, ours, theirs):
+		if o == t:
+			rec = o
+		elif o == b:
+			rec = t
+		elif t == b:
+			rec = o
+		elif o == None or t == None:
+			# deleted on one side and changed on the other, the changed entry stays
+			rec = o if o != None else t
+			out.write('conflict {}: {} on one side and changed on the other, keeping the change\n'.format(num, 'deleted' if b != None else 'missing'))
+			conflicts.append(num)
+		else:
+			# changed on both sides, or added on both, field by field
+			start = b if b != None else {field: None for field in FIELDS}
+			rec = {'num': num}
+			clashes = []
+			for field in FIELDS:
+				rec[field], clash = _merge_field(field, start, o, t)
+				if clash:
+					clashes.append('{} ours {}, theirs {}'.format(field, o[field], t[field]))
+			if len(clashes) > 0:
+				out.write('conflict {} {}: {}\n'.format(num, rec['name'], '; '.join(clashes)))
+				conflicts.append(num)
+		if rec != None:
+			yield rec
+
+def merge(base_name, ours_name, theirs_name, outname, out=None):
+	# write the changes made from base_name to both ours_name and theirs_name into outname, returns the conflicts.
+	# The report goes to out, stdout by default.
+	if out == None:
+		out = sys.stdout
+	conflicts = []
+	records = _merged(_sorted_records(base_name), _sorted_records(ours_name), _sorted_records(theirs_name), out, conflicts)
+	if is_jsonl(outname):
+		count = write_jsonl(outname, records)
+	else:
+		# line breaks follow ours, like the rows that mostly come from it
+		count = write_csv_records(outname, records, '\r\n' if is_jsonl(ours_name) else file_line_terminator(ours_name))
+	out.write('Wrote {} entries to {} with {} conflicts\n'.format(count, outname, len(conflicts)))
+	if len(conflicts) > 0:
+		# ours was kept field by field, so the evolution links of the result may disagree with each other
+		out.write('Run \'check\' on the merged dex to find any evolution links left one-sided by the conflicts.\n')
+	return conflicts
+
+def main(args):
+	parser = argparse.ArgumentParser(description='Compare or merge dex files sorted by num, without loading them.')
+	sub = parser.add_subparsers(dest='mode', required=True)
+	compare = sub.add_parser('diff', help='list the entries added, removed and changed from one dex to another')
+	compare.add_argument('old', help='dex file to compare from (.csv or .jsonl, optionally .gz or .xz)')
+	compare.add_argument('new', help='dex file to compare to')
+	compare.add_argument('--patch', metavar='OUT', help='also write the changes as a patch for the \'patch\' command')
+	combine = sub.add_parser('merge', help='combine the changes two dexes made to a common base')
+	combine.add_argument('base', help='the dex both sides started from')
+	combine.add_argument('ours', help='one changed dex, which wins conflicts')
+	combine.add_argument('theirs', help='the other changed dex')
+	combine.add_argument('out', help='file to write the merged dex to')
+	opts = parser.parse_args(args)
+
+	try:
+		if opts.mode == 'diff':
+			diff(opts.old, opts.new, patch=opts.patch)
+		else:
+			merge(opts.base, opts.ours, opts.theirs, opts.out)
+	except UnsortedDex as e:
+		print(e)
+		return 1
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,257 @@
+import sys, json, time, random, asyncio, argparse
+from string import digits
+
+from poke_dict import PokeDex, ColumnarPokeDex, Pokemon, TypeEnum, PokeDexError, pokemon_record, atomic_open
+
+# Line-delimited JSON protocol. Each request is one line like
+#   {"id": 7, "cmd": "find", "args": ["pikachu"]}
+# and is answered by one line
+#   {"id": 7, "ok": true, "result": {...}}    or    {"id": 7, "ok": false, "error": "PokeDexHasEntryNum"}
+# Requests on one connection are answered in order.
+
+READ_CMDS = ('find', 'evos', 'list', 'getsize', 'getmax', 'filter', 'search', 'query', 'matchup')
+WRITE_CMDS = ('add', 'delete', 'link', 'unlink', 'setmax', 'write')
+
+def _write_chunks(outname, chunks, loop):
+	# runs in a worker thread and pulls each chunk off the async generator chunks on loop only once the last one is
+	# written, so a save holds one chunk at a time however big the dex is
+	async def pull():
+		try:
+			return await chunks.__anext__()
+		except StopAsyncIteration:
+			return None
+	with atomic_open(outname) as f:
+		while True:
+			chunk = asyncio.run_coroutine_threadsafe(pull(), loop).result()
+			if chunk == None:
+				break
+			f.write(chunk)
+
+def _query(arg):
+	# same rule as MainLoop: all digits is a num, anything else a name
+	for ch in arg:
+		if ch not in digits:
+			return arg
+	return int(arg)
+
+def _type(arg):
+	# a type by name in any case, so a typo is reported rather than answered with a bare KeyError
+	if arg.upper() not in TypeEnum.__members__:
+		raise ValueError('{} is not a type.'.format(arg))
+	return TypeEnum[arg.upper()]
+
+class PokeDexServer:
+	# Reads run straight on the event loop. Mutations take one asyncio lock so they apply one at a time. A write to disk
+	# serializes a snapshot of the dex a few thousand rows at a time between other requests, so both readers and
+	# mutations keep being served during long saves, and only the file io runs in a worker thread. The columnar backend
+	# has no snapshots, so there the write runs in a worker thread while holding the lock.
+	def __init__(self, pokedex, filename):
+		self.pokedex = pokedex
+		self.filename = filename
+		self.mutation_lock = asyncio.Lock()
+		self.served = 0
+		# entries are decoded on lookup in a lazily mapped dex, which must not race with a write thread
+		self.pokedex.materialize()
+
+	def _find(self, arg):
+		pokemon = self.pokedex.find(_query(arg))
+		if pokemon == None:
+			raise LookupError('{} was not found in the PokeDex.'.format(arg))
+		return pokemon
+
+	def read(self, cmd, args):
+		if cmd == 'find':
+			return pokemon_record(self._find(args[0]))
+		elif cmd == 'evos':
+			return [{'num': mon.get_num(), 'name': mon.get_name(), 'depth': depth} for mon, depth in self.pokedex.evo_family(self._find(args[0]))]
+		elif cmd == 'list':
+			# [num, name] per entry, and with 'all' also [lo, hi] for each run of missing nums
+			fltr = args[0] if len(args) > 0 else 'known'
+			if fltr not in ('all', 'known'):
+				raise ValueError('Bad <filter> supplied. <filter> can be \'all\'|\'known\'')
+			result = []
+			expected = 1
+			for mon in self.pokedex.iter_range(1, self.pokedex.get_max_num()):
+				if fltr == 'all' and mon.get_num() > expected:
+					result.append([expected, mon.get_num()-1])
+				result.append([mon.get_num(), mon.get_name()])
+				expected = mon.get_num() + 1
+			if fltr == 'all' and expected <= self.pokedex.get_max_num():
+				result.append([expected, self.pokedex.get_max_num()])
+			return result
+		elif cmd == 'getsize':
+			return len(self.pokedex)
+		elif cmd == 'getmax':
+			return self.pokedex.get_max_num()
+		elif cmd == 'filter':
+			return [[mon.get_num(), mon.get_name()] for mon in self.pokedex.by_types(*[_type(arg) for arg in args])]
+		elif cmd == 'search':
+			fuzzy = len(args) == 2 and args[0] == 'fuzzy'
+			return [[mon.get_num(), mon.get_name()] for mon in self.pokedex.search(args[-1], fuzzy=fuzzy)]
+		elif cmd == 'query':
+			return [[mon.get_num(), mon.get_name()] for mon in self.pokedex.query(' '.join(args))]
+		elif cmd == 'matchup':
+			# [multiplier, [[num, name], ...]] from the best resisted to the most effective
+			groups = self.pokedex.effectiveness(*[_type(arg) for arg in args])
+			return [[multiplier, [[mon.get_num(), mon.get_name()] for mon in self.pokedex.in_mask(mask)]] for multiplier, mask in groups]
+
+	async def _snapshot_chunks(self):
+		with self.pokedex.snapshot() as snapshot:
+			for chunk in snapshot.csv_chunks():
+				yield chunk
+
+	async def save(self, outname):
+		# each chunk is serialized on the loop when the writer thread asks for it, so other requests are served between
+		# chunks
+		loop = asyncio.get_running_loop()
+		chunks = self._snapshot_chunks()
+		try:
+			await loop.run_in_executor(None, _write_chunks, outname + '.csv', chunks, loop)
+		finally:
+			# releases the snapshot if the write failed part way through
+			await chunks.aclose()
+		return outname
+
+	async def write(self, cmd, args):
+		if cmd == 'write' and isinstance(self.pokedex, PokeDex):
+			return await self.save(args[0] if len(args) > 0 else self.filename)
+		async with self.mutation_lock:
+			if cmd == 'add':
+				opts = {}
+				if len(args) > 2:
+					opts['type1'] = _type(args[2])
+				if len(args) > 3:
+					opts['type2'] = _type(args[3])
+				self.pokedex.add(Pokemon(int(args[0]), args[1], **opts))
+				return pokemon_record(self.pokedex.find(int(args[0])))
+			elif cmd == 'delete':
+				self.pokedex.delete(self._find(args[0]))
+				return None
+			elif cmd == 'link':
+				self._find(args[0]).set_evo_to(self._find(args[1]))
+				return None
+			elif cmd == 'unlink':
+				self._find(args[0]).del_evo_to(self._find(args[1]))
+				return None
+			elif cmd == 'setmax':
+				self.pokedex.set_max_num(int(args[0]))
+				return self.pokedex.get_max_num()
+			elif cmd == 'write':
+				outname = args[0] if len(args) > 0 else self.filename
+				await asyncio.get_running_loop().run_in_executor(None, self.pokedex.write, outname)
+				return outname
+
+	async def handle(self, request):
+		response = {'id': request.get('id') if isinstance(request, dict) else None}
+		try:
+			# any JSON value parses, but only an object with a list of args is a request
+			if not isinstance(request, dict) or not isinstance(request.get('args', []), list):
+				raise ValueError('Bad request, expected an object with a cmd and a list of args.')
+			cmd = request.get('cmd')
+			args = [str(arg) for arg in request.get('args', [])]
+			if cmd in READ_CMDS:
+				result = self.read(cmd, args)
+			elif cmd in WRITE_CMDS:
+				result = await self.write(cmd, args)
+			else:
+				raise ValueError('The input \'{}\' is not a valid command.'.format(cmd))
+			response['ok'] = True
+			response['result'] = result
+		except PokeDexError as e:
+			response['ok'] = False
+			response['error'] = type(e).__name__
+		except (LookupError, ValueError, IndexError) as e:
+			response['ok'] = False
+			response['error'] = str(e)
+		except Exception as e:
+			# anything else is a bug, but only this request fails and the connection stays open
+			response['ok'] = False
+			response['error'] = 'Internal error, {}: {}'.format(type(e).__name__, e)
+		self.served += 1
+		return response
+
+	async def client_connected(self, reader, writer):
+		try:
+			while True:
+				line = await reader.readline()
+				if len(line) == 0:
+					break
+				try:
+					request = json.loads(line)
+				except ValueError:
+					response = {'ok': False, 'error': 'Bad request, expected one JSON object per line.'}
+				else:
+					response = await self.handle(request)
+				writer.write(json.dumps(response).encode('utf-8') + b'\n')
+				await writer.drain()
+		except ConnectionError:
+			pass
+		finally:
+			writer.close()
+
+	async def serve(self, host='127.0.0.1', port=8765, unix=None):
+		if unix != None:
+			server = await asyncio.start_unix_server(self.client_connected, path=unix)
+			print('Serving {} on {}'.format(self.filename, unix))
+		else:
+			server = await asyncio.start_server(self.client_connected, host, port)
+			print('Serving {} on {}:{}'.format(self.filename, host, port))
+		async with server:
+			await server.serve_forever()
+
+## Load generator
+async def _client(host, port, unix, requests, queries, latencies):
+	if unix != None:
+		reader, writer = await asyncio.open_unix_connection(unix)
+	else:
+		reader, writer = await asyncio.open_connection(host, port)
+	for i in range(requests):
+		line = json.dumps({'id': i, 'cmd': random.choice(('find', 'find', 'evos', 'getsize')), 'args': [random.choice(queries)]}).encode('utf-8') + b'\n'
+		start = time.perf_counter()
+		writer.write(line)
+		await writer.drain()
+		await reader.readline()
+		latencies.append(time.perf_counter() - start)
+	writer.close()
+	await writer.wait_closed()
+
+async def loadgen(host='127.0.0.1', port=8765, unix=None, clients=32, requests=1000, max_num=428):
+	# each client sends its requests one after another, all clients at once
+	queries = [str(num) for num in range(1, max_num+1)]
+	latencies = []
+	start = time.perf_counter()
+	await asyncio.gather(*[_client(host, port, unix, requests, queries, latencies) for _ in range(clients)])
+	elapsed = time.perf_counter() - start
+	latencies.sort()
+	print('{} requests from {} clients in {:.2f}s'.format(len(latencies), clients, elapsed))
+	print('{:.0f} requests/s, p50 {:.3f}ms, p99 {:.3f}ms, max {:.3f}ms'.format(len(latencies) / elapsed, latencies[len(latencies)//2] * 1e3, latencies[int(len(latencies)*0.99)] * 1e3, latencies[-1] * 1e3))
+
+def main(args):
+	parser = argparse.ArgumentParser(description='Serve a PokeDex to local clients, or load test a running server.')
+	sub = parser.add_subparsers(dest='mode', required=True)
+	serve = sub.add_parser('serve', help='load a dex and answer requests')
+	serve.add_argument('filename', nargs='?', default='national', help='dex to open, without the extension (default: national)')
+	serve.add_argument('--binary', action='store_true', help='open the .pdx snapshot instead of the .csv')
+	serve.add_argument('--columnar', action='store_true', help='keep the dex in compact typed arrays')
+	bench = sub.add_parser('loadgen', help='measure requests per second and latency of a running server')
+	bench.add_argument('--clients', type=int, default=32)
+	bench.add_argument('--requests', type=int, default=1000, help='requests per client')
+	bench.add_argument('--max-num', type=int, default=428, help='query nums from 1 to this')
+	for p in (serve, bench):
+		p.add_argument('--host', default='127.0.0.1')
+		p.add_argument('--port', type=int, default=8765)
+		p.add_argument('--unix', metavar='PATH', help='use a unix socket instead of TCP')
+	opts = parser.parse_args(args)
+
+	if opts.mode == 'serve':
+		backend = ColumnarPokeDex if opts.columnar else PokeDex
+		server = PokeDexServer(backend(opts.filename, 0, False, opts.binary), opts.filename)
+		try:
+			asyncio.run(server.serve(opts.host, opts.port, opts.unix))
+		except KeyboardInterrupt:
+			print('Shutting Down the Server')
+	else:
+		asyncio.run(loadgen(opts.host, opts.port, opts.unix, opts.clients, opts.requests, opts.max_num))
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
@@ -0,0 +1,711 @@
+import os, shutil, io, json, asyncio, random, threading, time, hashlib
+
+import pytest
+
+from poke_dict import PokeDex, Pokemon, TypeEnum, ColumnarPokeDex, MainLoop, LatencyStats, STATS, PokeDexHasEntryNum, ReadWriteLock, PokeDexBadQuery, PokeDexBadType, type_multiplier, PokeDexBadFile, convert, csv_records, PokeDexWatcher, main
+from poke_server import PokeDexServer
+from poke_bench import generate
+from poke_diff import diff
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+@pytest.fixture
+def dex_name(tmp_path):
+	# a copy of the national dex to change, named without its extension like MainLoop takes it
+	shutil.copy(os.path.join(HERE, 'national.csv'), tmp_path / 'd.csv')
+	return str(tmp_path / 'd')
+
+def entries(dex):
+	# (num, name, type1, type2, evo_from, evo_to) of every entry, in num order
+	rows = []
+	for num in range(1, dex.get_max_num() + 1):
+		mon = dex.find(num)
+		if mon != None:
+			evo_from = mon.get_evo_from()
+			rows.append((num, mon.get_name(), mon.get_type1(), mon.get_type2(), None if evo_from == None else evo_from.get_num(), [evo.get_num() for evo in mon.get_evo_to()]))
+	return rows
+
+## Binary snapshots
+def test_binary_snapshot_round_trip(dex_name):
+	dex = PokeDex(dex_name, 0, False)
+	dex.write_binary(dex_name)
+	mapped = PokeDex(dex_name, 0, False, binary=True)
+	# entries are decoded from the mapping on lookup, by name as well as by num
+	assert mapped.find('Pikachu').get_num() == 25
+	assert entries(mapped) == entries(dex)
+	assert len(mapped) == len(dex)
+
+def test_binary_snapshot_can_be_changed(dex_name):
+	PokeDex(dex_name, 0, False).write_binary(dex_name)
+	mapped = PokeDex(dex_name, 0, False, binary=True)
+	mapped.add(Pokemon(500, 'Newmon', type1=TypeEnum.FIRE))
+	mapped.find(500).set_evo_to(mapped.find(4))
+	mapped.write_binary(dex_name)
+	again = PokeDex(dex_name, 0, False, binary=True)
+	assert again.find(4).get_evo_from().get_name() == 'Newmon'
+	assert entries(again) == entries(mapped)
+
+## Bulk loading
+def test_bulk_load_matches_row_by_row(dex_name):
+	rows = entries(PokeDex(dex_name, 0, False, bulk=False))
+	assert entries(PokeDex(dex_name, 0, False)) == rows
+
+## Columnar backend
+def test_columnar_matches_objects(dex_name):
+	assert entries(ColumnarPokeDex(dex_name, 0, False)) == entries(PokeDex(dex_name, 0, False))
+
+def test_columnar_changes_survive_a_write(dex_name):
+	dex = ColumnarPokeDex(dex_name, 0, False)
+	dex.add(Pokemon(500, 'Newmon', type1=TypeEnum.FIRE))
+	dex.find(500).set_evo_to(dex.find(1))
+	dex.update_name(dex.find(25), 'Pikachuu')
+	dex.update_num(dex.find(7), 501)
+	dex.delete(dex.find(10))
+	dex.write(dex_name)
+	assert entries(PokeDex(dex_name, 0, False)) == entries(dex)
+
+def test_columnar_delete_after_evolution_edits(dex_name):
+	dex = ColumnarPokeDex(dex_name, 0, False)
+	eevee = dex.find(133)
+	evos = [mon.get_num() for mon in eevee.get_evo_to()]
+	# unlinking and linking again moves the evolutions of eevee out of the packed table into a list of their own
+	eevee.del_evo_to(dex.find(134))
+	eevee.set_evo_to(dex.find(134))
+	dex.delete(eevee)
+	for num in evos:
+		assert dex.find(num).get_evo_from() == None
+	assert str(dex.find(135)) == '135 Jolteon'
+
+## Type index
+def test_by_types(dex_name):
+	dex = PokeDex(dex_name, 0, False)
+	rows = entries(dex)
+	assert [mon.get_num() for mon in dex.by_types(TypeEnum.FIRE)] == [row[0] for row in rows if TypeEnum.FIRE in row[2:4]]
+	assert [mon.get_num() for mon in dex.by_types(TypeEnum.FIRE, TypeEnum.FLYING)] == [row[0] for row in rows if set(row[2:4]) == {TypeEnum.FIRE, TypeEnum.FLYING}]
+	# kept up to date by edits
+	dex.update_types(dex.find(6), TypeEnum.WATER, TypeEnum.NONE)
+	dex.delete(dex.find(4))
+	dex.add(Pokemon(500, 'Newmon', type1=TypeEnum.FIRE))
+	fire = [mon.get_num() for mon in dex.by_types(TypeEnum.FIRE)]
+	assert 4 not in fire and 6 not in fire and 500 in fire
+
+## Evolution index
+def test_evo_index(dex_name):
+	dex = PokeDex(dex_name, 0, False)
+	bulbasaur, ivysaur, venusaur = dex.find(1), dex.find(2), dex.find(3)
+	assert dex.evo_root(venusaur) is bulbasaur and dex.evo_depth(venusaur) == 2
+	assert dex.is_ancestor(bulbasaur, venusaur) and not dex.is_ancestor(venusaur, bulbasaur)
+	assert [(mon.get_num(), depth) for mon, depth in dex.evo_family(ivysaur)] == [(1, 0), (2, 1), (3, 2)]
+	# kept up to date by unlink and link
+	ivysaur.del_evo_to(venusaur)
+	assert dex.evo_root(venusaur) is venusaur and dex.evo_depth(venusaur) == 0
+	assert not dex.is_ancestor(bulbasaur, venusaur)
+	ivysaur.set_evo_to(venusaur)
+	assert dex.evo_depth(venusaur) == 2 and dex.is_ancestor(bulbasaur, venusaur)
+
+def test_link_moves_an_entry_out_of_its_old_family(dex_name):
+	dex = PokeDex(dex_name, 0, False)
+	squirtle, wartortle, gardevoir = dex.find(7), dex.find(8), dex.find(282)
+	gardevoir.set_evo_to(wartortle)
+	assert wartortle.get_evo_from() is gardevoir and wartortle not in squirtle.get_evo_to()
+	assert dex.evo_root(wartortle) is dex.find(280) and dex.evo_depth(wartortle) == 3
+	assert dex.evo_depth(dex.find(9)) == 4
+	assert dex.evo_family(squirtle) == [(squirtle, 0)]
+	# and back, from the other end
+	wartortle.set_evo_from(squirtle)
+	assert gardevoir.get_evo_to() == [] and squirtle.get_evo_to() == [wartortle]
+	assert dex.evo_root(dex.find(9)) is squirtle and dex.evo_depth(dex.find(9)) == 2
+
+## Name search
+def distance(a, b):
+	# plain Levenshtein distance
+	prev = list(range(len(b) + 1))
+	for i, ch in enumerate(a, 1):
+		cur = [i]
+		for j, other in enumerate(b, 1):
+			cur.append(min(prev[j] + 1, cur[j-1] + 1, prev[j-1] + (ch != other)))
+		prev = cur
+	return prev[-1]
+
+def test_prefix_search(dex_name):
+	dex = PokeDex(dex_name, 0, False)
+	assert [mon.get_name() for mon in dex.search('char')] == ['Charizard', 'Charmander', 'Charmeleon']
+	assert [mon.get_name() for mon in dex.search('char', limit=1)] == ['Charizard']
+
+def test_fuzzy_search_finds_every_close_name(dex_name):
+	dex = PokeDex(dex_name, 0, False)
+	names = [row[1].lower() for row in entries(dex)]
+	for text, max_dist in (('pikchu', None), ('charmandr', None), ('bulbasaurr', None), ('mew', None), ('ab', None), ('eevee', 1), ('bulbsaur', 2), ('ab', 2)):
+		limit = 0 if len(text) < 3 else 1
+		limit = limit if max_dist == None else max_dist
+		found = [mon.get_name().lower() for mon in dex.search(text, fuzzy=True, max_dist=max_dist, limit=len(names))]
+		assert sorted(found) == sorted(name for name in names if distance(text, name) <= limit)
+		# closest first
+		assert [distance(text, name) for name in found] == sorted(distance(text, name) for name in found)
+	# kept up to date by edits
+	dex.update_name(dex.find(25), 'Pikachuu')
+	dex.add(Pokemon(500, 'Pikachoo'))
+	assert [mon.get_num() for mon in dex.search('pikachu', fuzzy=True)] == [25]
+
+## Script mode
+def run(filename, *lines):
+	# open filename like the command line does and run the lines as a script, returns the loop
+	loop = MainLoop(filename=filename)
+	loop.interactive = False
+	for line in lines:
+		loop.run_line(line)
+	return loop
+
+def test_script_json_output(dex_name):
+	loop = MainLoop(filename=dex_name)
+	out = io.StringIO()
+	failed = loop.run_script(['find 25', '# a comment', 'find Nomon', 'getsize', 'nocommand'], json_output=True, out=out)
+	results = [json.loads(line) for line in out.getvalue().splitlines()]
+	assert [result['cmd'] for result in results] == ['find 25', 'find Nomon', 'getsize', 'nocommand']
+	assert [result['ok'] for result in results] == [True, False, True, False]
+	assert results[2]['output'] == ['The current PokeDex size is 428.']
+	assert failed == 2
+
+def test_script_answers_prompts_with_yes(dex_name):
+	out = io.StringIO()
+	assert MainLoop(filename=dex_name).run_script(['delete 1', 'write'], out=out) == 0
+	assert MainLoop(filename=dex_name).pokedex.find(1) == None
+
+## Query server
+def test_server_answers_requests(dex_name):
+	server = PokeDexServer(PokeDex(dex_name, 0, False), dex_name)
+	requests = (
+		{'id': 1, 'cmd': 'find', 'args': ['pikachu']},
+		{'id': 2, 'cmd': 'add', 'args': [1, 'Dupe']},
+		{'id': 3, 'cmd': 'link', 'args': [1, 'Nomon']},
+		{'id': 4, 'cmd': 'nocommand', 'args': []},
+		['not', 'a', 'request'],
+		{'id': 5, 'cmd': 'getsize'},
+	)
+	async def send():
+		return [await server.handle(request) for request in requests]
+	found, added, linked, unknown, malformed, size = asyncio.run(send())
+	assert found['ok'] and found['result']['num'] == 25 and found['result']['evo_to'] == [26]
+	assert added == {'id': 2, 'ok': False, 'error': 'PokeDexHasEntryNum'}
+	assert linked == {'id': 3, 'ok': False, 'error': 'Nomon was not found in the PokeDex.'}
+	assert not unknown['ok'] and malformed['id'] == None and not malformed['ok']
+	assert size == {'id': 5, 'ok': True, 'result': 428}
+
+def test_server_save_streams_the_snapshot_to_disk(dex_name):
+	server = PokeDexServer(PokeDex(dex_name, 0, False), dex_name)
+	async def send():
+		return await server.handle({'id': 1, 'cmd': 'write', 'args': [dex_name + '_saved']})
+	assert asyncio.run(send()) == {'id': 1, 'ok': True, 'result': dex_name + '_saved'}
+	assert len(server.pokedex._snapshots) == 0
+	assert entries(PokeDex(dex_name + '_saved', 0, False)) == entries(server.pokedex)
+	# a failed write still releases its snapshot
+	async def fail():
+		return await server.handle({'id': 2, 'cmd': 'write', 'args': [os.path.join(dex_name, 'nodir', 'saved')]})
+	assert not asyncio.run(fail())['ok']
+	assert len(server.pokedex._snapshots) == 0
+
+## Journal
+def test_journal_replay(dex_name):
+	run(dex_name, 'add 500 Newmon FIRE', 'delete 3', 'link 500 4', 'write')
+	assert os.path.exists(dex_name + '.csv.journal')
+	loop = run(dex_name)
+	assert loop.pokedex.find(500).get_name() == 'Newmon'
+	assert loop.pokedex.find(3) == None
+	assert loop.pokedex.find(4).get_evo_from() is loop.pokedex.find(500)
+	assert loop.journal.committed == 3
+
+def test_journal_torn_tail(dex_name):
+	run(dex_name, 'add 500 Aaa', 'write')
+	# a crash part way through appending the next record
+	with open(dex_name + '.csv.journal', 'a') as f:
+		f.write('["add", 501, "Bb')
+	run(dex_name, 'add 502 Ccc', 'write')
+	loop = run(dex_name)
+	assert loop.pokedex.find(500) != None
+	assert loop.pokedex.find(501) == None
+	assert loop.pokedex.find(502) != None
+	assert loop.journal.committed == 2
+
+def test_compact_folds_the_journal(dex_name):
+	run(dex_name, 'delete 3', 'compact')
+	assert not os.path.exists(dex_name + '.csv.journal')
+	assert run(dex_name).pokedex.find(3) == None
+
+## Incremental writes
+def test_write_copies_unchanged_rows(dex_name):
+	with open(dex_name + '.csv', 'rb') as f:
+		before = f.read().splitlines(keepends=True)
+	dex = PokeDex(dex_name, 0, False)
+	dex.update_name(dex.find(25), 'Pikachuu')
+	dex.write(dex_name)
+	with open(dex_name + '.csv', 'rb') as f:
+		after = f.read().splitlines(keepends=True)
+	assert len(after) == len(before)
+	changed = [i for i in range(len(before)) if before[i] != after[i]]
+	assert len(changed) == 1 and after[changed[0]].startswith(b'25,Pikachuu,')
+
+def test_write_keeps_the_line_breaks(dex_name):
+	with open(dex_name + '.csv', 'rb') as f:
+		data = f.read()
+	with open(dex_name + '.csv', 'wb') as f:
+		f.write(data.replace(b'\n', b'\r\n'))
+	dex = PokeDex(dex_name, 0, False)
+	dex.update_name(dex.find(25), 'Pikachuu')
+	dex.add(Pokemon(500, 'Newmon'))
+	dex.write(dex_name)
+	with open(dex_name + '.csv', 'rb') as f:
+		lines = f.read().splitlines(keepends=True)
+	assert len(lines) == 430 and all(line.endswith(b'\r\n') for line in lines)
+	assert entries(PokeDex(dex_name, 0, False)) == entries(dex)
+
+## Number index and paging
+def test_iter_range(dex_name):
+	dex = PokeDex(dex_name, 0, False)
+	dex.delete(dex.find(5))
+	assert [mon.get_num() for mon in dex.iter_range(3, 8)] == [3, 4, 6, 7, 8]
+	dex.add(Pokemon(500, 'Newmon'))
+	dex.update_num(dex.find(4), 5)
+	assert [mon.get_num() for mon in dex.iter_range(3, 6)] == [3, 5, 6]
+	assert [mon.get_num() for mon in dex.iter_range(420)] == list(range(420, 429)) + [500]
+
+def test_list_pages(dex_name, capsys):
+	loop = run(dex_name, 'delete 5')
+	capsys.readouterr()
+	loop.run_line('list all --from 3 --to 8')
+	assert capsys.readouterr().out.splitlines() == ['3 Venusaur', '4 Charmander', '5 UNKNOWN/UNSEEN', '6 Charizard', '7 Squirtle', '8 Wartortle']
+	loop.run_line('list known --page 2')
+	lines = capsys.readouterr().out.splitlines()
+	assert len(lines) == 50 and lines[0] == '52 Meowth'
+
+## Benchmarks
+def test_generated_dex_is_consistent(tmp_path):
+	name = str(tmp_path / 'synthetic')
+	generate(name, 2000, seed=1)
+	dex = PokeDex(name, 0, False)
+	assert len(dex) == 2000
+	for num in range(1, 2001):
+		mon = dex.find(num)
+		assert all(evo.get_evo_from() is mon for evo in mon.get_evo_to())
+		assert mon.get_evo_from() == None or mon in mon.get_evo_from().get_evo_to()
+
+## Latency stats
+def test_stats_percentiles():
+	stats = LatencyStats()
+	for ms in range(1, 101):
+		stats.record('cmd', ms / 1000)
+	summary = stats.summary()['cmd']
+	assert summary['count'] == 100 and summary['max'] == 0.1
+	# read back from the histogram to within 5%
+	assert 0.050 <= summary['p50'] <= 0.050 * 1.05
+	assert 0.099 <= summary['p99'] <= 0.1
+
+def test_stats_command(dex_name, capsys):
+	STATS.reset()
+	loop = run(dex_name, 'find 1', 'find 2', 'getsize')
+	capsys.readouterr()
+	loop.run_line('stats')
+	counts = {line.split()[0]: line.split()[1] for line in capsys.readouterr().out.splitlines()[1:]}
+	assert counts['find'] == '2' and counts['getsize'] == '1'
+
+def test_stats_summary_on_exit(dex_name, capsys, monkeypatch):
+	STATS.reset()
+	lines = iter(['find 1', 'getsize', 'exit'])
+	monkeypatch.setattr('builtins.input', lambda prompt: next(lines))
+	assert main([dex_name]) == 0
+	assert 'Ran 3 commands' in capsys.readouterr().out
+	# kept in the file instead
+	STATS.reset()
+	lines = iter(['find 1', 'exit'])
+	assert main([dex_name, '--stats-file', dex_name + '.stats.json']) == 0
+	assert 'Ran ' not in capsys.readouterr().out
+	with open(dex_name + '.stats.json') as f:
+		assert json.load(f)['find']['count'] == 1
+
+## Regional dexes
+def test_regional_view(dex_name, capsys):
+	shutil.copy(os.path.join(HERE, 'kanto.region.csv'), os.path.dirname(dex_name))
+	loop = run(dex_name)
+	assert not loop.federation.is_loaded('kanto')
+	loop.run_line('use kanto')
+	assert loop.current == 'kanto' and loop.federation.is_loaded('kanto')
+	kanto = loop.pokedex
+	assert len(kanto) == 151 and kanto.find(152) == None and kanto.find('Chikorita') == None
+	# entries are shared with the national dex
+	assert kanto.find(25) is loop.federation.national.find(25)
+	loop.run_line('use d')
+	loop.run_line('delete 4')
+	assert kanto.find(4) == None and len(kanto) == 150
+
+## Parallel parsing
+def test_parallel_parse_matches_serial(dex_name, monkeypatch):
+	rows = entries(PokeDex(dex_name, 0, False, bulk=False))
+	monkeypatch.setattr('poke_dict.PARALLEL_MIN_BYTES', 0)
+	monkeypatch.setattr('poke_dict.os.cpu_count', lambda: 4)
+	assert entries(PokeDex(dex_name, 0, False, workers=3, cache=False)) == rows
+	assert entries(ColumnarPokeDex(dex_name, 0, False, workers=3)) == rows
+
+def test_parallel_parse_is_skipped_when_it_cannot_help(dex_name, monkeypatch):
+	def no_pool(*args):
+		raise AssertionError('parsed in parallel')
+	monkeypatch.setattr('poke_dict.ProcessPoolExecutor', no_pool)
+	# a small csv
+	assert len(PokeDex(dex_name, 0, False, workers=4, cache=False)) == 428
+	# a single cpu
+	monkeypatch.setattr('poke_dict.PARALLEL_MIN_BYTES', 0)
+	monkeypatch.setattr('poke_dict.os.cpu_count', lambda: 1)
+	assert len(PokeDex(dex_name, 0, False, workers=4, cache=False)) == 428
+
+## Batches
+def test_batch_rolls_back_on_error(dex_name):
+	dex = PokeDex(dex_name, 0, False)
+	before = entries(dex)
+	with pytest.raises(PokeDexHasEntryNum):
+		with dex.batch():
+			dex.update_name(dex.find(1), 'Renamed')
+			dex.update_types(dex.find(4), TypeEnum.WATER, TypeEnum.NONE)
+			dex.delete(dex.find(2))
+			dex.find(6).set_evo_to(dex.find(3))
+			dex.add(Pokemon(500, 'Newmon'))
+			dex.add(Pokemon(7, 'Clash'))
+	assert entries(dex) == before and len(dex) == len(before)
+	# and so are the indexes
+	assert dex.find('Renamed') == None and dex.search('renamed') == []
+	assert 4 in [mon.get_num() for mon in dex.by_types(TypeEnum.FIRE)]
+	assert dex.evo_root(dex.find(3)) is dex.find(1) and dex.evo_depth(dex.find(3)) == 2
+
+def test_batch_commits_as_one(dex_name):
+	dex = PokeDex(dex_name, 0, False)
+	with dex.batch():
+		dex.add(Pokemon(500, 'Newmon', type1=TypeEnum.FIRE))
+		dex.find(500).set_evo_to(dex.find(4))
+		dex.find(500).set_evo_to(dex.find(4))
+	assert [mon.get_num() for mon in dex.find(500).get_evo_to()] == [4]
+	assert dex.evo_root(dex.find(6)) is dex.find(500) and dex.evo_depth(dex.find(6)) == 3
+	assert 500 in [mon.get_num() for mon in dex.by_types(TypeEnum.FIRE)]
+
+## Integrity check
+def test_check_finds_and_repairs_broken_links(dex_name):
+	dex = PokeDex(dex_name, 0, False)
+	assert dex.check() == []
+	# a link only one end knows about, and a loop
+	ivysaur, venusaur = dex.find(2), dex.find(3)
+	ivysaur._evo_to = []
+	charmander, charizard = dex.find(4), dex.find(6)
+	charmander._evo_from = charizard
+	charizard._evo_to.append(charmander)
+	assert dex.check(repair=True) == ['3 Venusaur evolves from 2 Ivysaur, which doesn\'t list it.', '4 Charmander, 5 Charmeleon, 6 Charizard evolve into each other in a loop.']
+	assert dex.check() == []
+	assert ivysaur.get_evo_to() == [venusaur] and charmander.get_evo_from() == None and charizard.get_evo_to() == []
+	assert dex.evo_depth(venusaur) == 2 and dex.evo_depth(charizard) == 2
+
+def test_renumbering_keeps_the_dex_consistent(dex_name):
+	dex = PokeDex(dex_name, 0, False)
+	dex.update_num(dex.find(196), 500)
+	assert [mon.get_num() for mon in dex.find(133).get_evo_to()] == [134, 135, 136, 197, 500]
+	assert dex.check() == []
+	loop = run(dex_name, 'edit 135', 'set num 501', 'save', 'exit')
+	assert loop.pokedex.check() == []
+
+## Undo and redo
+def test_undo_survives_restart(dex_name):
+	run(dex_name, 'delete 3', 'delete 4', 'undo', 'write')
+	loop = run(dex_name)
+	assert loop.pokedex.find(3) == None
+	assert loop.pokedex.find(4) != None
+	# the versions are rebuilt by the replay, so the restarted dex can keep going back and forth
+	run(dex_name, 'redo', 'write')
+	assert run(dex_name).pokedex.find(4) == None
+	run(dex_name, 'undo', 'undo', 'write')
+	loop = run(dex_name)
+	assert loop.pokedex.find(3) != None and loop.pokedex.find(4) != None
+
+def test_undo_after_compact_changes_nothing(dex_name):
+	loop = run(dex_name, 'delete 2', 'compact', 'undo', 'write')
+	assert loop.pokedex.find(2) == None
+	assert run(dex_name).pokedex.find(2) == None
+
+def test_snapshot_keeps_what_it_saw(dex_name):
+	dex = PokeDex(dex_name, 0, False)
+	with dex.snapshot() as snapshot:
+		dex.update_name(dex.find(1), 'Renamed')
+		dex.delete(dex.find(2))
+		dex.add(Pokemon(500, 'Newmon'))
+		assert snapshot.find(1).get_name() == 'Bulbasaur' and snapshot.find(500) == None
+		assert [mon.get_num() for mon in snapshot.find(1).get_evo_to()] == [2]
+		assert dex.find(1).get_evo_to() == []
+
+## Concurrent mode
+def test_waiting_writer_holds_back_new_readers():
+	lock = ReadWriteLock()
+	stop = threading.Event()
+	def read():
+		while not stop.is_set():
+			with lock.shared():
+				time.sleep(0.001)
+	# overlapping readers keep the lock shared all the time, so a writer only gets in if new readers wait for it
+	readers = [threading.Thread(target=read) for _ in range(4)]
+	for thread in readers:
+		thread.start()
+	try:
+		waits = []
+		for _ in range(20):
+			start = time.perf_counter()
+			with lock.exclusive():
+				waits.append(time.perf_counter() - start)
+	finally:
+		stop.set()
+		for thread in readers:
+			thread.join()
+	assert max(waits) < 1
+
+def test_concurrent_readers_and_writers(dex_name):
+	dex = PokeDex(dex_name, 0, False, concurrent=True)
+	names = {row[0]: row[1] for row in entries(dex)}
+	stop = threading.Event()
+	errors = []
+	done = {}
+
+	def read(rng):
+		count = 0
+		while not stop.is_set():
+			num = rng.randint(1, 428)
+			mon = dex.find(num)
+			if mon != None and mon.get_num() != num:
+				errors.append('find({}) returned {}'.format(num, mon))
+			mon = dex.find(names[num])
+			if mon != None and mon.get_name() != names[num]:
+				errors.append('find({}) returned {}'.format(names[num], mon))
+			try:
+				family = dex.evo_family(mon) if mon != None else []
+			except KeyError:
+				# deleted since it was found
+				family = []
+			if len(family) > 0 and family[0][1] != 0:
+				errors.append('the family of {} starts at depth {}'.format(mon, family[0][1]))
+			count += 1
+		done[threading.get_ident()] = ('reads', count)
+
+	def change(rng):
+		count = 0
+		while not stop.is_set():
+			num = rng.randint(1, 428)
+			with dex.batch():
+				mon = dex.find(num)
+				r = rng.random()
+				if mon == None:
+					dex.add(Pokemon(num, names[num], type1=TypeEnum.NORMAL))
+				elif r < 0.2:
+					dex.delete(mon)
+				elif r < 0.6:
+					parent = dex.find(rng.randint(1, 428))
+					if parent != None and parent is not mon and not dex.is_ancestor(mon, parent):
+						parent.set_evo_to(mon)
+				elif r < 0.8:
+					if mon.get_evo_from() != None:
+						mon.get_evo_from().del_evo_to(mon)
+				else:
+					dex.update_types(mon, TypeEnum.WATER, TypeEnum.NONE)
+			count += 1
+		done[threading.get_ident()] = ('changes', count)
+
+	threads = [threading.Thread(target=read, args=(random.Random(i),)) for i in range(6)]
+	threads += [threading.Thread(target=change, args=(random.Random(100 + i),)) for i in range(2)]
+	for thread in threads:
+		thread.start()
+	time.sleep(1)
+	stop.set()
+	for thread in threads:
+		thread.join()
+
+	assert errors == []
+	# every thread kept making progress, the writers weren't starved by the readers or the other way round
+	assert len(done) == 8 and all(count > 0 for kind, count in done.values())
+	assert dex.check() == []
+	assert [mon.get_num() for mon in dex.iter_range()] == sorted(dex._by_num)
+	assert len(dex._by_name) == len(dex._by_num) == len(dex)
+
+def test_concurrent_dex_keeps_its_name_index_built(dex_name):
+	# readers only hold the shared lock, so they must never find the name index stale
+	dex = PokeDex(dex_name, 0, False, concurrent=True)
+	assert not dex._names_stale
+	# a one-sided link, which repair fixes by rebuilding every index
+	dex.find(4)._evo_from = dex.find(1)
+	assert len(dex.check(repair=True)) > 0
+	assert not dex._names_stale
+	assert [mon.get_num() for mon in dex.search('bulbasar', fuzzy=True)] == [1]
+
+## Parse cache
+def test_cache_is_used_until_the_csv_changes(dex_name, capsys):
+	cold = PokeDex(dex_name, 0, False)
+	assert os.path.exists(dex_name + '.csv.cache')
+	capsys.readouterr()
+	warm = PokeDex(dex_name, 0, False)
+	assert 'loaded from' in capsys.readouterr().out
+	assert entries(warm) == entries(cold)
+	stat = os.stat(dex_name + '.csv')
+	with open(dex_name + '.csv', 'rb') as f:
+		data = f.read()
+	# a touched but unchanged csv is hashed and still uses the cache
+	os.utime(dex_name + '.csv', ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+	capsys.readouterr()
+	PokeDex(dex_name, 0, False)
+	assert 'loaded from' in capsys.readouterr().out
+	# a change that keeps the size but not the mtime is seen through the hash
+	with open(dex_name + '.csv', 'wb') as f:
+		f.write(data.replace(b'Bulbasaur', b'Bulbasaux'))
+	os.utime(dex_name + '.csv', ns=(stat.st_atime_ns, stat.st_mtime_ns + 2 * 10**9))
+	capsys.readouterr()
+	again = PokeDex(dex_name, 0, False)
+	assert 'loaded from' not in capsys.readouterr().out
+	assert again.find(1).get_name() == 'Bulbasaux'
+
+def test_cache_check_reads_the_csv_only_when_the_mtime_alone_differs(dex_name, monkeypatch):
+	PokeDex(dex_name, 0, False)
+	stat = os.stat(dex_name + '.csv')
+	hashed = []
+	real = hashlib.blake2b
+	monkeypatch.setattr('poke_dict.hashlib.blake2b', lambda: hashed.append(1) or real())
+	PokeDex(dex_name, 0, False)
+	assert hashed == []
+	os.utime(dex_name + '.csv', ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+	PokeDex(dex_name, 0, False)
+	assert hashed == [1]
+
+def test_cached_dex_can_be_changed(dex_name):
+	PokeDex(dex_name, 0, False)
+	warm = PokeDex(dex_name, 0, False)
+	warm.find(282).set_evo_to(warm.find(8))
+	warm.update_name(warm.find(25), 'Pikachuu')
+	assert warm.check() == [] and warm.evo_depth(warm.find(8)) == 3
+	warm.write(dex_name)
+	assert entries(PokeDex(dex_name, 0, False, cache=False)) == entries(warm)
+
+## Queries
+def test_query_matches_a_scan(dex_name):
+	dex = PokeDex(dex_name, 0, False)
+	def types(mon):
+		return (mon.get_type1(), mon.get_type2())
+	cases = {
+		'type=FIRE and num<200': lambda mon: TypeEnum.FIRE in types(mon) and mon.get_num() < 200,
+		'type1=WATER and (type2=FLYING or type2=ICE)': lambda mon: mon.get_type1() == TypeEnum.WATER and mon.get_type2() in (TypeEnum.FLYING, TypeEnum.ICE),
+		'not evolves and evolved': lambda mon: mon.get_evo_to() == [] and mon.get_evo_from() != None,
+		'stage=2 or name=pika': lambda mon: dex.evo_depth(mon) == 2 or mon.get_name().lower().startswith('pika'),
+		'stage>=1 and type!=NORMAL': lambda mon: dex.evo_depth(mon) >= 1 and TypeEnum.NORMAL not in types(mon),
+	}
+	for expr, match in cases.items():
+		assert [mon.get_num() for mon in dex.query(expr)] == [mon.get_num() for mon in dex.iter_range() if match(mon)]
+	with pytest.raises(PokeDexBadQuery):
+		dex.query('type=FIRE and')
+	with pytest.raises(PokeDexBadQuery):
+		dex.query('type=FIER')
+
+def test_query_follows_edits(dex_name):
+	dex = PokeDex(dex_name, 0, False)
+	assert 8 not in [mon.get_num() for mon in dex.query('stage=3')]
+	dex.find(282).set_evo_to(dex.find(8))
+	assert [mon.get_num() for mon in dex.query('stage=3')] == [8]
+	dex.add(Pokemon(500, 'Newmon', type1=TypeEnum.FIRE))
+	dex.update_name(dex.find(500), 'Renamed')
+	assert 500 in [mon.get_num() for mon in dex.query('stage=0 and not evolves and name=ren')]
+
+## Type effectiveness
+def test_effectiveness_matches_the_chart(dex_name):
+	dex = PokeDex(dex_name, 0, False)
+	for attacking in ((TypeEnum.ELECTRIC,), (TypeEnum.GROUND, TypeEnum.ICE)):
+		groups = dex.effectiveness(*attacking)
+		assert [multiplier for multiplier, mask in groups] == sorted(multiplier for multiplier, mask in groups)
+		scored = {}
+		for multiplier, mask in groups:
+			for num in range(mask.bit_length()):
+				if mask >> num & 1:
+					scored[num] = multiplier
+		assert scored == {mon.get_num(): max(type_multiplier(t, mon.get_type1(), mon.get_type2()) for t in attacking) for mon in dex.iter_range()}
+
+def test_effectiveness_needs_attacking_types(dex_name):
+	dex = PokeDex(dex_name, 0, False)
+	with pytest.raises(PokeDexBadType):
+		dex.effectiveness()
+	with pytest.raises(PokeDexBadType):
+		dex.effectiveness(TypeEnum.NONE)
+
+## JSON Lines
+def test_jsonl_round_trip(dex_name, tmp_path):
+	jsonl = str(tmp_path / 'd.jsonl.gz')
+	assert convert(dex_name + '.csv', jsonl) == 428
+	dex = PokeDex(jsonl, 0, False)
+	assert entries(dex) == entries(PokeDex(dex_name, 0, False))
+	back = str(tmp_path / 'back.csv')
+	assert convert(jsonl, back) == 428
+	assert list(csv_records(back)) == list(csv_records(dex_name + '.csv'))
+
+def test_empty_jsonl_is_rejected(tmp_path):
+	empty = tmp_path / 'empty.jsonl'
+	empty.write_text('\n')
+	with pytest.raises(PokeDexBadFile):
+		PokeDex(str(empty), 0, False)
+
+## Diff and patch
+def test_diff_patch_reproduces_the_new_file(dex_name, tmp_path):
+	new = str(tmp_path / 'new')
+	dex = PokeDex(dex_name, 0, False)
+	# a rename cycle, so every name is still taken by another entry when the patch renames it
+	four, five, ten = dex.find(4), dex.find(5), dex.find(10)
+	dex.update_name(ten, 'Placeholder')
+	dex.update_name(five, 'Caterpie')
+	dex.update_name(four, 'Charmeleon')
+	dex.update_name(ten, 'Charmander')
+	dex.update_types(dex.find(25), TypeEnum.WATER, TypeEnum.FIRE)
+	dex.delete(dex.find(26))
+	dex.add(Pokemon(700, 'Brandnew', type1=TypeEnum.GRASS))
+	dex.find(700).set_evo_to(dex.find(1))
+	dex.set_max_num(900)
+	dex.write(outname=new)
+
+	patch = str(tmp_path / 'change.patch')
+	assert diff(dex_name + '.csv', new + '.csv', patch=patch) != (0, 0, 0)
+	run(dex_name, 'patch {}'.format(patch), 'write {}'.format(str(tmp_path / 'patched')))
+	assert diff(new + '.csv', str(tmp_path / 'patched.csv')) == (0, 0, 0)
+	assert list(csv_records(new + '.csv')) == list(csv_records(str(tmp_path / 'patched.csv')))
+
+def test_patch_that_does_not_apply_changes_nothing(dex_name, tmp_path):
+	patch = tmp_path / 'p.jsonl'
+	patch.write_text('["add", 600, "Xa", "FIRE", "NONE"]\n["delete", 9999]\n')
+	loop = run(dex_name)
+	assert loop.run_line('patch {}'.format(patch)) == False
+	assert loop.pokedex.find(600) == None
+	assert len(loop.journal) == 0
+
+def test_undo_patch_survives_restart(dex_name, tmp_path):
+	patch = tmp_path / 'p.jsonl'
+	patch.write_text('["add", 600, "Xa", "FIRE", "NONE"]\n["add", 601, "Xb", "FIRE", "NONE"]\n["link", 600, 601]\n')
+	size = len(run(dex_name).pokedex)
+	loop = run(dex_name, 'patch {}'.format(patch), 'undo', 'write')
+	assert len(loop.pokedex) == size
+	loop = run(dex_name)
+	assert len(loop.pokedex) == size
+	assert loop.pokedex.find(600) == None and loop.pokedex.find(601) == None
+	loop = run(dex_name, 'redo')
+	assert loop.pokedex.find(601).get_evo_from() is loop.pokedex.find(600)
+
+## Reload
+def test_reload_keeps_a_conflicting_unsaved_edit(dex_name):
+	dex = PokeDex(dex_name, 0, False)
+	watcher = PokeDexWatcher(dex)
+	dex.update_name(dex.find(1), 'Ours')
+	# another program changes the same entry, and one we didn't touch
+	other = PokeDex(dex_name, 0, False, cache=False)
+	other.update_name(other.find(1), 'Theirs')
+	other.update_name(other.find(7), 'Squirt')
+	other.write(dex_name)
+	stat = os.stat(dex_name + '.csv')
+	os.utime(dex_name + '.csv', ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+
+	added, removed, changed, conflicts = watcher.poll(force=True)
+	assert (added, removed, changed) == (0, 0, 1)
+	assert len(conflicts) == 1 and 'keeping the unsaved change' in conflicts[0]
+	assert dex.find(1).get_name() == 'Ours'
+	assert dex.find(7).get_name() == 'Squirt'
+	# writing the dex keeps both
+	dex.write(dex_name)
+	again = PokeDex(dex_name, 0, False, cache=False)
+	assert again.find(1).get_name() == 'Ours' and again.find(7).get_name() == 'Squirt'